@@ -0,0 +1,58 @@
+""" A naive, reflection based, serializer : what one writes when
+one doesn't generate code. It's the baseline the generated
+serializers are compared to.
+
+It looks at the mappers on each call and serializes shared instances
+as many times as they appear.
+"""
+
+from sqlalchemy.inspection import inspect
+
+
+def naive_to_dict( instance, skip = ('parent',)) -> dict:
+    mapper = inspect( instance).mapper
+
+    d = dict()
+    for attribute in mapper.column_attrs:
+        d[ attribute.key] = getattr( instance, attribute.key)
+
+    for relation in mapper.relationships:
+        if relation.key in skip:
+            continue
+
+        value = getattr( instance, relation.key)
+        if relation.uselist:
+            d[ relation.key] = [ naive_to_dict( item, skip) for item in value]
+        elif value is not None:
+            d[ relation.key] = naive_to_dict( value, skip)
+
+    return d
+
+
+def naive_from_dict( model, d : dict, session, skip = ('parent',)):
+    mapper = inspect( model)
+
+    key = tuple( [ d.get( mapper.get_property_by_column( c).key) for c in mapper.primary_key])
+    instance = None
+    if None not in key:
+        instance = session.query( model).get( key)
+    if instance is None:
+        instance = model()
+        session.add( instance)
+
+    for attribute in mapper.column_attrs:
+        if attribute.key in d:
+            setattr( instance, attribute.key, d[ attribute.key])
+
+    for relation in mapper.relationships:
+        if relation.key in skip or relation.key not in d:
+            continue
+
+        target = relation.mapper.class_
+        if relation.uselist:
+            setattr( instance, relation.key,
+                     [ naive_from_dict( target, item, session, skip) for item in d[ relation.key]])
+        elif d[ relation.key] is not None:
+            setattr( instance, relation.key, naive_from_dict( target, d[ relation.key], session, skip))
+
+    return instance
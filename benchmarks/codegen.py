@@ -0,0 +1,161 @@
+""" Scaling of the code generation with the size of the schema.
+
+    python -m benchmarks.codegen --sizes 10,100,1000 --output codegen.json
+
+For each size, we build a schema of that many mapped classes (a tree :
+each class has a many-to-one relation to its parent and the reverse
+one-to-many relation) and we generate the serializers in both
+directions between SQLA and dicts. We measure :
+
+* walk_seconds : the time spent in CodeGenQuick.make_serializers,
+* generate_seconds : the time spent in generated_code,
+* compile_seconds : the time to compile the generated code,
+* peak_kb : the peak memory allocated while walking and generating
+  (not compiling), measured with tracemalloc in a separate run since
+  tracing slows everything down.
+
+The times are the best of --repeat runs. The cost per mapper should
+not grow with the size of the schema.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import time
+import tracemalloc
+
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import configure_mappers, relationship
+
+from pyxfer.pyxfer import SQLAWalker, TypeSupportFactory, CodeGenQuick, generated_code, default_logger
+from pyxfer.type_support import SQLATypeSupport, SQLADictTypeSupport
+
+from benchmarks.run import git_revision
+
+
+def build_models( size : int, width : int = 6, fanout : int = 4) -> list:
+    """ Builds @size mapped classes, each with @width string columns.
+    They form a tree where each class has @fanout children classes.
+    The classes are registered in this module (so that generated
+    code can import them), under names that depend on @size.
+    """
+
+    base = declarative_base()
+    module_globals = globals()
+    models = []
+
+    for i in range( size):
+        name = "Mapper{}_{}".format( size, i)
+        attributes = {
+            '__module__' : __name__,
+            '__tablename__' : name.lower(),
+            'id' : Column( Integer, primary_key=True) }
+
+        for c in range( width):
+            attributes[ "f{}".format(c)] = Column( String)
+
+        if i > 0:
+            parent = models[ (i-1) // fanout]
+            attributes[ 'parent_id'] = Column( Integer, ForeignKey( parent.id))
+            attributes[ 'parent'] = relationship( parent, backref='children{}'.format( i))
+
+        model = type( name, (base,), attributes)
+        module_globals[ name] = model
+        models.append( model)
+
+    configure_mappers()
+    return models
+
+
+def generate( models) -> tuple:
+    """ Walks @models and generates the code of their serializers.
+    Returns the durations of each step and the size of the code,
+    and the code.
+    """
+
+    sqla_factory = TypeSupportFactory( SQLATypeSupport)
+    dict_factory = TypeSupportFactory( SQLADictTypeSupport)
+    models_fc = dict( [ (model, {}) for model in models])
+
+    start = time.perf_counter()
+    serializers = []
+    for source_factory, dest_factory in [ (sqla_factory, dict_factory), (dict_factory, sqla_factory)]:
+        cgq = CodeGenQuick( source_factory, dest_factory, SQLAWalker())
+        serializers.extend( cgq.make_serializers( models_fc).values())
+    walked = time.perf_counter()
+    code = generated_code( serializers)
+    generated = time.perf_counter()
+
+    return { 'walk_seconds' : walked - start,
+             'generate_seconds' : generated - walked,
+             'lines' : code.count( "\n") + 1,
+             'characters' : len( code) }, code
+
+
+def measure( size : int, repeat : int) -> dict:
+    models = build_models( size)
+
+    best = None
+    for i in range( repeat):
+        r, code = generate( models)
+        start = time.perf_counter()
+        compile( code, "<generated>", "exec")
+        r['compile_seconds'] = time.perf_counter() - start
+
+        if best is None or r['walk_seconds'] + r['generate_seconds'] < best['walk_seconds'] + best['generate_seconds']:
+            best = r
+
+    tracemalloc.start()
+    generate( models)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = best['walk_seconds'] + best['generate_seconds']
+    for k in ('walk_seconds', 'generate_seconds', 'compile_seconds'):
+        best[k] = round( best[k], 4)
+    best['mappers'] = size
+    best['ms_per_mapper'] = round( total * 1000 / size, 3)
+    best['peak_kb'] = round( peak / 1024)
+    return best
+
+
+def run( sizes : list, repeat : int) -> dict:
+    # The factories log every type support they make
+    level = default_logger.level
+    default_logger.setLevel( logging.WARNING)
+    try:
+        results = [ measure( size, repeat) for size in sizes]
+    finally:
+        default_logger.setLevel( level)
+
+    return {
+        'config' : { 'sizes' : sizes, 'repeat' : repeat },
+        'environment' : { 'python' : platform.python_version(),
+                          'implementation' : platform.python_implementation(),
+                          'sqlalchemy' : sqlalchemy.__version__,
+                          'machine' : platform.machine(),
+                          'revision' : git_revision() },
+        'results' : results }
+
+
+def main( argv = None):
+    parser = argparse.ArgumentParser( description="Benchmarks the code generation.")
+    parser.add_argument( "--sizes", default="10,100,1000", help="Comma separated numbers of mapped classes")
+    parser.add_argument( "--repeat", type=int, default=3, help="Number of runs per size")
+    parser.add_argument( "--output", help="Where to save the results (JSON)")
+    args = parser.parse_args( argv)
+
+    report = run( [ int( s) for s in args.sizes.split(",")], args.repeat)
+
+    text = json.dumps( report, indent=2)
+    if args.output:
+        with open( args.output, "w") as f:
+            f.write( text)
+    print( text)
+
+
+if __name__ == "__main__":
+    main()
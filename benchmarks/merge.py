@@ -0,0 +1,129 @@
+""" Cost of merging a large collection, with each merge strategy.
+
+    python -m benchmarks.merge --members 20000 --removed 0.5 --output merge.json
+
+We build one root with --members children, serialize it to a dict,
+remove a --removed fraction of the children from the dict and merge
+it back into the session with each of the collection_merge strategies
+of SQLATypeSupport (MERGE_APPEND, MERGE_REPLACE, MERGE_KEYS).
+For each strategy, we measure (best of --repeat runs) :
+
+* merge_seconds : the time spent in the dict to SQLA serializer
+  (loading the collection, or its keys, is part of it),
+* flush_seconds : the time to flush the changes (the DELETE's of
+  the removed children).
+
+Each run starts from a clean session (the previous one is rolled
+back), so the collection is always loaded from the database.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from pyxfer.pyxfer import TypeSupportFactory, default_logger, SKIP
+from pyxfer.type_support import SQLATypeSupport, SQLADictTypeSupport, MERGE_APPEND, MERGE_REPLACE, MERGE_KEYS
+
+from benchmarks.schema import build_schema
+from benchmarks.run import build_serializers, git_revision
+
+
+STRATEGIES = [ MERGE_APPEND, MERGE_REPLACE, MERGE_KEYS ]
+
+
+def run( members : int, removed : float, width : int, repeat : int) -> dict:
+    schema = build_schema( depth=2, width=width, fanout=members)
+
+    # MERGE_APPEND removes the members from the collection, the
+    # session deletes them if they're orphans.
+    schema.root.children.property.cascade = "all, delete-orphan"
+
+    engine = create_engine( "sqlite:///:memory:")
+    schema.metadata.create_all( engine)
+    session = sessionmaker( bind=engine)()
+    schema.populate( session, 1)
+
+    sqla_factory = TypeSupportFactory( SQLATypeSupport)
+    dict_factory = TypeSupportFactory( SQLADictTypeSupport)
+
+    # The children refer to their tag by its key only : once some of
+    # them are removed, the short forms of the tags could refer to
+    # full forms that are not there anymore.
+    models_fc = schema.models_fc()
+    models_fc[ schema.levels[1]]['tag'] = SKIP
+
+    root = schema.root.__name__
+    to_dict = build_serializers( models_fc, [ (sqla_factory, dict_factory) ])
+    d = to_dict[ "serialize_{0}_{0}_to_dict".format( root)]( session.query( schema.root).one(), None)
+
+    # Every n-th child is removed
+    step = max( 1, int( round( 1 / removed))) if removed > 0 else None
+    d['children'] = [ c for i, c in enumerate( d['children']) if step is None or i % step != 0]
+    kept = len( d['children'])
+
+    results = dict()
+    for strategy in STRATEGIES:
+        merge_factory = TypeSupportFactory( SQLATypeSupport, collection_merge=strategy)
+        code = build_serializers( models_fc, [ (dict_factory, merge_factory) ])
+        merge = code[ "serialize_{0}_dict_to_{0}".format( root)]
+
+        best_merge, best_flush = None, None
+        for i in range( repeat):
+            session.rollback()
+            session.expunge_all()
+
+            start = time.perf_counter()
+            merged = merge( d, None, session)
+            merged_at = time.perf_counter()
+            session.flush()
+            flushed_at = time.perf_counter()
+
+            assert len( merged.children) == kept, "{} : {} children instead of {}".format( strategy, len( merged.children), kept)
+
+            best_merge = merged_at - start if best_merge is None else min( best_merge, merged_at - start)
+            best_flush = flushed_at - merged_at if best_flush is None else min( best_flush, flushed_at - merged_at)
+
+        results[strategy] = { 'merge_seconds' : round( best_merge, 3),
+                              'flush_seconds' : round( best_flush, 3) }
+
+    session.rollback()
+
+    return {
+        'config' : { 'members' : members, 'removed' : removed, 'kept' : kept,
+                     'width' : width, 'repeat' : repeat },
+        'environment' : { 'python' : platform.python_version(),
+                          'implementation' : platform.python_implementation(),
+                          'sqlalchemy' : sqlalchemy.__version__,
+                          'machine' : platform.machine(),
+                          'revision' : git_revision() },
+        'results' : results }
+
+
+def main( argv = None):
+    parser = argparse.ArgumentParser( description="Benchmarks the merge of large collections.")
+    parser.add_argument( "--members", type=int, default=20000, help="Number of children of the root")
+    parser.add_argument( "--removed", type=float, default=0.5, help="Fraction of the children removed before merging")
+    parser.add_argument( "--width", type=int, default=6, help="Number of plain columns per level")
+    parser.add_argument( "--repeat", type=int, default=3, help="Number of runs per strategy")
+    parser.add_argument( "--output", help="Where to save the results (JSON)")
+    args = parser.parse_args( argv)
+
+    # The factories log every type support they make
+    default_logger.setLevel( logging.WARNING)
+    report = run( args.members, args.removed, args.width, args.repeat)
+
+    text = json.dumps( report, indent=2)
+    if args.output:
+        with open( args.output, "w") as f:
+            f.write( text)
+    print( text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+""" Throughput and latency of the generated serializers.
+
+    python -m benchmarks.run --roots 500 --depth 3 --width 6 --fanout 4 --output results.json
+
+For each direction, we measure :
+
+* ops_per_sec : the number of roots (with all their descendants)
+  serialized per second by the serialize_many_* function. That's the
+  best of --repeat runs.
+* p50_us, p99_us : the latency of the serialization of one root
+  (with the single serializer function), in microseconds.
+
+The directions are SQLA to dict, dict to SQLA, SQLA to object
+(__slots__ classes) and object to dict. The naive reflection serializer
+of benchmarks.baseline is measured the same way, in both directions
+between SQLA and dicts.
+
+The instances are loaded (eagerly) before the measures, so the
+database reads are not measured. The dict to SQLA direction
+merges the dicts back into the session, which is rolled back
+after each run (flushing is not measured either).
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from pyxfer.context import SerializationContext
+from pyxfer.pyxfer import TypeSupportFactory, BATCH, LOADER_OPTIONS
+from pyxfer.code_cache import generate_code
+from pyxfer.type_support import SQLATypeSupport, SQLADictTypeSupport, ObjectTypeSupport
+
+from benchmarks.schema import build_schema
+from benchmarks.baseline import naive_to_dict, naive_from_dict
+
+
+def percentile( sorted_values : list, p : float):
+    index = min( len( sorted_values) - 1, int( round( p / 100.0 * (len( sorted_values) - 1))))
+    return sorted_values[ index]
+
+
+def measure( run_batch, run_one, items, repeat : int, reset = None) -> dict:
+    """ Measures the throughput of @run_batch( @items) and the latency
+    of @run_one( item) for each item. @reset is called, out of the
+    measures, before each run.
+    """
+
+    best = None
+    for i in range( repeat):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        run_batch( items)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min( best, duration)
+
+    if reset:
+        reset()
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        run_one( item)
+        latencies.append( time.perf_counter() - start)
+    latencies.sort()
+
+    return { 'ops_per_sec' : round( len( items) / best, 1),
+             'p50_us' : round( percentile( latencies, 50) * 1e6, 2),
+             'p99_us' : round( percentile( latencies, 99) * 1e6, 2) }
+
+
+def build_serializers( models_fc, directions, inline_threshold : int = 0) -> dict:
+    code = generate_code( models_fc, directions, inline_threshold=inline_threshold, companions=(BATCH, LOADER_OPTIONS))
+
+    namespace = dict()
+    exec( compile( code, "<generated>", "exec"), namespace)
+    return namespace
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output( [ "git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def run( roots : int, depth : int, width : int, fanout : int, repeat : int, inline_threshold : int = 0) -> dict:
+    schema = build_schema( depth=depth, width=width, fanout=fanout)
+
+    engine = create_engine( "sqlite:///:memory:")
+    schema.metadata.create_all( engine)
+    session = sessionmaker( bind=engine)()
+    schema.populate( session, roots)
+
+    sqla_factory = TypeSupportFactory( SQLATypeSupport)
+    dict_factory = TypeSupportFactory( SQLADictTypeSupport)
+    object_factory = TypeSupportFactory( ObjectTypeSupport, slots=True, name_format="{}Object")
+
+    start = time.perf_counter()
+    code = build_serializers( schema.models_fc(),
+                              [ (sqla_factory, dict_factory),
+                                (dict_factory, sqla_factory),
+                                (sqla_factory, object_factory),
+                                (object_factory, dict_factory) ],
+                              inline_threshold)
+    codegen_seconds = time.perf_counter() - start
+
+    root = schema.root.__name__
+    def f( name):
+        return code[ name.format( root)]
+
+    instances = session.query( schema.root).options( *f( "loader_options_{0}_{0}_to_dict")()).all()
+
+    results = dict()
+
+    results['sqla_to_dict'] = measure(
+        f( "serialize_many_{0}_{0}_to_dict"),
+        lambda i, s=f( "serialize_{0}_{0}_to_dict"): s( i, None),
+        instances, repeat)
+
+    dicts = f( "serialize_many_{0}_{0}_to_dict")( instances)
+
+    # The dicts refer to each other (the short forms of the shared
+    # tags), so they're deserialized in one context.
+    context = dict()
+    def reset():
+        session.rollback()
+        context['cache'] = SerializationContext()
+
+    results['dict_to_sqla'] = measure(
+        lambda items, s=f( "serialize_many_{0}_dict_to_{0}"): s( items, session),
+        lambda i, s=f( "serialize_{0}_dict_to_{0}"): s( i, None, session, context['cache']),
+        dicts, repeat, reset)
+
+    session.rollback()
+    instances = session.query( schema.root).options( *f( "loader_options_{0}_{0}_to_dict")()).all()
+
+    results['sqla_to_object'] = measure(
+        f( "serialize_many_{0}_{0}_to_{0}Object"),
+        lambda i, s=f( "serialize_{0}_{0}_to_{0}Object"): s( i, None),
+        instances, repeat)
+
+    objects = f( "serialize_many_{0}_{0}_to_{0}Object")( instances)
+
+    results['object_to_dict'] = measure(
+        f( "serialize_many_{0}_{0}Object_to_dict"),
+        lambda i, s=f( "serialize_{0}_{0}Object_to_dict"): s( i, None),
+        objects, repeat)
+
+    results['naive_sqla_to_dict'] = measure(
+        lambda items: [ naive_to_dict( i) for i in items],
+        naive_to_dict,
+        instances, repeat)
+
+    naive_dicts = [ naive_to_dict( i) for i in instances]
+
+    results['naive_dict_to_sqla'] = measure(
+        lambda items: [ naive_from_dict( schema.root, d, session) for d in items],
+        lambda d: naive_from_dict( schema.root, d, session),
+        naive_dicts, repeat, reset)
+
+    session.rollback()
+
+    for direction in ('sqla_to_dict', 'dict_to_sqla'):
+        results[direction]['speedup_vs_naive'] = round(
+            results[direction]['ops_per_sec'] / results['naive_' + direction]['ops_per_sec'], 2)
+
+    rows_per_root = sum( [ fanout ** d for d in range( depth)])
+
+    return {
+        'config' : { 'roots' : roots, 'depth' : depth, 'width' : width, 'fanout' : fanout,
+                     'rows_per_root' : rows_per_root, 'repeat' : repeat,
+                     'inline_threshold' : inline_threshold },
+        'environment' : { 'python' : platform.python_version(),
+                          'implementation' : platform.python_implementation(),
+                          'sqlalchemy' : sqlalchemy.__version__,
+                          'machine' : platform.machine(),
+                          'revision' : git_revision() },
+        'codegen_seconds' : round( codegen_seconds, 3),
+        'results' : results }
+
+
+def main( argv = None):
+    parser = argparse.ArgumentParser( description="Benchmarks the generated serializers.")
+    parser.add_argument( "--roots", type=int, default=500, help="Number of root instances")
+    parser.add_argument( "--depth", type=int, default=3, help="Number of levels in the schema")
+    parser.add_argument( "--width", type=int, default=6, help="Number of plain columns per level")
+    parser.add_argument( "--fanout", type=int, default=4, help="Number of children per instance")
+    parser.add_argument( "--repeat", type=int, default=3, help="Number of runs of the throughput measures")
+    parser.add_argument( "--inline", type=int, default=0, help="Inline threshold of the walker (0 : no inlining)")
+    parser.add_argument( "--output", help="Where to save the results (JSON)")
+    args = parser.parse_args( argv)
+
+    report = run( args.roots, args.depth, args.width, args.fanout, args.repeat, args.inline)
+
+    text = json.dumps( report, indent=2)
+    if args.output:
+        with open( args.output, "w") as f:
+            f.write( text)
+    print( text)
+
+
+if __name__ == "__main__":
+    main()
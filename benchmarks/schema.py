@@ -0,0 +1,149 @@
+""" A synthetic schema for the benchmarks.
+
+It's like Order/OrderPart/Operation in the tests, but its shape is
+configurable :
+
+* depth : the number of levels. Level0 (the roots) has children of
+  type Level1, which have children of type Level2, etc.
+* fanout : the number of children of each instance.
+* width : the number of plain columns of each level (integers,
+  floats, strings and dates, in turns).
+
+Every level but the roots also has a many-to-one relation to a small
+table of Tag's (shared instances, like Operation in the tests).
+
+The mapped classes are created at run time but they live in this
+module (the generated code imports them from here).
+"""
+
+import datetime
+import random
+
+from sqlalchemy import Column, Date, Float, ForeignKey, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+from pyxfer.pyxfer import SKIP
+
+
+COLUMN_TYPES = [ Integer, Float, String, Date ]
+
+
+class Schema:
+    """ The mapped classes of a synthetic schema.
+
+    :ivar levels: the mapped classes of the levels, roots first.
+    :ivar tag: the mapped class of the tags.
+    """
+
+    def __init__( self, base, levels, tag, width, fanout):
+        self.base = base
+        self.metadata = base.metadata
+        self.levels = levels
+        self.tag = tag
+        self.width = width
+        self.fanout = fanout
+
+    @property
+    def root( self):
+        return self.levels[0]
+
+    def models_fc( self) -> dict:
+        """ The models and fields controls to give to
+        CodeGenQuick.make_serializers. The relations from the
+        children to their parents are skipped.
+        """
+
+        models_fc = { self.tag : {} }
+        for i, level in enumerate( self.levels):
+            models_fc[level] = { 'parent' : SKIP } if i > 0 else {}
+        return models_fc
+
+    def populate( self, session, roots : int, tags : int = 10, seed : int = 42):
+        """ Adds @roots root instances (and all their descendants) in
+        @session. The data are random, but always the same for a given
+        @seed.
+        """
+
+        rnd = random.Random( seed)
+
+        all_tags = []
+        for i in range( tags):
+            tag = self.tag( name = "Tag {}".format(i))
+            session.add( tag)
+            all_tags.append( tag)
+
+        def make( level_index):
+            model = self.levels[ level_index]
+            instance = model()
+
+            for c in range( self.width):
+                column_type = COLUMN_TYPES[ c % len( COLUMN_TYPES)]
+                if column_type == Integer:
+                    value = rnd.randint( 0, 1000000)
+                elif column_type == Float:
+                    value = rnd.random() * 1000
+                elif column_type == String:
+                    value = "".join( rnd.choice( "abcdefghijklmnopqrstuvwxyz ") for i in range( rnd.randint( 5, 30)))
+                else:
+                    value = datetime.date( 2000, 1, 1) + datetime.timedelta( days=rnd.randint( 0, 7000))
+                setattr( instance, "f{}".format( c), value)
+
+            if level_index > 0:
+                instance.tag = rnd.choice( all_tags)
+
+            if level_index + 1 < len( self.levels):
+                for i in range( self.fanout):
+                    instance.children.append( make( level_index + 1))
+
+            return instance
+
+        for i in range( roots):
+            session.add( make( 0))
+
+        session.commit()
+
+
+def build_schema( depth : int = 3, width : int = 6, fanout : int = 4) -> Schema:
+    """ Builds the mapped classes of a synthetic schema (see the module
+    documentation). This can be done once per process only, since
+    the classes are registered in this module under fixed names.
+    """
+
+    assert depth >= 1 and width >= 0 and fanout >= 1
+
+    base = declarative_base()
+    module_globals = globals()
+
+    tag = type( "Tag", (base,), {
+        '__module__' : __name__,
+        '__tablename__' : 'tags',
+        'tag_id' : Column( Integer, primary_key=True),
+        'name' : Column( String, nullable=False) })
+    module_globals["Tag"] = tag
+
+    levels = []
+    for d in range( depth):
+        name = "Level{}".format( d)
+        attributes = {
+            '__module__' : __name__,
+            '__tablename__' : 'level{}'.format( d),
+            'level{}_id'.format( d) : Column( Integer, primary_key=True) }
+
+        for c in range( width):
+            attributes[ "f{}".format(c)] = Column( COLUMN_TYPES[ c % len( COLUMN_TYPES)])
+
+        if d > 0:
+            parent_id = 'level{}_id'.format( d-1)
+            attributes[ 'parent_id'] = Column( Integer, ForeignKey( 'level{}.{}'.format( d-1, parent_id)), nullable=False)
+            attributes[ 'tag_id'] = Column( Integer, ForeignKey( tag.tag_id), nullable=False)
+            attributes[ 'tag'] = relationship( tag, uselist=False)
+
+        if d + 1 < depth:
+            attributes[ 'children'] = relationship( "Level{}".format( d+1), backref='parent')
+
+        model = type( name, (base,), attributes)
+        module_globals[ name] = model
+        levels.append( model)
+
+    return Schema( base, levels, tag, width, fanout)
@@ -0,0 +1,381 @@
+""" Serialization of SQLA entities to fixed layout binary records.
+
+A record is made of a fixed part, packed with the struct module,
+followed by a heap where the variable length strings are stored :
+
+    total length | null mask | field 1 | field 2 | ... | heap
+
+* The total length (4 bytes) is the size of the record, heap included.
+  That's how one goes from one record to the next.
+* The null mask has one bit per field, set when the field is None.
+* Integers, floats and booleans are stored as is, dates as their
+  ordinal, datetimes as microseconds since 1970 (naive datetimes only).
+* A string is stored as its offset (relative to the start of
+  the record) and its length in the heap, UTF-8 encoded.
+
+The layout of the records of a mapped class is derived from its
+columns (see record_layout), so that both ends of a transfer agree on it
+as long as they share the mapping. Records are flat : relations
+must be SKIPped. To transfer a graph, serialize each of its
+types separately, the foreign keys will tie them back together.
+
+The records are decoded in place : iter_records reads them out
+of a memoryview over the buffer, no bytes are copied besides
+the values themselves.
+"""
+
+import datetime
+from struct import Struct
+
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Numeric, String
+
+from pyxfer.pyxfer import TypeSupport, CodeWriter, Serializer, sqla_attribute_analysis
+
+
+# --- Runtime used by the generated code ---------------------------------------
+
+_EPOCH = datetime.datetime( 1970, 1, 1)
+_MICROSECOND = datetime.timedelta( microseconds=1)
+
+def datetime_to_us( value : datetime.datetime) -> int:
+    return (value - _EPOCH) // _MICROSECOND
+
+def us_to_datetime( value : int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta( microseconds=value)
+
+date_from_ordinal = datetime.date.fromordinal
+
+
+class RecordLayout:
+    """ The layout of a record.
+
+    :param fields: a list of (field name, kind) pairs, kind being
+      one of the keys of KINDS.
+    """
+
+    KINDS = { 'int' : 'q', 'float' : 'd', 'bool' : '?',
+              'date' : 'i', 'datetime' : 'q', 'text' : 'II' }
+
+    def __init__( self, fields : list):
+        assert len( fields) <= 64, "Too many fields for the null mask : {}".format( len( fields))
+
+        self.fields = list( fields)
+
+        if len( fields) <= 8:
+            mask_format = 'B'
+        elif len( fields) <= 16:
+            mask_format = 'H'
+        elif len( fields) <= 32:
+            mask_format = 'I'
+        else:
+            mask_format = 'Q'
+
+        # Where the values are in the unpacked record. 0 is the
+        # total length and 1 is the null mask.
+        self._positions = dict()
+        self._kinds = dict()
+        self._bits = dict()
+
+        fmt = '<I' + mask_format
+        position = 2
+        for i, (name, kind) in enumerate( self.fields):
+            self._positions[name] = position
+            self._kinds[name] = kind
+            self._bits[name] = 1 << i
+            position += len( self.KINDS[kind])
+            fmt += self.KINDS[kind]
+
+        self.struct = Struct( fmt)
+
+    @property
+    def size( self) -> int:
+        """ Size of the fixed part of the records. """
+        return self.struct.size
+
+    def position( self, field : str) -> int:
+        return self._positions[field]
+
+    def kind( self, field : str) -> str:
+        return self._kinds[field]
+
+    def bit( self, field : str) -> int:
+        return self._bits[field]
+
+    def __repr__( self):
+        return "RecordLayout({})".format( repr( self.fields))
+
+
+def column_kind( column_type) -> str:
+    if issubclass( column_type, Boolean):
+        return 'bool'
+    elif issubclass( column_type, Integer):
+        return 'int'
+    elif issubclass( column_type, (Float, Numeric)):
+        # Decimals are stored as floats
+        return 'float'
+    elif issubclass( column_type, DateTime):
+        return 'datetime'
+    elif issubclass( column_type, Date):
+        return 'date'
+    elif issubclass( column_type, String):
+        return 'text'
+    else:
+        raise Exception("I don't know how to store a column of type {} in a record".format( column_type))
+
+
+def record_layout( model) -> RecordLayout:
+    """ The layout of the records of the mapped class @model.
+    All the columns are in the layout, in the order of their names.
+    """
+
+    ftypes, rnames, single_rnames, knames = sqla_attribute_analysis( model)
+    return RecordLayout( [ (name, column_kind( ftypes[name])) for name in sorted( ftypes)])
+
+
+class Record:
+    """ A record, read in place in a buffer. @values are the
+    unpacked values of its fixed part.
+    """
+
+    __slots__ = ('buffer', 'offset', 'values')
+
+    def __init__( self, buffer : memoryview, offset : int, values : tuple):
+        self.buffer = buffer
+        self.offset = offset
+        self.values = values
+
+    def text( self, position : int) -> str:
+        start = self.offset + self.values[position]
+        return str( self.buffer[start:start + self.values[position+1]], 'utf-8')
+
+
+def iter_records( buffer, layout : RecordLayout):
+    """ Iterates over the records in @buffer (bytes, bytearray,
+    mmap...), all of them having the given @layout.
+    """
+
+    view = memoryview( buffer)
+    unpack_from = layout.struct.unpack_from
+    offset = 0
+    end = len( view)
+    while offset < end:
+        values = unpack_from( view, offset)
+        yield Record( view, offset, values)
+        offset += values[0]
+
+
+# --- TypeSupports -------------------------------------------------------------
+
+def _flat_relation( model, relation_name):
+    return Exception("Records are flat, they can't hold the relation {}.{}. Please SKIP it.".format(
+        model.__name__, relation_name))
+
+
+class SQLABinaryTypeSupport(TypeSupport):
+    """ Writes SQLA entities as binary records appended to a bytearray
+    (the destination). The serialize_many_* function writes all
+    the records in one bytearray.
+    """
+
+    def __init__( self, base_type):
+        self._model = base_type
+        self._layout = record_layout( base_type)
+
+        # Fields written by the serializer being generated
+        self._written = set()
+
+    def type( self):
+        return bytearray
+
+    def type_name( self):
+        return "binary"
+
+    def type_annotation( self):
+        return "bytearray"
+
+    def make_instance_code( self, destination):
+        return "bytearray()"
+
+    def gen_global_code( self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("from pyxfer.binary_support import RecordLayout, datetime_to_us")
+        return cw
+
+    def layout_var_name( self, serializer : Serializer) -> str:
+        return serializer.companion_func_name( "layout")
+
+    def gen_destination_companions( self, serializer) -> list:
+        cw = CodeWriter()
+        cw.append_code("{} = {}".format( self.layout_var_name( serializer), repr( self._layout)))
+        return [cw]
+
+    def start_instance_serializer( self, serializer, dest_instance_name : str):
+        self._written = set()
+
+    def gen_write_field( self, instance, field, value):
+        # The values are packed all at once, in finish_serializer
+        self._written.add( field)
+        return "v_{} = {}".format( field, value)
+
+    def gen_basetype_to_type_conversion( self, field, code):
+        return code
+
+    def gen_read_field( self, instance, field):
+        raise Exception("Records can't be read back while they're written")
+
+    def cache_on_write( self, serializer, source_type_support, source_instance_name, cache_base_name, dest_instance_name):
+        # Each source makes a record, so nothing to remember.
+        pass
+
+    def finish_serializer( self, serializer):
+        layout = self._layout
+
+        serializer.append_code("# Packing the record")
+        has_heap = any( [ kind == 'text' and name in self._written for name, kind in layout.fields])
+
+        serializer.append_code("mask = 0")
+        if has_heap:
+            serializer.append_code("heap = []")
+        serializer.append_code("end = {}".format( layout.size))
+
+        packed = []
+        for name, kind in layout.fields:
+            v = "v_{}".format( name)
+
+            if name not in self._written:
+                serializer.append_code("mask |= {}".format( layout.bit( name)))
+                packed.extend( [ "0", "0"] if kind == 'text' else [ "0"])
+                continue
+
+            serializer.append_code("if {} is None:".format( v))
+            serializer.append_code("    mask |= {}".format( layout.bit( name)))
+            if kind == 'text':
+                serializer.append_code("    o_{} = l_{} = 0".format( name, name))
+                serializer.append_code("else:")
+                serializer.append_code("    b = {}.encode('utf-8')".format( v))
+                serializer.append_code("    heap.append( b)")
+                serializer.append_code("    o_{} = end".format( name))
+                serializer.append_code("    l_{} = len( b)".format( name))
+                serializer.append_code("    end += l_{}".format( name))
+                packed.extend( [ "o_" + name, "l_" + name])
+            else:
+                serializer.append_code("    {} = 0".format( v))
+                if kind == 'date':
+                    serializer.append_code("else:")
+                    serializer.append_code("    {} = {}.toordinal()".format( v, v))
+                elif kind == 'datetime':
+                    serializer.append_code("else:")
+                    serializer.append_code("    {} = datetime_to_us( {})".format( v, v))
+                packed.append( v)
+
+        serializer.append_code("dest += {}.struct.pack( end, mask, {})".format(
+            self.layout_var_name( serializer), ", ".join( packed)))
+        if has_heap:
+            serializer.append_code("for b in heap:")
+            serializer.append_code("    dest += b")
+
+    def gen_single_relation_copy( self, serializer, source_instance_name, dest_instance_name,
+                                  relation_name, source_ts, serializer_call_code):
+        raise _flat_relation( self._model, relation_name)
+
+    def relation_copy( self, serializer, source_instance_name, dest_instance_name, relation_name,
+                       source_ts, dest_ts,
+                       rel_source_type_support,
+                       serializer_call_code,
+                       base_type = None):
+        raise Exception("Records are flat, they can't hold the relation {}. Please SKIP it.".format( relation_name))
+
+    def gen_batch_serializer( self, serializer) -> CodeWriter:
+        # All the records go into one buffer
+
+        cw = CodeWriter()
+        cw.append_code("def {}( sources, destination : bytearray = None, cache : SerializationContext = None):".format(
+            serializer.batch_func_name()))
+        cw.indent_right()
+        cw.append_code("if cache is None:")
+        cw.append_code("    cache = SerializationContext.for_call()")
+        cw.append_code("if destination is None:")
+        cw.append_code("    destination = bytearray()")
+        cw.append_code("serializer = {}".format( serializer.func_name()))
+        cw.append_code("for source in sources:")
+        cw.append_code("    serializer( source, destination, cache)")
+        cw.append_code("return destination")
+        cw.indent_left()
+        return cw
+
+    def __str__( self):
+        return "SQLABinaryTypeSupport[{}]".format( self._model.__name__)
+
+
+class SQLARecordTypeSupport(TypeSupport):
+    """ Reads the binary records written with SQLABinaryTypeSupport.
+    The sources are Record's, as given by iter_records or
+    by the records_* companion function :
+
+        records = records_Order_record_to_dict( data)
+        dicts = serialize_many_Order_record_to_dict( records)
+    """
+
+    def __init__( self, base_type):
+        self._model = base_type
+        self._layout = record_layout( base_type)
+
+    def type( self):
+        return Record
+
+    def type_name( self):
+        return "record"
+
+    def type_annotation( self):
+        return "Record"
+
+    def make_instance_code( self, destination):
+        raise Exception("Records are read only")
+
+    def gen_global_code( self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("from pyxfer.binary_support import RecordLayout, Record, iter_records, date_from_ordinal, us_to_datetime")
+        return cw
+
+    def layout_var_name( self, serializer : Serializer) -> str:
+        return serializer.companion_func_name( "layout")
+
+    def gen_source_companions( self, serializer) -> list:
+        cw = CodeWriter()
+        cw.append_code("{} = {}".format( self.layout_var_name( serializer), repr( self._layout)))
+        cw.append_code("")
+        cw.append_code("def {}( buffer):".format( serializer.companion_func_name( "records")))
+        cw.append_code("    return iter_records( buffer, {})".format( self.layout_var_name( serializer)))
+        return [cw]
+
+    def gen_read_field( self, instance, field):
+        layout = self._layout
+        position = layout.position( field)
+        kind = layout.kind( field)
+
+        if kind == 'text':
+            value = "{}.text({})".format( instance, position)
+        elif kind == 'date':
+            value = "date_from_ordinal( {}.values[{}])".format( instance, position)
+        elif kind == 'datetime':
+            value = "us_to_datetime( {}.values[{}])".format( instance, position)
+        else:
+            value = "{}.values[{}]".format( instance, position)
+
+        return "(None if {}.values[1] & {} else {})".format( instance, layout.bit( field), value)
+
+    def gen_type_to_basetype_conversion( self, field, code):
+        return code
+
+    def cache_key( self, serializer : Serializer, key_var : str, source_instance_name : str, cache_base_name : str):
+        # Each record is read once
+        serializer.append_code( "{} = None".format( key_var))
+
+    def gen_is_single_relation_present( self, instance, relation_name) -> str:
+        raise _flat_relation( self._model, relation_name)
+
+    def gen_read_relation( self, instance, relation_name):
+        raise _flat_relation( self._model, relation_name)
+
+    def __str__( self):
+        return "SQLARecordTypeSupport[{}]".format( self._model.__name__)
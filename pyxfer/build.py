@@ -0,0 +1,134 @@
+""" Ahead of time generation of the serializers.
+
+    python -m pyxfer.build myapp.models SERIALIZERS --output myapp/generated/serializers.py
+
+imports the module myapp.models (so that its mappers are declared),
+reads the spec SERIALIZERS, generates the code of the serializers
+it describes and writes it as a regular module, with its bytecode.
+In production, you just import that module : there's no code
+generation, no compilation and no analysis of the mappers at startup,
+and forked workers share the loaded code.
+
+The spec is the name of an attribute of the models module, or
+"module:attribute". It is a dict with :
+
+* "models" : the mapped classes and their fields controls (the dict
+  given to CodeGenQuick.make_serializers),
+* "directions" : a list of (source factory, destination factory) pairs,
+* "walker_options" : optional, given to SQLAWalker (for example
+  { 'instrumentation' : COUNTERS }).
+
+A function returning such a dict is fine too.
+
+The first line of the module is the fingerprint of what it was
+generated from (see code_cache.schema_fingerprint). With --check,
+nothing is written but the exit status is 1 if the module is missing
+or outdated (so that a CI notices it must be rebuilt).
+"""
+
+import argparse
+import importlib
+import os
+import sys
+
+from pyxfer.code_cache import schema_fingerprint, generate_code, write_module
+
+
+FINGERPRINT_HEADER = "# pyxfer fingerprint : "
+
+
+def load_spec( models_module : str, spec : str) -> dict:
+    """ Imports @models_module and returns the @spec it
+    denotes (see the module documentation).
+    """
+
+    module = importlib.import_module( models_module)
+
+    if ":" in spec:
+        module_name, attribute = spec.split(":", 1)
+        module = importlib.import_module( module_name)
+    else:
+        attribute = spec
+
+    value = getattr( module, attribute)
+    if callable( value):
+        value = value()
+
+    if type( value) != dict or "models" not in value or "directions" not in value:
+        raise Exception("The spec {} must be a dict with 'models' and 'directions' (or a function giving one)".format( spec))
+    return value
+
+
+def spec_fingerprint( spec : dict) -> str:
+    return schema_fingerprint( spec["models"], spec["directions"],
+                               walker_options=spec.get( "walker_options"))
+
+
+def module_fingerprint( path : str) -> str:
+    """ The fingerprint written in the module at @path, None if
+    there's no such module (or it wasn't built by us).
+    """
+
+    if not os.path.exists( path):
+        return None
+
+    with open( path, encoding='utf-8') as f:
+        line = f.readline().rstrip("\n")
+
+    if line.startswith( FINGERPRINT_HEADER):
+        return line[ len( FINGERPRINT_HEADER):]
+    return None
+
+
+def build( spec : dict, path : str) -> bool:
+    """ Generates the serializers of @spec in the module at @path,
+    unless it's already up to date. If the module's directory
+    is not a package, it's made one (with an empty __init__.py).
+    Returns True if the module was written.
+    """
+
+    fingerprint = spec_fingerprint( spec)
+    if module_fingerprint( path) == fingerprint:
+        return False
+
+    code = generate_code( spec["models"], spec["directions"], **( spec.get( "walker_options") or dict()))
+    write_module( FINGERPRINT_HEADER + fingerprint + "\n" + code + "\n", path)
+
+    init_path = os.path.join( os.path.dirname( os.path.abspath( path)), "__init__.py")
+    if not os.path.exists( init_path):
+        write_module( "", init_path)
+
+    return True
+
+
+def main( argv = None) -> int:
+    parser = argparse.ArgumentParser( prog="python -m pyxfer.build",
+                                      description="Generates the serializers as an importable module.")
+    parser.add_argument( "models", help="The module declaring the mappers")
+    parser.add_argument( "spec", help="The spec, an attribute of the models module or module:attribute")
+    parser.add_argument( "--output", required=True, help="The python file to write")
+    parser.add_argument( "--check", action="store_true", help="Don't write, exit with 1 if the module is outdated")
+    args = parser.parse_args( argv)
+
+    # Like "python -m", the current directory is importable.
+    if "" not in sys.path and os.getcwd() not in sys.path:
+        sys.path.insert( 0, os.getcwd())
+
+    spec = load_spec( args.models, args.spec)
+
+    if args.check:
+        if module_fingerprint( args.output) != spec_fingerprint( spec):
+            print( "{} is outdated".format( args.output))
+            return 1
+        print( "{} is up to date".format( args.output))
+        return 0
+
+    if build( spec, args.output):
+        print( "Wrote {}".format( args.output))
+    else:
+        print( "{} is up to date".format( args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit( main())
@@ -0,0 +1,225 @@
+""" On-disk cache of the generated serializers.
+
+Generating the serializers means walking all the mappers, building
+the code and compiling it. With a few hundred mappers, that's
+a significant part of a process start. So we fingerprint
+everything that has an influence on the generated code
+(the mappers, the fields controls and the TypeSupport classes)
+and store the generated module, with its bytecode, under
+that fingerprint. Next time, we just import it.
+"""
+
+import hashlib
+import importlib.util
+import inspect as pyinspect
+import os
+import py_compile
+import sys
+import tempfile
+
+from sqlalchemy.inspection import inspect
+
+from pyxfer.pyxfer import default_logger, Serializer, SQLAWalker, CodeGenQuick, generated_code
+from pyxfer.inline import inline_call
+
+
+def _qualified_name( obj):
+    return "{}.{}".format( obj.__module__, obj.__qualname__)
+
+
+def _source_digest( obj):
+    """ Digest of the source file defining @obj. That's how we
+    notice that a TypeSupport was modified.
+    """
+
+    try:
+        path = pyinspect.getsourcefile( obj)
+    except TypeError:
+        path = None
+
+    if not path or not os.path.exists( path):
+        return _qualified_name( obj)
+
+    with open( path, 'rb') as f:
+        return hashlib.sha256( f.read()).hexdigest()
+
+
+def _canonical_fields_control( fields_control):
+    """ A stable text representation of a fields control. """
+
+    parts = []
+    for name in sorted( fields_control):
+        value = fields_control[name]
+        if isinstance( value, Serializer):
+            value = "serializer:" + value.func_name()
+        elif type( value) == dict:
+            value = "{" + _canonical_fields_control( value) + "}"
+        elif type( value) == type:
+            value = _qualified_name( value)
+        else:
+            value = repr( value)
+        parts.append( "{}={}".format( name, value))
+    return ",".join( parts)
+
+
+def _canonical_mapper( model):
+    """ A stable text representation of a SQLA mapper, limited to
+    what the walker looks at.
+    """
+
+    mapper = inspect( model)
+    parts = [ _qualified_name( model),
+              str( getattr( mapper, 'local_table', None)) ]
+
+    for prop in sorted( mapper.column_attrs, key=lambda p:p.key):
+        parts.append( "column:{}:{}:{}".format(
+            prop.key, prop.columns[0].name, repr( prop.columns[0].type)))
+
+    for key, relation in sorted( mapper.relationships.items()):
+        parts.append( "relation:{}:{}:{}:{}".format(
+            key, _qualified_name( relation.mapper.class_), relation.uselist,
+            getattr( relation.collection_class, '__name__', relation.collection_class)))
+
+    parts.append( "keys:{}".format( ",".join( [k.name for k in mapper.primary_key])))
+    return "\n".join( parts)
+
+
+def _canonical_factory( factory):
+    type_support_class = getattr( factory, '_type_support_class', None) or type( factory)
+    options = getattr( factory, '_options', None) or dict()
+    return "{}:{}:{}:{}".format(
+        _qualified_name( type( factory)),
+        _qualified_name( type_support_class),
+        _source_digest( type_support_class),
+        _canonical_fields_control( options))
+
+
+def schema_fingerprint( models_fc, directions, walker_class = SQLAWalker, walker_options : dict = None) -> str:
+    """ Computes a key that changes whenever the code generated
+    for @models_fc in the given @directions would change.
+
+    :param models_fc: a map from SQLA mapped classes to their fields controls
+      (the one you give to CodeGenQuick.make_serializers).
+    :param directions: a list of (source factory, destination factory) pairs.
+    :param walker_options: the options given to the walker's constructor.
+    """
+
+    h = hashlib.sha256()
+
+    # The code generator itself
+    for module_object in (Serializer, inline_call, walker_class):
+        h.update( _source_digest( module_object).encode('utf-8'))
+    h.update( _canonical_fields_control( walker_options or dict()).encode('utf-8'))
+
+    for model in sorted( models_fc, key=_qualified_name):
+        h.update( _canonical_mapper( model).encode('utf-8'))
+        h.update( _canonical_fields_control( models_fc[model]).encode('utf-8'))
+
+    for source_factory, dest_factory in directions:
+        h.update( "{}->{}".format( _canonical_factory( source_factory),
+                                   _canonical_factory( dest_factory)).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def generate_code( models_fc, directions, walker_class = SQLAWalker, logger = default_logger, **walker_options) -> str:
+    """ Generates the code of the serializers of @models_fc in
+    the given @directions (see schema_fingerprint).
+    """
+
+    walker = walker_class( logger, **walker_options)
+    serializers = []
+    for source_factory, dest_factory in directions:
+        cgq = CodeGenQuick( source_factory, dest_factory, walker, logger)
+        serializers.extend( cgq.make_serializers( models_fc).values())
+    return generated_code( serializers)
+
+
+def write_module( code : str, path : str):
+    """ Writes @code as a python module at @path together with
+    its compiled bytecode (at the usual __pycache__ location, so
+    that the regular import machinery picks it).
+
+    The write is atomic so that concurrent processes never see
+    half a module.
+    """
+
+    directory = os.path.dirname( os.path.abspath( path))
+    os.makedirs( directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp( suffix=".py", dir=directory)
+    with os.fdopen( fd, 'w', encoding='utf-8') as f:
+        f.write( code)
+    os.replace( tmp_path, path)
+
+    py_compile.compile( path, cfile=importlib.util.cache_from_source( path), doraise=True)
+
+
+def load_module( path : str, module_name : str = None):
+    """ Imports the python file at @path (and registers it in
+    sys.modules under @module_name).
+    """
+
+    if module_name is None:
+        module_name = os.path.splitext( os.path.basename( path))[0]
+
+    if module_name in sys.modules:
+        return sys.modules[ module_name]
+
+    spec = importlib.util.spec_from_file_location( module_name, path)
+    module = importlib.util.module_from_spec( spec)
+    sys.modules[ module_name] = module
+    try:
+        spec.loader.exec_module( module)
+    except Exception:
+        del sys.modules[ module_name]
+        raise
+    return module
+
+
+class GeneratedCodeCache:
+    """ Cache of generated serializers modules, stored in a directory.
+
+    Usage :
+
+        cache = GeneratedCodeCache( "/var/cache/myapp")
+        serializers = cache.get_module( model_and_field_controls,
+                                        [ (sqla_factory, dict_factory),
+                                          (dict_factory, sqla_factory) ])
+        serializers.serialize_Order_Order_to_dict( order)
+    """
+
+    MODULE_PREFIX = "pyxfer_generated_"
+
+    def __init__( self, cache_dir : str, walker_class = SQLAWalker, logger = default_logger, **walker_options):
+        """ :param walker_options: given to the walker's constructor,
+        for example instrumentation=TIMING.
+        """
+
+        self._cache_dir = cache_dir
+        self._walker_class = walker_class
+        self._walker_options = walker_options
+        self._logger = logger
+
+    def module_path( self, fingerprint : str) -> str:
+        return os.path.join( self._cache_dir, "{}{}.py".format( self.MODULE_PREFIX, fingerprint[0:32]))
+
+    def generate( self, models_fc, directions) -> str:
+        """ Generates the code, without any caching. """
+
+        return generate_code( models_fc, directions, self._walker_class, self._logger, **self._walker_options)
+
+    def get_module( self, models_fc, directions):
+        """ Returns the module containing the serializers for
+        @models_fc in the given @directions. The module is
+        generated only if it's not in the cache.
+        """
+
+        fingerprint = schema_fingerprint( models_fc, directions, self._walker_class, self._walker_options)
+        path = self.module_path( fingerprint)
+
+        if not os.path.exists( path):
+            self._logger.debug("Code cache miss, generating {}".format( path))
+            write_module( self.generate( models_fc, directions), path)
+
+        return load_module( path)
@@ -0,0 +1,227 @@
+""" The serialization context is the "cache" parameter that all the
+generated serializers pass around. It remembers what was already
+serialized so that shared instances are serialized once
+and reference cycles are broken.
+
+The generated serializers look the context up once or twice per
+instance. So an unbounded context is a dict, and these look ups are
+native dict operations. Only a bounded context (see max_size) pays
+for the bookkeeping of its least recently used entries.
+"""
+
+import weakref
+from contextlib import contextmanager
+
+
+class SerializationContext( dict):
+    """ Remembers the results of serializations, for one call
+    or one batch of calls.
+
+    The generated serializers create a new context when the caller
+    doesn't give one. So nothing is kept from one call to another,
+    unless you explicitly share a context, for example :
+
+        with SerializationContext() as context:
+            for order in orders:
+                serialize_Order_Order_to_dict( order, None, context)
+
+    The context is cleared when leaving the "with" block.
+
+    :param max_size: If given, the context won't hold more than
+      @max_size entries (it's a BoundedSerializationContext). The least
+      recently used ones are evicted first. Note that when deserializing
+      dicts, a short form dict (see SQLADictTypeSupport) can only be
+      resolved if its full form is still in the context. So only bound
+      a context if you know your data don't rely on that. The entries
+      are also what breaks the reference cycles, so nothing is evicted
+      while the context is pinned (see pinned).
+    :param weak_identity: Entries keyed on the identity of a source
+      instance (see identity_key) are dropped as soon as the instance
+      is garbage collected. Therefore, the context doesn't keep
+      the source instances alive.
+    """
+
+    def __new__( cls, max_size : int = None, weak_identity : bool = True):
+        if max_size is not None and cls is SerializationContext:
+            cls = BoundedSerializationContext
+        return super().__new__( cls)
+
+    def __init__( self, max_size : int = None, weak_identity : bool = True):
+        assert max_size is None or max_size > 0, "Wrong max_size {}".format( max_size)
+
+        super().__init__()
+        self.max_size = max_size
+        self._weak_identity = weak_identity
+
+        # id(instance) -> [ weakref or instance, set of cache keys ]
+        self._watched = dict()
+
+        # Instances loaded ahead of the serialization, see
+        # pyxfer.sqla_runtime.prefetch. It's a map from mapped class
+        # to a map from key tuple to the instance (None if there's
+        # no such instance in the database).
+        self.prefetched = dict()
+
+    # A context is a mutable dict, but it's not compared by value.
+    __hash__ = object.__hash__
+
+    def __eq__( self, other):
+        return self is other
+
+    def __ne__( self, other):
+        return self is not other
+
+    def __bool__( self):
+        return True
+
+    @classmethod
+    def for_call( cls) -> 'SerializationContext':
+        """ The context a generated serializer makes when it's given
+        none. It lives as long as the call and all the instances the
+        call reaches stay referenced (by the instance given to the
+        serializer, or by the list of instances given to a batch
+        serializer) until it returns. So their ids can't be reused
+        and the identity keys don't need to watch the instances.
+        """
+        return _CallContext()
+
+    def identity_key( self, base_name : str, instance):
+        """ Builds a cache key denoting @instance (not its value, its
+        identity).
+
+        An identity key is only meaningful while the instance lives
+        (after that, its id may be reused). So we watch the instance
+        and forget about it when it's garbage collected. Instances
+        that can't be weak referenced are kept alive by the context.
+        """
+
+        i = id(instance)
+        key = (base_name, i)
+
+        watched = self._watched.get( i)
+        if watched is None:
+            try:
+                if not self._weak_identity:
+                    raise TypeError()
+                ref = weakref.ref( instance, self._forget_callback( i))
+            except TypeError:
+                ref = instance
+            watched = self._watched[i] = [ ref, set() ]
+
+        watched[1].add( key)
+        return key
+
+    def _forget_callback( self, instance_id):
+        # Don't hold a strong reference on the context in the
+        # weakref's callback, that would make a cycle.
+        context_ref = weakref.ref( self)
+
+        def forget( ref):
+            context = context_ref()
+            if context is not None:
+                context._forget( instance_id, ref)
+
+        return forget
+
+    def _forget( self, instance_id, ref):
+        watched = self._watched.get( instance_id)
+        if watched is not None and watched[0] is ref:
+            del self._watched[ instance_id]
+            for key in watched[1]:
+                self.pop( key, None)
+
+    @contextmanager
+    def pinned( self):
+        """ Within the "with" block, the entries are not evicted,
+        whatever max_size. When serializing a root instance, the
+        entries of the instances being serialized must stay : they're
+        what stops the serializer from following a cycle again. The
+        context is trimmed back to max_size when leaving the block :
+
+            with context.pinned():
+                serialize_Order_Order_to_dict( order, None, context)
+
+        An unbounded context never evicts anything.
+        """
+
+        yield self
+
+    def clear( self):
+        super().clear()
+        self._watched.clear()
+        self.prefetched.clear()
+
+    def __enter__( self):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback):
+        self.clear()
+        return False
+
+    def __repr__( self):
+        return "{}[{} entries, max_size={}]".format( type( self).__name__, len( self), self.max_size)
+
+
+class _CallContext( SerializationContext):
+    # See SerializationContext.for_call
+
+    def identity_key( self, base_name : str, instance):
+        return (base_name, id(instance))
+
+
+class BoundedSerializationContext( SerializationContext):
+    """ A SerializationContext holding at most max_size entries,
+    the least recently used are evicted first. That's what
+    SerializationContext( max_size = ...) makes.
+    """
+
+    def __init__( self, max_size : int = None, weak_identity : bool = True):
+        assert max_size is not None, "A bounded context needs a max_size"
+        super().__init__( max_size, weak_identity)
+        self._pinned = 0
+
+    def _evicted( self, key):
+        if type(key) == tuple and len(key) == 2:
+            watched = self._watched.get( key[1])
+            if watched is not None and key in watched[1]:
+                watched[1].discard( key)
+                if not watched[1]:
+                    del self._watched[ key[1]]
+
+    def __getitem__( self, key):
+        # Moved to the end : the dict's order is the order of use
+        value = dict.pop( self, key)
+        dict.__setitem__( self, key, value)
+        return value
+
+    def get( self, key, default = None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+
+    def __setitem__( self, key, value):
+        dict.pop( self, key, None)
+        dict.__setitem__( self, key, value)
+        if not self._pinned:
+            self._trim()
+
+    def __delitem__( self, key):
+        dict.__delitem__( self, key)
+        self._evicted( key)
+
+    def _trim( self):
+        while len( self) > self.max_size:
+            evicted_key = next( iter( self))
+            dict.__delitem__( self, evicted_key)
+            self._evicted( evicted_key)
+
+    @contextmanager
+    def pinned( self):
+        self._pinned += 1
+        try:
+            yield self
+        finally:
+            self._pinned -= 1
+            if not self._pinned:
+                self._trim()
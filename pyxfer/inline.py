@@ -0,0 +1,226 @@
+""" Inlining of a generated serializer into the one that calls it.
+
+Following a single relation costs a call to the relation's serializer
+for each instance. When that serializer is small (typically, a leaf
+of the schema, like Operation for OrderPart), its body can replace
+the call. So this :
+
+    dest['operation'] = serialize_Operation_Operation_to_dict(source.operation, None, cache)
+
+becomes :
+
+    _i1_source = source.operation
+    if _i1_source is None:
+        _i1_result = None
+    else:
+        ...the body of serialize_Operation_Operation_to_dict...
+        _i1_result = _i1_dest
+    dest['operation'] = _i1_result
+
+The local variables of the inlined function are prefixed so that
+they don't clash with the caller's ones. Its returns become
+assignments to the result variable. That's only possible when
+the returns don't hide in loops, try or with blocks. Whatever we
+can't transform safely is left as a regular call.
+
+This works on the syntax tree of the generated code, and needs
+ast.unparse (Python 3.9+). Without it, nothing is inlined.
+"""
+
+import ast
+import copy
+
+
+class _CantInline(Exception):
+    pass
+
+
+def can_inline() -> bool:
+    return hasattr( ast, 'unparse')
+
+
+def _has_return( node) -> bool:
+    return any( isinstance( n, ast.Return) for n in ast.walk( node))
+
+
+def _always_returns( statements) -> bool:
+    if not statements:
+        return False
+    last = statements[-1]
+    if isinstance( last, ast.Return):
+        return True
+    if isinstance( last, ast.If):
+        return _always_returns( last.body) and _always_returns( last.orelse)
+    return False
+
+
+def _assign( name : str, value) -> ast.Assign:
+    return ast.Assign( targets=[ ast.Name( id=name, ctx=ast.Store())],
+                       value=value if value is not None else ast.Constant( value=None))
+
+
+def _eliminate_returns( statements, result : str) -> list:
+    # The @statements, with the returns replaced by assignments
+    # to @result (the code after them goes in else branches).
+
+    transformed = []
+    for i, statement in enumerate( statements):
+        if isinstance( statement, ast.Return):
+            transformed.append( _assign( result, statement.value))
+            return transformed
+
+        if not _has_return( statement):
+            transformed.append( statement)
+            continue
+
+        if not isinstance( statement, ast.If):
+            # A return in a loop, a try, a with...
+            raise _CantInline()
+
+        rest = statements[i+1:]
+        body_returns = _always_returns( statement.body)
+        orelse_returns = _always_returns( statement.orelse)
+
+        if body_returns and orelse_returns:
+            body, orelse = statement.body, statement.orelse
+        elif body_returns:
+            body, orelse = statement.body, statement.orelse + rest
+        elif orelse_returns:
+            body, orelse = statement.body + rest, statement.orelse
+        else:
+            raise _CantInline()
+
+        transformed.append( ast.If( test=statement.test,
+                                    body=_eliminate_returns( body, result),
+                                    orelse=_eliminate_returns( orelse, result) if orelse else []))
+        return transformed
+
+    # Falling off the end of a function returns None
+    transformed.append( _assign( result, None))
+    return transformed
+
+
+class _Renamer( ast.NodeTransformer):
+    # Renames the local variables, replaces the parameters
+    # which are never assigned by the arguments they're given.
+
+    def __init__( self, renames : dict, substitutions : dict):
+        self._renames = renames
+        self._substitutions = substitutions
+
+    def visit_Name( self, node):
+        if node.id in self._substitutions:
+            return copy.deepcopy( self._substitutions[ node.id])
+        elif node.id in self._renames:
+            return ast.copy_location( ast.Name( id=self._renames[ node.id], ctx=node.ctx), node)
+        return node
+
+
+class _Folder( ast.NodeTransformer):
+    # Resolves the if's whose test compares two constants with "is"
+    # or "is not" (that's what the substitution of a None argument
+    # gives, like "if None is None:").
+
+    def visit_If( self, node):
+        self.generic_visit( node)
+
+        test = node.test
+        if isinstance( test, ast.Compare) and len( test.ops) == 1 and \
+           isinstance( test.left, ast.Constant) and isinstance( test.comparators[0], ast.Constant) and \
+           isinstance( test.ops[0], (ast.Is, ast.IsNot)):
+
+            same = test.left.value is test.comparators[0].value
+            if isinstance( test.ops[0], ast.IsNot):
+                same = not same
+            return (node.body if same else node.orelse) or ast.Pass()
+
+        return node
+
+
+def _assigned_names( function) -> set:
+    return set( [ node.id for node in ast.walk( function)
+                  if isinstance( node, ast.Name) and isinstance( node.ctx, (ast.Store, ast.Del))])
+
+
+def _called( statement, func_name : str):
+    # The call to @func_name which is the whole value of @statement
+    # (maybe awaited), as (call, awaited). None if there's no such call.
+
+    if isinstance( statement, (ast.Assign, ast.Expr)):
+        value = statement.value
+        awaited = isinstance( value, ast.Await)
+        if awaited:
+            value = value.value
+        if isinstance( value, ast.Call) and isinstance( value.func, ast.Name) and value.func.id == func_name:
+            return value, awaited
+    return None
+
+
+def inline_call( line : str, function_code : str, func_name : str, prefix : str) -> list:
+    """ The lines of code replacing @line, which calls the function
+    @func_name defined by @function_code, by the body of that
+    function. @prefix is put in front of the local variables of
+    the function. @line must be a statement (with no indentation)
+    whose value is the call, like "dest['x'] = f( source.x, None, cache)".
+
+    Returns None if the call can't be inlined.
+    """
+
+    if not can_inline():
+        return None
+
+    try:
+        function = ast.parse( function_code).body[0]
+        statement = ast.parse( line).body[0]
+    except (SyntaxError, IndexError):
+        return None
+
+    if not isinstance( function, (ast.FunctionDef, ast.AsyncFunctionDef)) or function.name != func_name:
+        return None
+
+    called = _called( statement, func_name)
+    if called is None:
+        return None
+    call, awaited = called
+
+    parameters = [ a.arg for a in function.args.args]
+    if awaited != isinstance( function, ast.AsyncFunctionDef) or \
+       call.keywords or len( call.args) != len( parameters) or function.args.vararg or function.args.kwarg:
+        return None
+
+    for node in ast.walk( function):
+        if node is not function and isinstance( node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef,
+                                                        ast.Global, ast.Nonlocal, ast.Yield, ast.YieldFrom)):
+            return None
+
+    assigned = _assigned_names( function)
+    local_names = assigned | set( parameters)
+    renames = dict( [ (name, "{}{}".format( prefix, name)) for name in local_names])
+
+    # The arguments which are plain names or constants replace their
+    # parameters (if they're never assigned). The others are
+    # evaluated once, in the order of the call, like a call does.
+    statements = []
+    substitutions = dict()
+    for parameter, argument in zip( parameters, call.args):
+        if isinstance( argument, (ast.Name, ast.Constant)) and parameter not in assigned:
+            substitutions[ parameter] = argument
+        else:
+            statements.append( _assign( renames[ parameter], argument))
+
+    result = "{}result".format( prefix)
+    try:
+        body = _eliminate_returns( function.body, result)
+    except _CantInline:
+        return None
+
+    module = ast.Module( body=body, type_ignores=[])
+    module = _Renamer( renames, substitutions).visit( module)
+    module = _Folder().visit( module)
+
+    statements.extend( module.body)
+    statement.value = ast.Name( id=result, ctx=ast.Load()) # The call (and its await)
+    statements.append( statement)
+
+    module = ast.fix_missing_locations( ast.Module( body=statements, type_ignores=[]))
+    return ast.unparse( module).split( "\n")
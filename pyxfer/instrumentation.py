@@ -0,0 +1,115 @@
+""" Runtime statistics of the generated serializers.
+
+When the walker is asked to instrument the serializers
+(SQLAWalker( instrumentation=COUNTERS or TIMING)), the generated
+functions count their calls, cache hits and misses and the
+instances they produce, and optionally the time spent in them.
+They report into the registry of this module :
+
+    from pyxfer.instrumentation import registry
+    print( registry.report())
+
+Without instrumentation, the generated code doesn't change at all,
+so there's no overhead.
+
+The counters are updated without locking. Under heavy threading,
+they're an approximation.
+"""
+
+import threading
+
+
+# Instrumentation modes
+COUNTERS = "counters"
+TIMING = "timing" # counters and timers
+
+
+class SerializerStats:
+    """ The statistics of one generated serializer.
+
+    * calls : number of calls (with a source which is not None).
+    * cache_hits : number of times the source was already in
+      the context (so the cached result was returned).
+    * cache_misses : number of times the source was serialized.
+    * produced : number of instances produced.
+    * time_ns : time spent in the serializer, in nanoseconds (only
+      with TIMING). This includes the time spent in the serializers
+      it calls for the relations.
+    """
+
+    __slots__ = ('name', 'calls', 'cache_hits', 'cache_misses', 'produced', 'time_ns')
+
+    def __init__( self, name : str):
+        self.name = name
+        self.reset()
+
+    def reset( self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.produced = 0
+        self.time_ns = 0
+
+    def as_dict( self) -> dict:
+        return { 'calls' : self.calls,
+                 'cache_hits' : self.cache_hits,
+                 'cache_misses' : self.cache_misses,
+                 'produced' : self.produced,
+                 'time_ns' : self.time_ns }
+
+    def __repr__( self):
+        return "SerializerStats[{} : {}]".format( self.name, self.as_dict())
+
+
+class StatsRegistry:
+    """ The statistics of all the instrumented serializers,
+    by serializer name.
+    """
+
+    def __init__( self):
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def get( self, name : str) -> SerializerStats:
+        """ The statistics of the serializer @name, created if needed.
+        The generated code calls this when it's loaded.
+        """
+
+        stats = self._stats.get( name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault( name, SerializerStats( name))
+        return stats
+
+    def __getitem__( self, name : str) -> SerializerStats:
+        return self._stats[name]
+
+    def __contains__( self, name : str):
+        return name in self._stats
+
+    def __iter__( self):
+        return iter( list( self._stats.values()))
+
+    def snapshot( self) -> dict:
+        """ A copy of all the statistics, as a dict of dicts. """
+        return dict( [ (s.name, s.as_dict()) for s in self])
+
+    def reset( self):
+        """ Sets all the counters back to zero. """
+        for s in self:
+            s.reset()
+
+    def report( self, sort_by : str = 'calls') -> str:
+        """ A text table of the statistics, hottest serializers first. """
+
+        stats = sorted( self, key=lambda s:getattr( s, sort_by), reverse=True)
+
+        lines = [ "{:>10} {:>10} {:>10} {:>10} {:>12}  {}".format(
+            "calls", "hits", "misses", "produced", "time (ms)", "serializer") ]
+        for s in stats:
+            lines.append( "{:>10} {:>10} {:>10} {:>10} {:>12.3f}  {}".format(
+                s.calls, s.cache_hits, s.cache_misses, s.produced, s.time_ns / 1e6, s.name))
+        return "\n".join( lines)
+
+
+registry = StatsRegistry()
@@ -0,0 +1,261 @@
+""" Serialization of SQLA entities directly to JSON text.
+
+Serializing to dicts and then calling json.dumps on them builds
+the data twice. SQLAJSONTypeSupport generates serializers that write
+the JSON text right away into a stream (a StringIO, a file,
+an HTTP response...). The keys are turned into JSON literals
+(with their quotes, colons and commas) when the code is generated.
+"""
+
+import datetime
+import decimal
+import gzip
+import io
+import json
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import Boolean, Date, DateTime, Integer, String
+
+from pyxfer.pyxfer import TypeSupport, CodeWriter, sqla_attribute_analysis
+from pyxfer.type_support import SQLADictTypeSupport
+
+
+# --- Encoders used by the generated code -------------------------------------
+
+def _default( value):
+    if isinstance( value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    elif isinstance( value, decimal.Decimal):
+        return float( value)
+    elif isinstance( value, uuid.UUID):
+        return str( value)
+    else:
+        raise TypeError("Can't convert {} to JSON".format( type(value)))
+
+_encode = json.JSONEncoder( default=_default).encode
+_encode_string = json.encoder.encode_basestring
+
+
+def json_value( value) -> str:
+    """ JSON text of any value. """
+    return _encode( value)
+
+def json_int( value) -> str:
+    if value is None:
+        return 'null'
+    return int.__repr__( value)
+
+def json_string( value) -> str:
+    if value is None:
+        return 'null'
+    return _encode_string( value)
+
+def json_date( value) -> str:
+    if value is None:
+        return 'null'
+    return '"' + value.isoformat() + '"'
+
+
+@contextmanager
+def json_stream( fileobj, compress : bool = False, encoding : str = 'utf-8'):
+    """ Gives a buffered text stream writing into the binary file
+    object @fileobj (a file, an HTTP response...), optionally
+    gzip-compressed. The file object is left open.
+
+        with open( "orders.json.gz", "wb") as f, json_stream( f, compress=True) as out:
+            serialize_many_Order_Order_to_json( orders, out)
+    """
+
+    raw = gzip.GzipFile( fileobj=fileobj, mode='wb') if compress else fileobj
+    text = io.TextIOWrapper( raw, encoding=encoding)
+    try:
+        yield text
+    finally:
+        text.flush()
+        text.detach()
+        if compress:
+            raw.close()
+
+
+# --- TypeSupport -------------------------------------------------------------
+
+class SQLAJSONTypeSupport(TypeSupport):
+    """ Writes the JSON representation of SQLA entities into a
+    text stream. The JSON is the same as the one you'd get with
+    json.dumps over the dicts made with SQLADictTypeSupport,
+    including the short forms of entities already serialized
+    (see SQLADictTypeSupport.ID_TAG).
+
+    The serializers return the stream they wrote to (a new StringIO
+    if none was given).
+    """
+
+    ID_TAG = SQLADictTypeSupport.ID_TAG
+
+    def __init__( self, base_type):
+        self._model = base_type
+        self._ftypes, rnames, single_rnames, self._key_names = sqla_attribute_analysis( base_type)
+
+        # Set while generating a serializer : have we already
+        # written a key in the current JSON object ?
+        self._first_key = True
+
+    def type( self):
+        return io.TextIOBase
+
+    def type_name( self):
+        return "json"
+
+    def type_annotation( self):
+        return "TextIO"
+
+    def make_instance_code( self, destination):
+        return "io.StringIO()"
+
+    def gen_global_code( self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("import io")
+        cw.append_code("from typing import TextIO")
+        cw.append_code("from pyxfer.json_support import json_value, json_int, json_string, json_date")
+        return cw
+
+    def _key_literal( self, name : str) -> str:
+        """ The JSON text introducing the key @name in the current
+        object, as a python literal.
+        """
+
+        if self._first_key:
+            prefix = '{'
+            self._first_key = False
+        else:
+            prefix = ','
+
+        return repr( prefix + json.dumps( name) + ':')
+
+    def _encoder( self, field : str) -> str:
+        t = self._ftypes.get( field)
+        if t is None or issubclass( t, Boolean):
+            return "json_value"
+        elif issubclass( t, Integer):
+            return "json_int"
+        elif issubclass( t, String):
+            return "json_string"
+        elif issubclass( t, Date) and not issubclass( t, DateTime):
+            return "json_date"
+        else:
+            return "json_value"
+
+    def start_instance_serializer( self, serializer, dest_instance_name : str):
+        self._first_key = True
+        serializer.append_code("write = {}.write".format( dest_instance_name))
+
+    def gen_write_field( self, instance, field, value):
+        return "write( {} + {})".format( self._key_literal( field), value)
+
+    def gen_basetype_to_type_conversion( self, field, code):
+        return "{}( {})".format( self._encoder( field), code)
+
+    def gen_read_field( self, instance, field):
+        raise Exception("JSON text can't be read back by the generated code")
+
+    def finish_serializer( self, serializer):
+        if self._first_key:
+            serializer.append_code("write('{}')")
+        else:
+            serializer.append_code("write('}')")
+
+    def gen_cache_hit( self, serializer, key_var : str):
+        # We write the short form of the source (see cache_on_write)
+        serializer.append_code("if destination is None:")
+        serializer.append_code("    destination = io.StringIO()")
+        serializer.append_code("destination.write( cache[{}])".format( key_var))
+        serializer.append_code("return destination")
+
+    def cache_on_write( self, serializer, source_type_support, source_instance_name, cache_base_name, dest_instance_name):
+        # Same short forms as SQLADictTypeSupport, but as JSON text.
+
+        key_reads = [ source_type_support.gen_read_field( source_instance_name, k) for k in self._key_names]
+        serializer.append_code("zulu = ({},)".format( ",".join( key_reads)))
+
+        parts = []
+        for i, k in enumerate( self._key_names):
+            parts.append( "{} + {}( zulu[{}])".format(
+                repr( ('{' if i == 0 else ',') + json.dumps( k) + ':'), self._encoder( k), i))
+
+        serializer.append_code("if any(zulu):")
+        serializer.append_code("    cache[cache_key] = {} + '}}'".format( " + ".join( parts)))
+        serializer.append_code("else:")
+        serializer.append_code("    cache[cache_key] = '{{\"{}\":' + str( id({})) + '}}'".format(
+            self.ID_TAG, source_instance_name))
+
+    def gen_single_relation_copy( self, serializer, source_instance_name, dest_instance_name,
+                                  relation_name, source_ts, serializer_call_code):
+
+        # Like dicts, an absent relation is not written at all
+        serializer.append_code( "if ({}):".format(
+            source_ts.gen_is_single_relation_present( source_instance_name, relation_name)))
+        serializer.indent_right()
+        serializer.append_code( "write( {})".format( self._key_literal( relation_name)))
+        serializer.append_code( serializer_call_code(
+            source_ts.gen_read_field( source_instance_name, relation_name),
+            dest_instance_name))
+        serializer.indent_left()
+
+    def relation_copy( self, serializer, source_instance_name, dest_instance_name, relation_name,
+                       source_ts, dest_ts,
+                       rel_source_type_support,
+                       serializer_call_code,
+                       base_type = None):
+
+        # Note that the key is written in the JSON object described
+        # by dest_ts, not in the one described by self (which
+        # describes the items of the relation).
+
+        serializer.append_code("# ------ relation : {} ------".format(relation_name))
+        serializer.append_code("write( {} + '[')".format( dest_ts._key_literal( relation_name)))
+        serializer.append_code("sep = ''")
+        serializer.append_code("for item in {}:".format(
+            source_ts.gen_read_relation( source_instance_name, relation_name)))
+        serializer.indent_right()
+        serializer.append_code("write( sep)")
+        serializer.append_code("sep = ','")
+        serializer.append_code( serializer_call_code( 'item', dest_instance_name))
+        serializer.indent_left()
+        serializer.append_code("write(']')")
+
+    def gen_batch_serializer( self, serializer) -> CodeWriter:
+        # A batch is a JSON array.
+
+        cw = CodeWriter()
+        cw.append_code("def {}( sources, destination : TextIO = None, cache : SerializationContext = None):".format(
+            serializer.batch_func_name()))
+        cw.indent_right()
+        cw.append_code("if cache is None:")
+        cw.append_code("    cache = SerializationContext.for_call()")
+        cw.append_code("if destination is None:")
+        cw.append_code("    destination = io.StringIO()")
+        cw.append_code("serializer = {}".format( serializer.func_name()))
+        cw.append_code("write = destination.write")
+        cw.append_code("write('[')")
+        cw.append_code("sep = ''")
+        cw.append_code("for source in sources:")
+        cw.indent_right()
+        cw.append_code("write( sep)")
+        cw.append_code("sep = ','")
+        cw.append_code("if source is None:")
+        cw.append_code("    write('null')")
+        cw.append_code("else:")
+        cw.append_code("    serializer( source, destination, cache)")
+        cw.indent_left()
+        cw.append_code("write(']')")
+        cw.append_code("return destination")
+        cw.indent_left()
+        return cw
+
+    def gen_stream_serializer( self, serializer) -> CodeWriter:
+        # Yields the JSON text of each source.
+        return serializer.gen_default_stream_serializer( "{}.getvalue()")
+
+    def __str__( self):
+        return "SQLAJSONTypeSupport[{}]".format( self._model.__name__)
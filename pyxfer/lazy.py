@@ -0,0 +1,124 @@
+""" Serializers generated on first use.
+
+CodeGenQuick and generated_code make the serializers of all the
+mapped classes upfront. When a process uses only a few of them,
+that's a lot of time and memory for nothing. LazySerializers
+generates the code of a serializer (and of the serializers of the
+relations it follows) the first time it's requested, compiles it
+and keeps the functions :
+
+    serializers = LazySerializers( model_and_field_controls, companions=(BATCH,))
+    to_dict = serializers.get( sqla_factory, Order, dict_factory)
+    to_dict( order)
+    serializers.get( sqla_factory, Order, dict_factory, "serialize_many")( orders)
+
+Building the registry costs nothing : the mappers are not even
+analysed. The generated code is dropped once compiled : the registry
+keeps the functions and, for each serializer, a stub (see
+Serializer.stub) that the serializers generated later can call.
+"""
+
+import threading
+
+from pyxfer.pyxfer import default_logger, SQLAWalker, CodeGenQuick, generated_code, merge_dicts, schema_index, SKIP, VIEWS
+
+
+class LazySerializers:
+    """ A registry of serializers, generated when they're first
+    requested. The serializers of each (source factory, mapped class,
+    destination factory) are generated once. That's thread safe.
+    """
+
+    def __init__( self, models_fc, walker_class = SQLAWalker, logger = default_logger, **walker_options):
+        """ :param models_fc: a dict from mapped class to its fields control
+          (see CodeGenQuick.make_serializers).
+        :param walker_options: given to the walker's constructor,
+          for example instrumentation=TIMING.
+        """
+
+        self._models_fc = models_fc
+        self._walker = walker_class( logger, **walker_options)
+        self._logger = logger
+        self._lock = threading.RLock()
+
+        # (source factory, destination factory) -> (CodeGenQuick, { mapped class -> Serializer stub })
+        self._directions = dict()
+
+        # The generated functions, of all the directions
+        self._namespace = dict()
+
+    def get( self, source_factory, model, dest_factory, prefix : str = "serialize"):
+        """ The function generated for @model from @source_factory's
+        type to @dest_factory's one. By default, that's the serializer,
+        @prefix selects another function generated along it, for
+        example "serialize_many", "stream" or "loader_options"
+        (see Serializer.companion_func_name), if the walker
+        generates it (see SQLAWalker's companions).
+
+        The first time, the serializers are generated, along with
+        the ones of the relations they follow.
+        """
+
+        serializers = self._direction( source_factory, dest_factory)[1]
+        serializer = serializers.get( model)
+
+        if serializer is None:
+            with self._lock:
+                serializer = serializers.get( model)
+                if serializer is None:
+                    self._generate( source_factory, model, dest_factory)
+                    serializer = serializers[model]
+
+        return self._namespace[ serializer.companion_func_name( prefix)]
+
+    def is_generated( self, source_factory, model, dest_factory) -> bool:
+        return model in self._direction( source_factory, dest_factory)[1]
+
+    def _direction( self, source_factory, dest_factory):
+        direction = self._directions.get( (source_factory, dest_factory))
+        if direction is None:
+            with self._lock:
+                direction = self._directions.setdefault(
+                    (source_factory, dest_factory),
+                    ( CodeGenQuick( source_factory, dest_factory, self._walker, self._logger), dict()))
+        return direction
+
+    def _followed( self, model) -> list:
+        # The mapped classes the relations of @model lead to, when
+        # they're followed by its serializer or one of its views.
+
+        fields_control = self._models_fc[model]
+        controls = [ fields_control ] + [ merge_dicts( fields_control, view) for view in fields_control.get( VIEWS, {}).values()
+                                          if type( view) == dict ]
+
+        return [ relation_target for relation_name, relation_target in schema_index.info( model).relations.items()
+                 if relation_target in self._models_fc and any( fc.get( relation_name) != SKIP for fc in controls) ]
+
+    def _generate( self, source_factory, model, dest_factory):
+        if model not in self._models_fc:
+            raise Exception("{} is not one of the mapped classes of this registry".format( model.__name__))
+
+        cgq, serializers = self._direction( source_factory, dest_factory)
+
+        # What's reachable from @model and not generated yet
+        todo = dict()
+        stack = [ model]
+        while stack:
+            m = stack.pop()
+            if m not in todo and m not in serializers:
+                todo[m] = self._models_fc[m]
+                stack.extend( self._followed( m))
+
+        self._logger.debug("Generating the serializers of {}".format( ", ".join( sorted( [ m.__name__ for m in todo]))))
+
+        made = cgq.make_serializers( todo, serializers)
+        code = generated_code( list( made.values()))
+        exec( compile( code, "<pyxfer {}>".format( model.__name__), "exec"), self._namespace)
+
+        for key, serializer in made.items():
+            if key in todo:
+                serializers[key] = serializer.stub()
+
+        # The walker remembers what it made, to refuse duplicates.
+        # We don't make any, so there's no need to keep the code.
+        self._walker.serializers.clear()
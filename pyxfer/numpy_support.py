@@ -0,0 +1,218 @@
+""" Columnar serialization of SQLA entities into NumPy arrays.
+
+When one serializes lots of entities only to pivot them into arrays
+afterwards, it's much cheaper to write them directly into
+arrays : one array per column (a "struct of arrays"). That's what
+SQLANumpyTypeSupport does.
+
+NumPy is an optional dependency of Pyxfer. This module (and the
+code generated with it) needs it.
+"""
+
+import numpy
+
+from sqlalchemy import Boolean, Date, DateTime, Integer, Numeric
+from sqlalchemy.inspection import inspect
+
+from pyxfer.pyxfer import TypeSupport, CodeWriter, sqla_attribute_analysis, BATCH
+
+
+class ColumnBatch:
+    """ A batch of rows stored as one NumPy array per column.
+
+    The arrays are preallocated for @size rows, @row is the
+    number of rows actually filled.
+    """
+
+    def __init__( self, dtypes : dict, size : int):
+        self.arrays = dict( [ (name, numpy.empty( size, dtype=dtype)) for name, dtype in dtypes.items()])
+        self.row = 0
+
+    def keys( self):
+        return self.arrays.keys()
+
+    def __getitem__( self, name):
+        """ The filled part of the array of column @name. """
+        return self.arrays[name][0:self.row]
+
+    def __len__( self):
+        return self.row
+
+    def __repr__( self):
+        return "ColumnBatch[{} rows : {}]".format( self.row, ", ".join( self.arrays.keys()))
+
+
+def column_dtype( column_type, nullable : bool) -> str:
+    """ The NumPy dtype to store the values of a column of SQLA
+    type @column_type.
+
+    Integer and boolean arrays can't store None, so nullable
+    integers are stored as floats (None becomes NaN) and nullable
+    booleans as objects. Dates become NaT when None.
+    Everything else (strings for example) is stored as objects.
+    """
+
+    if issubclass( column_type, Boolean):
+        return 'object' if nullable else 'bool'
+    elif issubclass( column_type, Integer):
+        return 'float64' if nullable else 'int64'
+    elif issubclass( column_type, Numeric):
+        # Float is a Numeric too
+        return 'float64'
+    elif issubclass( column_type, DateTime):
+        return 'datetime64[us]'
+    elif issubclass( column_type, Date):
+        return 'datetime64[D]'
+    else:
+        return 'object'
+
+
+class SQLANumpyTypeSupport(TypeSupport):
+    """ Writes SQLA entities into a ColumnBatch. The dtypes of the
+    columns are derived from the SQLA column types.
+
+    The serializer generated with this TypeSupport writes one row
+    in a ColumnBatch given as destination. The serialize_many_*
+    function is where the speed is : it allocates the arrays for
+    the whole batch and fills them in one pass.
+
+    This representation is flat, so relations can't be
+    serialized with it (SKIP them).
+    """
+
+    def __init__( self, base_type):
+        self._model = base_type
+
+        ftypes, rnames, single_rnames, knames = sqla_attribute_analysis( base_type)
+        mapper = inspect( base_type)
+
+        self._dtypes = dict()
+        for field, field_type in ftypes.items():
+            self._dtypes[field] = column_dtype( field_type, mapper.column_attrs[field].columns[0].nullable)
+
+    def type( self):
+        return ColumnBatch
+
+    def type_name( self):
+        return "columns"
+
+    def type_annotation( self):
+        return "ColumnBatch"
+
+    def dtype( self, field_name):
+        return self._dtypes[field_name]
+
+    def make_instance_code( self, destination):
+        # The destination batch must be given, see class doc.
+        return None
+
+    def gen_global_code( self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("import numpy")
+        cw.append_code("from pyxfer.numpy_support import ColumnBatch")
+        return cw
+
+    def gen_write_field( self, instance, field, value):
+        return "{}.arrays['{}'][{}.row] = {}".format( instance, field, instance, value)
+
+    def gen_read_field( self, instance, field):
+        return "{}.arrays['{}'][{}.row]".format( instance, field, instance)
+
+    def gen_basetype_to_type_conversion( self, field, code):
+        # NumPy converts None, dates, etc. by itself.
+        return code
+
+    def cache_on_write( self, serializer, source_type_support, source_instance_name, cache_base_name, dest_instance_name):
+        # Each source makes a row, so nothing to remember.
+        pass
+
+    def finish_serializer( self, serializer):
+        serializer.append_code("dest.row += 1")
+
+    def gen_single_relation_copy( self, serializer, source_instance_name, dest_instance_name,
+                                  relation_name, source_ts, serializer_call_code):
+        raise Exception("Columns are flat, they can't hold the relation {}.{}. Please SKIP it.".format(
+            self._model.__name__, relation_name))
+
+    def relation_copy( self, serializer, source_instance_name, dest_instance_name, relation_name,
+                       source_ts, dest_ts,
+                       rel_source_type_support,
+                       serializer_call_code,
+                       base_type = None):
+        raise Exception("Columns are flat, they can't hold the relation {}. Please SKIP it.".format( relation_name))
+
+    def dtypes_var_name( self, serializer) -> str:
+        return serializer.companion_func_name( "columns")
+
+    def gen_destination_companions( self, serializer) -> list:
+        # The dtypes of the columns written by the serializer, so
+        # that one can build a ColumnBatch for it.
+
+        cw = CodeWriter()
+        cw.append_code("{} = {{ {} }}".format(
+            self.dtypes_var_name( serializer),
+            ", ".join( [ "'{}' : '{}'".format( f, self._dtypes[f]) for f in serializer.field_names])))
+        return [cw]
+
+    def gen_batch_serializer( self, serializer) -> CodeWriter:
+        source_ts = serializer.source_type_support
+
+        cw = CodeWriter()
+        cw.append_code("def {}( sources, cache : SerializationContext = None):".format(
+            serializer.batch_func_name()))
+        cw.indent_right()
+        cw.append_code("if not isinstance( sources, (list, tuple)):")
+        cw.append_code("    sources = list( sources)")
+        cw.append_code("batch = ColumnBatch( {}, len( sources))".format( self.dtypes_var_name( serializer)))
+
+        # Hoist the arrays out of the loop
+        for i, field in enumerate( serializer.field_names):
+            cw.append_code("c{} = batch.arrays['{}']".format( i, field))
+
+        cw.append_code("for row, source in enumerate( sources):")
+        cw.indent_right()
+        for i, field in enumerate( serializer.field_names):
+            cw.append_code("c{}[row] = {}".format(
+                i,
+                self.gen_basetype_to_type_conversion(
+                    field,
+                    source_ts.gen_type_to_basetype_conversion(
+                        field,
+                        source_ts.gen_read_field( "source", field)))))
+        cw.indent_left()
+
+        cw.append_code("batch.row = len( sources)")
+        cw.append_code("return batch")
+        cw.indent_left()
+        return cw
+
+    def gen_stream_serializer( self, serializer) -> CodeWriter:
+        # Yields a ColumnBatch for every @window sources.
+
+        if BATCH not in serializer.companions:
+            raise Exception("The stream of {} is made by its batch serializer, please ask for the BATCH companion too".format( serializer.func_name()))
+
+        cw = CodeWriter()
+        cw.append_code("def {}( sources, cache : SerializationContext = None, window : int = 1000, release = None):".format(
+            serializer.stream_func_name()))
+        cw.indent_right()
+        cw.append_code("serializer = {}".format( serializer.batch_func_name()))
+        cw.append_code("chunk = []")
+        cw.append_code("for source in sources:")
+        cw.indent_right()
+        cw.append_code("chunk.append( source)")
+        cw.append_code("if len( chunk) >= window:")
+        cw.append_code("    yield serializer( chunk, cache)")
+        cw.append_code("    if release is not None:")
+        cw.append_code("        release( chunk)")
+        cw.append_code("    chunk = []")
+        cw.indent_left()
+        cw.append_code("if chunk:")
+        cw.append_code("    yield serializer( chunk, cache)")
+        cw.append_code("    if release is not None:")
+        cw.append_code("        release( chunk)")
+        cw.indent_left()
+        return cw
+
+    def __str__( self):
+        return "SQLANumpyTypeSupport[{}]".format( self._model.__name__)
@@ -0,0 +1,151 @@
+""" Serialization of large collections of SQLA entities over
+several processes.
+
+The roots to serialize are split in chunks of primary keys. Each
+chunk is sent to a worker process which loads the roots with its
+own session and serializes them with the serialize_many_* function of
+the generated module. The results come back in the order of the keys.
+
+The workers import the generated module from its file, so it must
+be a file backed module (see GeneratedCodeCache), not an exec'd string.
+It must be generated with the BATCH companion (and LOADER_OPTIONS, to
+eager load the roots' relations).
+The session factory is pickled to the workers, so it must be
+picklable (sessionmaker's aren't, use EngineSessionFactory or
+a module level function).
+
+Each chunk is serialized with its own SerializationContext, so a
+shared entity is serialized in full once per chunk (instead of once
+overall) and its short forms only refer to it within its chunk.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session
+
+from pyxfer.code_cache import load_module
+from pyxfer.sqla_runtime import load
+
+
+class EngineSessionFactory:
+    """ A picklable session factory. The engine is created from
+    its URL in each process, the first time a session is needed.
+    """
+
+    def __init__( self, url : str, **engine_options):
+        self.url = url
+        self.engine_options = engine_options
+        self._engine = None
+
+    def __getstate__( self):
+        return { 'url' : self.url, 'engine_options' : self.engine_options, '_engine' : None }
+
+    def __call__( self):
+        if self._engine is None:
+            self._engine = create_engine( self.url, **self.engine_options)
+        return Session( bind=self._engine)
+
+
+# The state of a worker process
+_worker_module = None
+_worker_session = None
+
+def _init_worker( module_path : str, module_name : str, session_factory):
+    global _worker_module, _worker_session
+
+    _worker_module = load_module( module_path, module_name)
+    _worker_session = session_factory()
+
+
+def _serialize_chunk( model, serializer_name : str, keys : list):
+    batch_serializer = getattr( _worker_module, "serialize_many_" + serializer_name[len("serialize_"):])
+
+    # Eager load what the serializer will read, if the source knows how to.
+    loader_options = getattr( _worker_module, "loader_options_" + serializer_name[len("serialize_"):], None)
+    options = loader_options() if loader_options else ()
+
+    try:
+        roots = load( _worker_session, model, keys, options)
+        return batch_serializer( roots)
+    finally:
+        # Don't accumulate instances from one chunk to the next
+        _worker_session.rollback()
+        _worker_session.expunge_all()
+
+
+class ParallelSerializer:
+    """ Runs a generated serializer over a pool of processes.
+
+        cache = GeneratedCodeCache( "/var/cache/myapp", companions=(BATCH, LOADER_OPTIONS))
+        module = cache.get_module( model_and_field_controls, [ (sqla_factory, dict_factory) ])
+
+        with ParallelSerializer( module, "serialize_Order_Order_to_dict", Order,
+                                 EngineSessionFactory( "postgresql://...")) as parallel:
+            dicts = parallel.map( order_ids)
+
+    :param module: the generated module, loaded from a file.
+    :param serializer_name: the name of the serializer to run. Its source
+      must be the model's instances (as given by the session).
+    :param max_workers: the number of processes, defaults to the
+      number of CPU's.
+    :param chunk_size: how many roots are sent to a worker at once.
+    :param mp_context: the multiprocessing context of the pool.
+    """
+
+    def __init__( self, module, serializer_name : str, model, session_factory,
+                  max_workers : int = None, chunk_size : int = 1000, mp_context = None):
+
+        assert getattr( module, '__file__', None), "The generated module must be loaded from a file"
+        assert hasattr( module, serializer_name), "Unknown serializer {}".format( serializer_name)
+        assert chunk_size > 0
+
+        self._serializer_name = serializer_name
+        self._model = model
+        self._chunk_size = chunk_size
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count(),
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=( module.__file__, module.__name__, session_factory))
+
+    def _key( self, key_or_root) -> tuple:
+        if isinstance( key_or_root, self._model):
+            return inspect( key_or_root).identity
+        elif isinstance( key_or_root, tuple):
+            return key_or_root
+        else:
+            return ( key_or_root,)
+
+    def map( self, keys_or_roots) -> list:
+        """ Serializes the roots denoted by @keys_or_roots and returns
+        the results in the same order. Roots are given either as
+        instances of the model (only their primary keys are sent to
+        the workers), primary key tuples, or, for single
+        column primary keys, primary key values.
+
+        The result of an unknown key is None.
+        """
+
+        keys = [ self._key( k) for k in keys_or_roots]
+        chunks = [ keys[i:i+self._chunk_size] for i in range( 0, len( keys), self._chunk_size)]
+
+        results = []
+        for chunk_results in self._executor.map( _serialize_chunk,
+                                                 [ self._model] * len( chunks),
+                                                 [ self._serializer_name] * len( chunks),
+                                                 chunks):
+            results.extend( chunk_results)
+        return results
+
+    def close( self):
+        self._executor.shutdown()
+
+    def __enter__( self):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback):
+        self.close()
+        return False
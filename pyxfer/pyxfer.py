@@ -1,8 +1,12 @@
 import logging
+import weakref
 from datetime import datetime
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import ColumnProperty
 
+from pyxfer.instrumentation import COUNTERS, TIMING
+from pyxfer.inline import inline_call
+
 default_logger = logging.Logger("Montgomery")
 default_logger.addHandler(logging.StreamHandler())
 default_logger.setLevel(logging.DEBUG)
@@ -41,9 +45,16 @@ class CodeWriter:
         else:
             raise Exception("Unexpected data")
 
-        for i in range( len( lines)):
-            line = lines[i]
-            self._code.insert( ndx+i, "    " * indentation_level + line)
+        # One list operation for all the lines (inserting them one
+        # by one costs a move of the tail of the code for each line).
+        if indentation_level:
+            prefix = "    " * indentation_level
+            lines = [ prefix + line for line in lines]
+
+        if ndx >= len( self._code):
+            self._code.extend( lines)
+        else:
+            self._code[ndx:ndx] = lines
 
     def append_code(self, lines):
         self.insert_code(lines, len(self._code), self._indentation)
@@ -97,6 +108,43 @@ class TypeSupport:
         """
         raise NotImplementedError()
 
+    def type_annotation(self) -> str:
+        """ The type annotation of the parameters of the type managed by
+        this TypeSupport in the generated code. It must be a name
+        the generated code knows about.
+        """
+        return self.type_name()
+
+    def gen_batch_serializer(self, serializer : 'Serializer') -> CodeWriter:
+        """ Code of the batch serializer (see Serializer.gen_batch_serializer)
+        producing instances of the type managed by this TypeSupport.
+        None means the default one is fine.
+        """
+        return None
+
+    def is_asynchronous(self) -> bool:
+        """ True if the code generated by this TypeSupport must
+        run in a coroutine (it awaits things). The serializers using
+        it are then "async def" functions.
+        """
+        return False
+
+    def gen_stream_serializer(self, serializer : 'Serializer') -> CodeWriter:
+        """ Code of the streaming serializer (see Serializer.gen_stream_serializer)
+        producing instances of the type managed by this TypeSupport.
+        None means the default one is fine.
+        """
+        return None
+
+    def short_forms_need_context(self) -> bool:
+        """ True if the instances of the type supported by this
+        TypeSupport refer to the ones read before them with short
+        forms, which are resolved in the context. These can't be read
+        through a bounded context, so they're not streamed (see
+        Serializer.gen_stream_serializer).
+        """
+        return False
+
     def relation_read_iterator( self, relation_name : str):
         # By default the iterator works over immutable sequence-like objects;
 
@@ -108,9 +156,69 @@ class TypeSupport:
         """
         pass
 
+    def start_instance_serializer( self, serializer : 'Serializer', dest_instance_name : str):
+        """ What to do once the destination instance is known, before
+        anything is written into it.
+        """
+        pass
+
+    def start_source_serializer( self, serializer : 'Serializer', source_instance_name : str):
+        """ What to do before anything is read from the source instance
+        (which is of the type described by this TypeSupport).
+        """
+        pass
+
+    def gen_read_guard( self, instance : str, field : str) -> str:
+        """ An expression telling if the non-key @field of @instance
+        (described by this TypeSupport) must be copied at all. None
+        means it's always copied. The key fields are always copied.
+        """
+        return None
+
+    def gen_write_guard( self, source_ts : 'TypeSupport', source_instance : str, field : str) -> str:
+        """ An expression telling if the non-key @field must be written
+        in the instance described by this TypeSupport, given the source
+        instance @source_instance (described by @source_ts). None means
+        it's always written.
+        """
+        return None
+
+    def gen_has_field( self, instance : str, field : str) -> str:
+        """ An expression telling if @field is present in @instance.
+        """
+        raise NotImplementedError()
+
     def check_instance_serializer( self, serializer : 'Serializer', dest_instance_name : str):
         pass
 
+    def gen_cache_hit( self, serializer : 'Serializer', key_var : str):
+        """ Builds the code to run when the source was already serialized,
+        that is, when its key is in the cache.
+        """
+
+        serializer.append_code( "return cache[{}]".format( key_var))
+
+    def gen_source_companions(self, serializer : 'Serializer') -> list:
+        """ Code of the functions to generate along a serializer
+        which reads instances of the type described by this TypeSupport
+        (a list of CodeWriter).
+        """
+        return []
+
+    def gen_destination_companions(self, serializer : 'Serializer') -> list:
+        """ Code of the functions to generate along a serializer
+        which produces instances of the type described by this TypeSupport
+        (a list of CodeWriter).
+        """
+        return []
+
+    def gen_batch_prologue(self, serializer : 'Serializer', code : CodeWriter, sources_var : str):
+        """ What to do before serializing a batch of sources
+        (see Serializer.gen_batch_serializer) into instances of the
+        type described by this TypeSupport.
+        """
+        pass
+
     def cache_key( self, serializer : 'Serializer', key_var : str, source_instance_name : str, cache_base_name : str):
         """ Builds code to compute the key that will be used
         to cache serialization results. If the results must
@@ -121,7 +229,7 @@ class TypeSupport:
         # Default implementation, may not work for every
         # scenarios (see DictTypeSupport for example).
 
-        serializer.append_code( "{} = (\"{}\", id({}))".format( key_var, cache_base_name, source_instance_name))
+        serializer.append_code( "{} = cache.identity_key(\"{}\", {})".format( key_var, cache_base_name, source_instance_name))
 
 
     def cache_on_write(self, serializer : 'Serializer', source_type_support, source_instance_name, cache_base_name, dest_instance_name):
@@ -175,6 +283,29 @@ class TypeSupport:
     def gen_write_field(self, instance, field, value) -> str:
         raise NotImplementedError()
 
+    def gen_single_relation_copy(self, serializer : 'Serializer', source_instance_name : str, dest_instance_name : str,
+                                 relation_name : str, source_ts : 'TypeSupport', serializer_call_code):
+        """ Builds the code to copy a single item relation (ie a many-to-one
+        relation) of a source instance (described by @source_ts)
+        into the corresponding relation of a destination instance
+        (described by this TypeSupport).
+        """
+
+        # This is tricky. The first part of the if ensures
+        # there is a child to serializez. The presence of the
+        # child is reprsented by the existence of an object.
+
+        serializer.append_code( "if ({}):".format(
+            source_ts.gen_is_single_relation_present( source_instance_name, relation_name)))
+
+        serializer.indent_right()
+        serializer.append_code("{} = {}".format(
+            self.gen_read_field( dest_instance_name, relation_name),
+            serializer_call_code(
+                source_ts.gen_read_field( source_instance_name, relation_name),
+                None)))
+        serializer.indent_left()
+
     def gen_is_single_relation_present(self, instance, relation_name) -> str:
         """ Returns an expression that evaluate to True if a
         a single item relation (ie a one-to-one relation, for example
@@ -270,10 +401,19 @@ class TypeSupport:
 
 
 SKIP = "!skip"
+VIEWS = "!views"
 CLEAR_APPEND = "by append"
 REPLACE = "by index"
 FACTORY = "FACTORY"
 
+# The functions that can be generated along a serializer
+# (see SQLAWalker's companions)
+BATCH = "serialize_many"
+STREAM = "stream"
+LOADER_OPTIONS = "loader_options"
+PREFETCH = "prefetch"
+COMPANIONS = (BATCH, STREAM, LOADER_OPTIONS, PREFETCH)
+
 class Serializer(CodeWriter):
     """ Holds the code that will implement a serializer. The code kept by the
     serializer is a function that makes a @dest_type out of a @start_type.
@@ -290,7 +430,7 @@ class Serializer(CodeWriter):
     """
 
     def __init__(self, start_type : TypeSupport, base_type_name : str, dest_type : TypeSupport, serializer_name = None,
-                 additional_parameters = []) :
+                 additional_parameters = [], instrumentation : str = None, companions = ()) :
         """
         The method @call_code gives a code fragment to call this serializer (which is
         necessary to allow to call one serializer from another)
@@ -310,14 +450,38 @@ class Serializer(CodeWriter):
               not a good idea (imagine we have two simultaneous SQLA sessions)
               and I prefer functional style, even if it means pushing/popping
               parameters on the stack (which can have an impact on performance).
+        :param instrumentation: None, COUNTERS or TIMING (see pyxfer.instrumentation).
+        :param companions: the functions to generate along the serializer,
+              among COMPANIONS.
         """
         super().__init__()
 
+        assert instrumentation in (None, COUNTERS, TIMING), "Unknown instrumentation {}".format( instrumentation)
+        self.instrumentation = instrumentation
+
+        assert set( companions) <= set( COMPANIONS), "Unknown companions {}".format( set( companions) - set( COMPANIONS))
+        self.companions = frozenset( companions)
+
         self.source_type_support, self.base_type_name, self.destination_type_support = start_type, base_type_name, dest_type
         self._name = serializer_name
         self._additional_parameters = additional_parameters
         self._key = None
 
+        # Functions generated along the serializer (batch entry point, etc.)
+        self._companions = []
+
+        # What was walked to build this serializer. This is filled
+        # by the walker so that TypeSupports can generate companion
+        # functions that follow the same structure.
+        self.base_type = None
+        self.key_names = []
+        self.field_names = []
+        self.relations = dict() # relation name -> (relation serializer, is single item relation)
+
+        # True once the walker has written the whole body. Forward
+        # declared serializers (in cycles) and stubs are never walked.
+        self.walked = False
+
         # Generate what can be generated right now. The body of the serializer
         # will be generated elsewhere.
 
@@ -337,11 +501,59 @@ class Serializer(CodeWriter):
             self.source_type_support.type_name(),
             self.destination_type_support.type_name())
 
+        if self.is_asynchronous():
+            n += "_async"
+
         if self._name:
             n += "_" + self._name
 
         return n
 
+    def is_asynchronous(self) -> bool:
+        """ An asynchronous serializer is a coroutine function, so
+        it must be awaited, and so must be its batch and stream
+        companions.
+        """
+
+        return self.source_type_support.is_asynchronous() or \
+            self.destination_type_support.is_asynchronous()
+
+    def _def(self):
+        return "async def" if self.is_asynchronous() else "def"
+
+    def _await(self):
+        return "await " if self.is_asynchronous() else ""
+
+    def companion_func_name(self, prefix : str):
+        """ Builds the name of a function generated along this
+        serializer, for example prefetch_Order_dict_to_Order.
+        """
+
+        return prefix + self.func_name()[ len("serialize"):]
+
+    def batch_func_name(self):
+        """ Builds the name of the function that will serialize
+        several sources in one call.
+        """
+
+        return self.companion_func_name( "serialize_many")
+
+    def _additional_parameters_names(self):
+        return [ p.split(':')[0].strip() for p in self._additional_parameters]
+
+    def stub(self):
+        """ A serializer with the same name, types and parameters as
+        this one, but without code nor companions. Once the code of
+        this one is compiled, that's all the serializers calling it
+        need (see pyxfer.lazy).
+        """
+
+        stub = Serializer( self.source_type_support, self.base_type_name, self.destination_type_support,
+                           self._name, self._additional_parameters, self.instrumentation)
+        stub._code = []
+        stub.base_type = self.base_type
+        return stub
+
     def call_code(self, additional_parameters = []):
         """ Builds the code fragment that will call the serializer.
         It's used when we navigate recursively in the serialized
@@ -350,9 +562,9 @@ class Serializer(CodeWriter):
 
         if not additional_parameters:
             # func_name ( source_inst, dest_inst )
-            return "{}({{}}, {{}}, cache)".format( self.func_name()).format
+            return "{}{}({{}}, {{}}, cache)".format( self._await(), self.func_name()).format
         else:
-            return "{}({{}}, {{}}, {}, cache)".format(self.func_name(), ",".join( [ p.split(':')[0] for p in additional_parameters])).format
+            return "{}{}({{}}, {{}}, {}, cache)".format( self._await(), self.func_name(), ",".join( [ p.split(':')[0] for p in additional_parameters])).format
 
     def _proto_serializer(self):
 
@@ -361,10 +573,11 @@ class Serializer(CodeWriter):
         else:
             addp = ""
 
-        self.append_code("def {}( source : {}, destination : {}, {} cache = dict()):".format(
+        self.append_code("{} {}( source : {}, destination : {}, {} cache : SerializationContext = None):".format(
+            self._def(),
             self.func_name(),
-            self.source_type_support.type_name(),
-            self.destination_type_support.type_name(),
+            self.source_type_support.type_annotation(),
+            self.destination_type_support.type_annotation(),
             addp))
 
         self.indent_right()
@@ -372,9 +585,164 @@ class Serializer(CodeWriter):
         self.indent_right()
         self.append_code("return None")
         self.indent_left()
+        self.append_code("if cache is None:")
+        self.indent_right()
+        self.append_code("cache = SerializationContext.for_call()")
+        self.indent_left()
         # self.append_code("is_new_instance = dest == None")
+        self.count( "calls")
+        if self.instrumentation == TIMING:
+            # The body goes in the try (see end_body)
+            self.append_code("_t0 = perf_counter_ns()")
+            self.append_code("try:")
+        else:
+            self.indent_left()
+
+    def stats_var_name(self):
+        return self.companion_func_name( "_stats")
+
+    def count(self, counter : str):
+        """ Generates the code incrementing @counter in the
+        statistics of this serializer, if it is instrumented.
+        """
+
+        if self.instrumentation:
+            self.append_code("{}.{} += 1".format( self.stats_var_name(), counter))
+
+    def end_body(self):
+        """ To be called once the body of the serializer is complete.
+        """
+
+        if self.instrumentation == TIMING:
+            self.indent_left()
+            self.append_code("finally:")
+            self.append_code("    {}.time_ns += perf_counter_ns() - _t0".format( self.stats_var_name()))
         self.indent_left()
 
+    def gen_stats_declaration(self) -> CodeWriter:
+        if not self.instrumentation:
+            return None
+
+        cw = CodeWriter()
+        cw.append_code("{} = _pyxfer_stats.get( '{}')".format( self.stats_var_name(), self.func_name()))
+        return cw
+
+    def add_companion(self, code : CodeWriter):
+        """ Adds the code of a function that goes along this serializer
+        (so it'll be generated with it).
+        """
+
+        if code is not None:
+            self._companions.append( code)
+
+    def gen_batch_serializer(self) -> CodeWriter:
+        """ Builds a function that serializes an iterable of sources
+        and returns the list of results.
+
+        All the sources share the same context, so instances
+        referenced by several of them are serialized only once.
+        The lookups that don't change across the loop are done
+        once, before it.
+        """
+
+        # The batch serializers of the TypeSupports are synchronous.
+        if not self.is_asynchronous():
+            code = self.destination_type_support.gen_batch_serializer( self)
+            if code is not None:
+                return code
+
+        addp = "".join( [ p + ", " for p in self._additional_parameters])
+        addn = "".join( [ p + ", " for p in self._additional_parameters_names()])
+
+        cw = CodeWriter()
+        cw.append_code("{} {}( sources, {}cache : SerializationContext = None):".format(
+            self._def(), self.batch_func_name(), addp))
+        cw.indent_right()
+        cw.append_code("if cache is None:")
+        cw.append_code("    cache = SerializationContext.for_call()")
+        self.destination_type_support.gen_batch_prologue( self, cw, "sources")
+        cw.append_code("serializer = {}".format( self.func_name()))
+        if self.is_asynchronous():
+            cw.append_code("return [ await serializer( source, None, {}cache) async for source in _aiterate( sources) ]".format( addn))
+        else:
+            cw.append_code("return [ serializer( source, None, {}cache) for source in sources ]".format( addn))
+        cw.indent_left()
+        return cw
+
+    def stream_func_name(self):
+        return self.companion_func_name( "stream")
+
+    def gen_stream_serializer(self) -> CodeWriter:
+        """ Builds the streaming serializer (see gen_default_stream_serializer),
+        unless the destination TypeSupport has its own idea about it.
+        """
+
+        code = None
+        if not self.is_asynchronous():
+            code = self.destination_type_support.gen_stream_serializer( self)
+
+        if code is not None:
+            return code
+        else:
+            return self.gen_default_stream_serializer()
+
+    def gen_default_stream_serializer(self, result_expression = "{}") -> CodeWriter:
+        """ Builds a generator function that serializes the items of
+        an iterable of sources (for example a query.yield_per(1000)),
+        one at a time, yielding the results.
+
+        Memory doesn't grow with the number of sources :
+        - the context remembers the last @window serializations only
+          (so the deduplication of shared instances is done over
+          a sliding window). It's trimmed between the sources only :
+          while a source is serialized, its entries must stay to
+          break the reference cycles (see SerializationContext.pinned),
+        - every @window sources, the processed ones are given
+          to @release, which can free them (see sqla_runtime.expunger).
+
+        :param result_expression: a format to make the yielded
+          value out of the result of the serializer.
+        """
+
+        addp = "".join( [ p + ", " for p in self._additional_parameters])
+        addn = "".join( [ p + ", " for p in self._additional_parameters_names()])
+
+        cw = CodeWriter()
+        cw.append_code("{} {}( sources, {}cache : SerializationContext = None, window : int = 1000, release = None):".format(
+            self._def(), self.stream_func_name(), addp))
+        cw.indent_right()
+        cw.append_code("if cache is None:")
+        cw.append_code("    cache = SerializationContext( max_size = window)")
+        cw.append_code("serializer = {}".format( self.func_name()))
+        cw.append_code("processed = []")
+        if self.is_asynchronous():
+            # The sources may come from an AsyncSession.stream
+            cw.append_code("async for source in _aiterate( sources):")
+        else:
+            cw.append_code("for source in sources:")
+        cw.indent_right()
+        cw.append_code("with cache.pinned():")
+        cw.append_code("    result = {}serializer( source, None, {}cache)".format( self._await(), addn))
+        cw.append_code("yield {}".format( result_expression.format( "result")))
+        cw.append_code("if release is not None:")
+        cw.append_code("    processed.append( source)")
+        cw.append_code("    if len( processed) >= window:")
+        cw.append_code("        release( processed)")
+        cw.append_code("        processed = []")
+        cw.indent_left()
+        cw.append_code("if processed:")
+        cw.append_code("    release( processed)")
+        cw.indent_left()
+        return cw
+
+    def function_code(self) -> str:
+        """ The code of the serializer function, without its companions. """
+        return super().generated_code()
+
+    def generated_code(self):
+        return "\n\n".join( [ super().generated_code() ] +
+                             [ c.generated_code() for c in self._companions ])
+
     def instance_mgmt(self, knames, source_type_support, dest_type_support):
         # We serialize into a new object if no destination is passed.
         # That's practical : sometimes we don't want to explicitely
@@ -404,20 +772,17 @@ class AbstractTypeSupportFactory:
 
     def __init__(self, logger = default_logger):
         self._logger = default_logger
-        self._supported_types = []
-        self._types_support = []
+        self._types_support = dict() # base type -> type support
 
 
     def get_type_support(self, base_type):
-        if base_type not in self._supported_types:
+        t = self._types_support.get( base_type)
+        if t is None:
             # self._logger.debug("Factory creates a new type support for {}".format(base_type))
 
-            self._supported_types.append( base_type)
             t = self.make_type_support(base_type)
-            self._types_support.append( t)
-            return t
-        else:
-            return self._types_support[ self._supported_types.index( base_type)]
+            self._types_support[ base_type] = t
+        return t
 
     def make_type_support(self, base_type):
         raise NotImplementedError()
@@ -425,63 +790,125 @@ class AbstractTypeSupportFactory:
 
 class TypeSupportFactory(AbstractTypeSupportFactory):
 
-    def __init__( self, type_support_class : TypeSupport, logger = default_logger):
+    def __init__( self, type_support_class : TypeSupport, logger = default_logger, **options):
+        """ :param options: Passed to the constructor of the TypeSupport's
+        along the base type (e.g. slots=True for ObjectTypeSupport).
+        """
+
         assert type( type_support_class) == type
         super().__init__( logger)
         self._type_support_class = type_support_class
+        self._options = options
 
     def make_type_support(self, base_type):
         self._logger.debug("TypeSupportFactory : trying to make a '{}' with a '{}'".format(self._type_support_class, base_type))
-        return self._type_support_class( base_type)
+        return self._type_support_class( base_type, **self._options)
+
+
+
+class MapperInfo:
+    """ What the code generation needs to know about a mapped class.
+    Don't build it yourself, ask the schema_index.
+
+    :ivar ftypes: a dict from the names of the fields (column
+      properties) to the classes of their SQLA types, in the order
+      of the mapper's properties.
+    :ivar rnames: a dict from the names of the collection relations
+      to the mapped classes they refer to.
+    :ivar single_rnames: same as rnames, for the single relations
+      (many-to-one, one-to-one).
+    :ivar relations: rnames and single_rnames together.
+    :ivar knames: the names of the primary key columns, in the order
+      of the primary key.
+    :ivar fk_columns: a dict from the names of the relations to the
+      pairs (local attribute, remote attribute) of the columns that
+      join them.
+    """
 
+    def __init__( self, model):
+        mapper = inspect( model)
+        self.model = model
+
+        # Warning ! Some column properties are read only !
+        self.ftypes = dict( [ (prop.key, type( prop.columns[0].type))
+                              for prop in mapper.iterate_properties
+                              if isinstance(prop, ColumnProperty)])
+
+        self.rnames = dict()
+        self.single_rnames = dict()
+        self.fk_columns = dict()
+        for key, relation in mapper.relationships.items():
+
+            # From the relation, we retrieve the mapped class, that is
+            # the one written by the SQLA schema author (i.e. you :-))
+            mapped_class = relation.mapper.class_
+            if relation.uselist == False:
+                self.single_rnames[key] = mapped_class
+            else:
+                self.rnames[key] = mapped_class
 
+            self.fk_columns[key] = [ ( _column_attribute( mapper, local), _column_attribute( relation.mapper, remote))
+                                     for local, remote in relation.local_remote_pairs ]
+
+        self.relations = merge_dicts( self.rnames, self.single_rnames)
+
+        # Order is important to rebuild composite keys (I think, not tested so far).
+        # See SQLA comment for query.get operation :
+        # http://docs.sqlalchemy.org/en/rel_1_0/orm/query.html#sqlalchemy.orm.query.Query.get )
+        self.knames = [key.name for key in mapper.primary_key]
+        self.key_set = frozenset( self.knames)
+
+    def relation_target( self, relation_name : str):
+        """ The mapped class the relation @relation_name refers to. """
+        return self.relations[relation_name]
+
+
+def _column_attribute( mapper, column):
+    # The name of the attribute mapping @column, None if it's not
+    # mapped (e.g. the columns of a secondary table).
+    try:
+        return mapper.get_property_by_column( column).key
+    except Exception:
+        return None
+
+
+class SchemaIndex:
+    """ The MapperInfo of the mapped classes, built once per class.
+
+    Analysing a mapped class means going through all of its
+    SQLA properties. The walker, the factories, the type supports
+    all need that, for each serializer, in each direction. With
+    the index, that's done once.
+
+    The index doesn't keep the mapped classes alive. If you change
+    a mapping after having generated code for it, clear() the index.
+    """
+
+    def __init__( self):
+        self._infos = weakref.WeakKeyDictionary()
+
+    def info( self, model) -> MapperInfo:
+        info = self._infos.get( model)
+        if info is None:
+            info = MapperInfo( model)
+            self._infos[model] = info
+        return info
+
+    def clear( self):
+        self._infos.clear()
 
-def sqla_attribute_analysis( model, logger = default_logger):
-    #default_logger.debug("Analysing model {}".format(model))
-
-
-    # print("-"*80)
-    # for prop in inspect(model).iterate_properties:
-    #     if isinstance(prop, ColumnProperty):
-    #         print( type(prop.columns[0].type))
-    #         print( type( inspect( getattr(model, prop.key))))
-
-    # Warning ! Some column properties are read only !
-    fnames = [prop.key for prop in inspect(model).iterate_properties
-              if isinstance(prop, ColumnProperty)]
-
-    ftypes = dict()
-    for fname in fnames:
-
-        t = inspect( getattr(model, fname)).type
-        # print( type( inspect( getattr(model, fname)).type))
-        ftypes[fname] = type(t)
-
-    #print(ftypes)
-    single_rnames = dict()
-    rnames = dict()
-    for key, relation in inspect(model).relationships.items():
-
-        # From the relation, we retrieve the mapped class, that is
-        # the one written by the SQLA schema author (i.e. you :-))
-        mapped_class = relation.mapper.class_
-        # print( "Mapper class = {}".format(mapped_class))
-        # print( relation.argument.class_)
-        if relation.uselist == False:
-            single_rnames[key] = mapped_class
-        else:
-            rnames[key] = mapped_class
 
-    # Order is important to rebuild composite keys (I think, not tested so far).
-    # See SQLA comment for query.get operation :
-    # http://docs.sqlalchemy.org/en/rel_1_0/orm/query.html#sqlalchemy.orm.query.Query.get )
-    knames = [key.name for key in inspect(model).primary_key]
+schema_index = SchemaIndex()
 
-    # logger.debug(
-    #     "For model {}, I have these attributes : primary keys={}, fields={}, realtionships={} (single: {})".format(
-    #         model, knames, fnames, rnames, single_rnames))
 
-    return ( ftypes, rnames, single_rnames, knames)
+def sqla_attribute_analysis( model, logger = default_logger):
+    """ The fields types, collection relations, single relations and
+    key names of @model (see MapperInfo). They're copies of what's in
+    the schema_index, so you can change them.
+    """
+
+    info = schema_index.info( model)
+    return ( dict( info.ftypes), dict( info.rnames), dict( info.single_rnames), list( info.knames))
 
 
 
@@ -507,10 +934,8 @@ def make_cache_key_expression( key_fields, cache_base_name, type_support : TypeS
 
 def extract_sqla_key( base_type, type_support : TypeSupport, instance_name):
 
-    mapper = inspect( base_type)
-    k_names = [k.name for k in mapper.primary_key]
     key_parts_extractors = []
-    for k_name in k_names:
+    for k_name in schema_index.info( base_type).knames:
         key_parts_extractors.append( type_support.gen_read_field( instance_name, k_name))
     return ", ".join( key_parts_extractors)
 
@@ -532,19 +957,74 @@ class SQLAWalker:
 
     """
 
-    def __init__(self, logger = default_logger):
+    def __init__(self, logger = default_logger, instrumentation : str = None, inline_threshold : int = 0,
+                 companions = ()):
+        """ :param instrumentation: None, COUNTERS or TIMING. See
+        pyxfer.instrumentation.
+        :param inline_threshold: the serializers of the single relations
+          whose function has at most that many lines are inlined in the
+          serializers following the relations, saving a call per
+          instance (see pyxfer.inline). 0 means no inlining. Only the
+          serializers of the relations walked before are inlined
+          (CodeGenQuick.make_serializers walks them first, except
+          in cycles).
+        :param companions: the functions to generate along each
+          serializer, among COMPANIONS : BATCH (serialize_many_*),
+          STREAM (stream_*), LOADER_OPTIONS (loader_options_*, when
+          reading SQLA entities) and PREFETCH (prefetch_*, when merging
+          dicts into SQLA entities, the batch serializers use it). None
+          by default : with hundreds of mappers, they're most of the
+          generated code. Sources referring to each other with short
+          forms (dicts) are not streamed, whatever @companions.
+        """
 
         self._logger = logger
+        self._instrumentation = instrumentation
+        self._inline_threshold = inline_threshold
+        self._companions = tuple( companions)
         self.serializers = {}
 
         # self._all_type_supports = set()
 
 
 
+    def _inline( self, serializer : Serializer, start : int, relation_serializer : Serializer, prefix : str) -> int:
+        """ Replaces the call to @relation_serializer, in the code of
+        @serializer written since the line @start, by the body of
+        @relation_serializer if it's small enough. Returns 1
+        if it was inlined, else 0.
+
+        A serializer which is not walked yet (a forward declaration,
+        in a cycle) has no body to inline, so it's called.
+        """
+
+        if not relation_serializer.walked:
+            return 0
+
+        function_code = relation_serializer.function_code()
+        if function_code.count( "\n") + 1 > self._inline_threshold:
+            return 0
+
+        call = relation_serializer.func_name() + "("
+        calls = [ i for i in range( start, len( serializer._code)) if call in serializer._code[i]]
+        if len( calls) != 1:
+            return 0
+
+        line = serializer._code[ calls[0]]
+        indentation = line[ 0 : len( line) - len( line.lstrip())]
+        lines = inline_call( line.strip(), function_code, relation_serializer.func_name(), prefix)
+
+        if lines is None:
+            self._logger.debug("Can't inline {} in {}".format( relation_serializer.func_name(), serializer.func_name()))
+            return 0
+
+        serializer._code[ calls[0]:calls[0]+1] = [ indentation + l for l in lines]
+        return 1
+
     def _field_copy( self, serializer : Serializer,
                      source_type_support : TypeSupport, source_instance : str,
                      dest_type_support : TypeSupport, dest_instance : str,
-                     fields_names):
+                     fields_names, guarded = False):
 
         for field in sorted( fields_names):
 
@@ -563,7 +1043,17 @@ class SQLAWalker:
                             field,
                             read_field_code( source_instance, field))))
 
-            serializer.append_code(field_transfer)
+            guards = []
+            if guarded:
+                guards = [ g for g in ( source_type_support.gen_read_guard( source_instance, field),
+                                        dest_type_support.gen_write_guard( source_type_support, source_instance, field))
+                           if g]
+
+            if guards:
+                serializer.append_code("if {}:".format( " and ".join( guards)))
+                serializer.append_code("    " + field_transfer)
+            else:
+                serializer.append_code(field_transfer)
 
     # def register_serializer(self, s : Serializer):
     #     serializer_id = (s.source_type_support, s.base_type_name, s.destination_type_support)
@@ -622,7 +1112,9 @@ class SQLAWalker:
                                 base_type.__name__,
                                 dest_type_support,
                                 serializer_name=serializer_name,
-                                additional_parameters=dest_type_support.serializer_additional_parameters())
+                                additional_parameters=dest_type_support.serializer_additional_parameters(),
+                                instrumentation=self._instrumentation,
+                                companions=self._companions)
 
         self._logger.debug("Registering serializer {} {}".format(source_type_support, serializer.func_name()))
 
@@ -631,7 +1123,10 @@ class SQLAWalker:
 
         self.serializers[ serializer.func_name() ] = serializer
 
-        fields, relations, single_rnames, knames = sqla_attribute_analysis(base_type)
+        info = schema_index.info( base_type)
+        fields, relations, single_rnames, knames = info.ftypes, info.rnames, info.single_rnames, info.knames
+        serializer.base_type = base_type
+        serializer.key_names = list(knames)
 
         # --- INSTANCE MANAGEMENT ---------------------------------------------
 
@@ -723,14 +1218,18 @@ class SQLAWalker:
         serializer.append_code("if (cache_key is not None) and (cache_key in cache):")
         serializer.indent_right()
         serializer.append_code(    "# We have already transformed 'source'")
-        serializer.append_code(    "return cache[cache_key]")
+        serializer.count( "cache_hits")
+        dest_type_support.gen_cache_hit( serializer, "cache_key")
         serializer.indent_left()
+        serializer.count( "cache_misses")
 
 
         # Create destination instance
         serializer.append_blank()
         serializer.append_code("# Check if new instance has to be created")
         serializer.instance_mgmt( knames, source_type_support, dest_type_support)
+        dest_type_support.start_instance_serializer( serializer, "dest")
+        source_type_support.start_source_serializer( serializer, "source")
 
         # --- FIELDS (key and non-key) ----------------------------------------
 
@@ -744,7 +1243,7 @@ class SQLAWalker:
         fields_to_skip = []
 
         for field in sorted(list(fields_names)):
-            if field in knames:
+            if field in info.key_set:
                 continue
             elif field in fields_control and fields_control[field] == SKIP:
                 serializer.append_code("# Skipped field {}".format(field))
@@ -761,9 +1260,11 @@ class SQLAWalker:
 
 
 
+        serializer.field_names = list(knames) + fields_to_copy
+
         serializer.append_blank()
         serializer.append_code("# Copy non-key fields")
-        self._field_copy( serializer, source_type_support, source_instance, dest_type_support, dest_instance, fields_to_copy)
+        self._field_copy( serializer, source_type_support, source_instance, dest_type_support, dest_instance, fields_to_copy, guarded=True)
 
 
 
@@ -804,6 +1305,7 @@ class SQLAWalker:
 
         # --- RELATIONS represented as single item ----------------------------
 
+        inlined = 0
         for relation_name in single_rnames:
 
             if relation_name not in fields_control:
@@ -818,30 +1320,18 @@ class SQLAWalker:
                 assert isinstance( relation_serializer, Serializer), "Expected a relation serializer, got '{}'".format(relation_serializer)
 
                 fk_name = next(iter(getattr( base_type, relation_name).property.local_columns)).name
-
-                # This is tricky. The first part of the if ensures
-                # there is a child to serializez. The presence of the
-                # child is reprsented by the existence of an object.
-
-                serializer.append_code( "if ({}):".format(
-                    source_type_support.gen_is_single_relation_present("source", relation_name)))
-
-                # serializer.append_code( "if ({} is not None) or ({} is None):".format(
-                #     source_type_support.gen_is_single_relation_present("source", relation_name),
-                #     dest_type_support.gen_read_field("dest", fk_name)))
-
-                serializer.indent_right()
+                serializer.relations[relation_name] = (relation_serializer, True)
 
                 serializer_code = relation_serializer.call_code(
                     relation_serializer.destination_type_support.serializer_additional_parameters())
 
-                serializer.append_code("{} = {}".format(
-                    dest_type_support.gen_read_field("dest", relation_name),
-                    serializer_code(
-                        source_type_support.gen_read_field("source", relation_name),
-                        None)))
+                start = len( serializer._code)
+                dest_type_support.gen_single_relation_copy(
+                    serializer, "source", "dest", relation_name,
+                    source_type_support, serializer_code)
 
-                serializer.indent_left()
+                if self._inline_threshold:
+                    inlined += self._inline( serializer, start, relation_serializer, "_i{}_".format( inlined + 1))
 
             else:
                 serializer.append_code("# Skipped single relation '{}'".format(relation_name))
@@ -896,6 +1386,7 @@ class SQLAWalker:
             self._logger.debug("rel_source_type_support={}".format( rel_source_type_support))
             assert isinstance(relation_serializer, Serializer), "I want a Serializer for the relation '{}' of type {}".format(relation_name, relation_serializer)
 
+            serializer.relations[relation_name] = (relation_serializer, False)
             serializer_code = relation_serializer.call_code( rel_destination_type_support.serializer_additional_parameters())
             #serializer.append_blank()
 
@@ -912,13 +1403,85 @@ class SQLAWalker:
 
         dest_type_support.finish_serializer( serializer)
 
+        serializer.count( "produced")
         serializer.append_code("return dest")
-        serializer.indent_left()
-
+        serializer.end_body()
+
+        serializer.add_companion( serializer.gen_stats_declaration())
+        if BATCH in serializer.companions:
+            serializer.add_companion( serializer.gen_batch_serializer())
+        if STREAM in serializer.companions:
+            if source_type_support.short_forms_need_context():
+                self._logger.debug("{} reads short forms, it can't be streamed".format( serializer.func_name()))
+            else:
+                serializer.add_companion( serializer.gen_stream_serializer())
+        for code in source_type_support.gen_source_companions( serializer) + \
+                    dest_type_support.gen_destination_companions( serializer):
+            serializer.add_companion( code)
 
+        serializer.walked = True
         return serializer
 
 
+def strongly_connected_components( graph : dict) -> list:
+    """ The strongly connected components of @graph, a dict from each
+    node to the list of the nodes it leads to. A node leads to the
+    nodes of its component and to the ones of the components listed
+    before it, never after (that's a topological order of
+    the components).
+
+    That's Tarjan's algorithm, without recursion (so that
+    long chains of nodes don't hit the recursion limit).
+    """
+
+    index = dict()
+    lowlink = dict()
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = len( index)
+        stack.append( root)
+        on_stack.add( root)
+        work = [ (root, iter( graph[root])) ]
+
+        while work:
+            node, successors = work[-1]
+
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len( index)
+                    stack.append( successor)
+                    on_stack.add( successor)
+                    work.append( (successor, iter( graph[successor])))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min( lowlink[node], index[successor])
+            else:
+                # All the successors of node are visited
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min( lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard( n)
+                        component.append( n)
+                        if n is node:
+                            break
+                    component.reverse()
+                    components.append( component)
+
+    return components
+
+
 class CodeGenQuick:
     def __init__(self, source_factory : TypeSupportFactory,
                  dest_factory : TypeSupportFactory,
@@ -939,84 +1502,180 @@ class CodeGenQuick:
         dest_type_support = self.dest_factory.get_type_support( base_type)
 
         s = self.walker.walk( source_type_support, base_type,
-                              dest_type_support, fields_control)
+                              dest_type_support, fields_control, serializer_name)
         return s
 
-    def make_serializers( self, models_fc):
+    def make_serializers( self, models_fc, known : dict = None):
+        """ Makes the serializers of the mapped classes in @models_fc,
+        a dict from mapped class to its fields control.
 
-        serializers = dict()
+        A fields control may declare views of the class under the
+        VIEWS key : a dict from view name to either a fields control
+        (which overrides the class' one) or the names of the fields
+        and relations to serialize (the others are skipped, but
+        the keys are always there). For example :
 
-        for base_type, fields_control in models_fc.items():
-            source_type_support = self.source_factory.get_type_support( base_type)
-            dest_type_support = self.dest_factory.get_type_support( base_type)
-            serializers[base_type] =  Serializer( source_type_support, base_type.__name__, dest_type_support)
+            { Order : { VIEWS : { 'summary' : ['cost'],
+                                  'no_parts' : { 'parts' : SKIP } } } }
+
+        Each view gets its own serializer, named after the class'
+        one (serialize_Order_Order_to_dict_summary) and the relations
+        are serialized with the serializers of their classes. The
+        views_* dict (views_Order_Order_to_dict) maps the view names
+        (and None, for the class' serializer) to the serializers.
 
-        do_now = dict(models_fc)
-        do_later = dict()
-        stop = False
+        :param known: serializers made before (a dict from mapped
+          class to serializer). The relations leading to their
+          classes use them, they're not made again.
+
+        Returns a dict from mapped class to serializer, and from
+        (mapped class, view name) to serializer for the views
+        (the @known ones are not in there).
+        """
 
-        while do_now or do_later:
+        known = known or dict()
+        serializers = dict( known)
+        views = dict()
+        fields_controls = dict()
 
-            dbg_missing_deps = []
-            serializers_made = False
-            for base_type, fields_control in do_now.items():
-                fc = dict(fields_control)
-                ftypes, rnames, single_rnames, knames = sqla_attribute_analysis( base_type)
+        for base_type, fields_control in models_fc.items():
+            if VIEWS in fields_control:
+                views[base_type] = fields_control[VIEWS]
+            fields_controls[base_type] = dict( [ (k, v) for k, v in fields_control.items() if k != VIEWS])
+
+        for component in self.plan( fields_controls, known):
+            if len( component) > 1 or component[0] in [ t for n, t in self._followed_relations( component[0], fields_controls[component[0]])]:
+                # The serializers of a cycle refer to each other. The
+                # ones which are not made yet are forward declared : the
+                # generated code only needs their names.
+                self._logger.debug("Cyclic relations between {}".format( ", ".join( [ t.__name__ for t in component])))
+                for base_type in component:
+                    serializers[base_type] = Serializer( self.source_factory.get_type_support( base_type),
+                                                         base_type.__name__,
+                                                         self.dest_factory.get_type_support( base_type))
+
+            for base_type in component:
+                fc = dict( fields_controls[base_type])
+                for relation_name, relation_target in self._followed_relations( base_type, fc):
+                    fc[relation_name] = serializers[relation_target]
+
+                serializers[base_type] = self.make_serializer( base_type, fc)
+
+        for base_type in views:
+            self._make_views( base_type, fields_controls[base_type], views[base_type], serializers)
+
+        return dict( [ (k, s) for k, s in serializers.items() if k not in known])
+
+    def _followed_relations( self, base_type, fields_control) -> list:
+        # The relations of @base_type which are not skipped, as
+        # (relation name, mapped class it leads to) pairs.
+        return [ (relation_name, relation_target) for relation_name, relation_target in schema_index.info( base_type).relations.items()
+                 if fields_control.get( relation_name) != SKIP ]
+
+    def plan( self, models_fc, known = ()) -> list:
+        """ The order in which the serializers of the mapped classes
+        of @models_fc must be made : a list of groups of mapped
+        classes, where a group only depends on the groups before it
+        (a serializer needs the serializers of the relations it
+        follows). The classes of a group depend on each other (their
+        relations make a cycle). This runs in a time proportional
+        to the number of classes and relations.
+
+        Fails if a relation which is not skipped leads to a mapped
+        class which is neither in @models_fc nor in @known (the
+        classes which already have a serializer).
+        """
 
+        dependencies = dict()
+        missing = []
+        for base_type, fields_control in models_fc.items():
+            followed = self._followed_relations( base_type, fields_control)
+            dependencies[base_type] = [ relation_target for relation_name, relation_target in followed
+                                        if relation_target in models_fc]
 
-                has_unsatisfied_deps = False
-                for relation_name in merge_dicts( rnames, single_rnames):
-                    if relation_name in fields_control and fields_control[relation_name] == SKIP:
-                        continue
+            for relation_name, relation_target in followed:
+                if relation_target not in models_fc and relation_target not in known:
+                    missing.append( "{}.{} of type {}".format( base_type.__name__, relation_name, relation_target.__name__))
 
-                    relation = getattr( base_type, relation_name)
-                    relation_target = inspect(relation).mapper.class_
-                    self._logger.debug("Relation {} of tpye {}".format( relation_name, relation_target))
-                    if relation_target not in serializers:
-                        dbg_missing_deps.append( "{}.{} of type {}".format( base_type.__name__, relation_name, relation_target.__name__))
-                        has_unsatisfied_deps = True
-                        # I could break, but I let it go so that
-                        # the missing deps array is completely built,
-                        # which in turn will improve error reporting.
-                    else:
-                        fc[relation_name] = serializers[relation_target]
+        if missing:
+            raise Exception("Don't know what to do with these fields : {}. Did you give all mappers ?".format( ", ".join( sorted( missing))))
 
+        return strongly_connected_components( dependencies)
 
-                if has_unsatisfied_deps:
-                    do_later[base_type] = fields_control
-                else:
-                    serializers[base_type] = self.make_serializer( base_type, fc)
-                    serializers_made = True
+    def _make_views( self, base_type, fields_control, views : dict, serializers : dict):
+        info = schema_index.info( base_type)
+        ftypes, relations = info.ftypes, info.relations
 
+        view_serializers = []
+        for view_name in sorted( views):
+            view = views[view_name]
+            fc = dict( fields_control)
 
-            if not serializers_made:
-                self._logger.debug( "serializers : {}".format(str( serializers)))
-                self._logger.debug( "to do next  : {}".format( str( do_later)))
-                self._logger.debug( "missing deps: {}".format( dbg_missing_deps))
-                raise Exception("Don't know what to do with these fields : {}. Did you give all mappers ?".format( ", ".join( sorted( dbg_missing_deps))))
+            if isinstance( view, dict):
+                fc.update( view)
+            else:
+                unknown = set( view) - set( ftypes) - set( relations)
+                if unknown:
+                    raise Exception("The view {} of {} refers to unknown fields or relations : {}".format(
+                        view_name, base_type.__name__, ", ".join( sorted( unknown))))
+
+                for name in list( ftypes) + list( relations):
+                    if name not in view and name not in info.key_set:
+                        fc[name] = SKIP
+
+            for relation_name in relations:
+                if fc.get( relation_name) != SKIP:
+                    relation_target = info.relation_target( relation_name)
+                    if relation_target not in serializers:
+                        raise Exception("The view {} of {} needs a serializer for {}.{}. Did you give all mappers ?".format(
+                            view_name, base_type.__name__, base_type.__name__, relation_name))
+                    fc[relation_name] = serializers[relation_target]
 
-            stop = len(do_later) == 0
-            do_now = do_later
-            do_later = dict()
+            s = self.make_serializer( base_type, fc, serializer_name=view_name)
+            serializers[ (base_type, view_name)] = s
+            view_serializers.append( s)
 
-        return serializers
+        # The dispatch table goes along the last serializer of the
+        # generated code, where all of them are defined.
+        default = serializers[base_type]
+        cw = CodeWriter()
+        cw.append_code("{} = {{".format( default.companion_func_name( "views")))
+        cw.append_code("    None : {},".format( default.func_name()))
+        for view_name, s in zip( sorted( views), view_serializers):
+            cw.append_code("    '{}' : {},".format( view_name, s.func_name()))
+        cw.append_code("}")
+        max( [ default] + view_serializers, key=lambda s:s.func_name()).add_companion( cw)
 
 
 
-def generated_code( serializers) -> str:
+def generated_code( serializers, timestamp : bool = False) -> str:
     """ Generate the code hold in the serializers.
     Call this once you've got all your serializer ready.
 
     We generate code in a smart way (avoid code duplication etc.)
+
+    The output is deterministic : the same serializers always give
+    the same code (that's what makes it cacheable, see code_cache).
+    Set @timestamp if you want the generation date in the header
+    anyway.
     """
 
     # Avoid code duplication
     type_supports = set(  [ s.source_type_support      for s in serializers])
     type_supports.update( [ s.destination_type_support for s in serializers] )
 
-    scode = [ "# Generated by Montgomery on {}".format( datetime.now()) ]
+    if timestamp:
+        scode = [ "# Generated by Montgomery on {}".format( datetime.now()) ]
+    else:
+        scode = [ "# Generated by Montgomery" ]
+
+    scode.append("from pyxfer.context import SerializationContext")
 
-    scode.append("cache = dict()")
+    instrumentations = set( [ s.instrumentation for s in serializers])
+    if instrumentations != set( [None]):
+        scode.append("from pyxfer.instrumentation import registry as _pyxfer_stats")
+    if TIMING in instrumentations:
+        scode.append("from time import perf_counter_ns")
 
     global_code_fragments = [ set() ]
 
@@ -1039,7 +1698,8 @@ def generated_code( serializers) -> str:
             global_code_fragments[0].add( fragments.generated_code())
 
     for level in global_code_fragments:
-        for frag in level:
+        # Sets don't iterate in a stable order (hash randomization)
+        for frag in sorted( level):
             if frag: # clean empty fragments (should be useless, but I'm not alawys clean :-))
                 scode.append(frag)
 
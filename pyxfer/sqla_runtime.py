@@ -0,0 +1,374 @@
+""" SQLAlchemy helpers called by the generated serializers.
+
+These are too big to be generated inline (like _sqla_session_add)
+and they don't depend on the walked types, so they're plain
+functions, imported by the generated code.
+"""
+
+from sqlalchemy import tuple_
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import with_parent, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+try:
+    from sqlalchemy.util import greenlet_spawn
+except ImportError:
+    # SQLAlchemy < 1.4, no asyncio
+    greenlet_spawn = None
+
+from pyxfer.context import SerializationContext
+from pyxfer.pyxfer import schema_index
+
+
+def _chunks( items, size):
+    for i in range( 0, len(items), size):
+        yield items[i:i+size]
+
+
+def _key_criterion( mapper, keys):
+    key_columns = mapper.primary_key
+    if len( key_columns) == 1:
+        return key_columns[0].in_( [ k[0] for k in keys])
+    else:
+        return tuple_( *key_columns).in_( keys)
+
+
+def load( session, model, keys, options = (), chunk_size : int = 500) -> list:
+    """ Loads the instances of @model denoted by the key tuples @keys
+    (one query per @chunk_size keys). The instances are returned
+    in the order of the keys, None for the keys that don't exist.
+
+    :param options: query options, like the ones given by
+      the loader_options_* functions.
+    """
+
+    mapper = inspect( model)
+    found = dict()
+
+    for chunk in _chunks( list( keys), chunk_size):
+        for instance in session.query( model).options( *options).filter( _key_criterion( mapper, chunk)):
+            found[ mapper.identity_key_from_instance( instance)[1]] = instance
+
+    return [ found.get( k) for k in keys]
+
+
+def prefetch( session, keys, context : SerializationContext, chunk_size : int = 500, collections : dict = None):
+    """ Loads all the instances denoted by @keys, with one query per
+    mapped class (well, one per @chunk_size keys), and records them
+    in @context.prefetched.
+
+    :param keys: A map from mapped class to a set of key tuples. The
+      values in the tuples are in the order of the mapper's primary key.
+      Tuples with None values (new instances) are ignored.
+    :param collections: A map from mapped class to the names of the
+      collections to load along the instances (with one more query
+      per collection, see selectinload). The merge goes through these
+      collections, else it would load them one instance at a time.
+
+    Note that the context holds the loaded instances so that they
+    stay in the session's identity map (which is weak referencing).
+    """
+
+    for model, model_keys in keys.items():
+        prefetched = context.prefetched.setdefault( model, dict())
+        todo = sorted( [ k for k in model_keys if (k not in prefetched) and (None not in k)])
+        if not todo:
+            continue
+
+        mapper = inspect( model)
+        options = [ selectinload( getattr( model, name)) for name in sorted( (collections or dict()).get( model, ()))]
+
+        for chunk in _chunks( todo, chunk_size):
+            # Not found unless proven otherwise
+            for k in chunk:
+                prefetched[k] = None
+
+            for instance in session.query( model).options( *options).filter( _key_criterion( mapper, chunk)):
+                prefetched[ mapper.identity_key_from_instance( instance)[1]] = instance
+
+
+def merge( session, instance, model, key : tuple, context : SerializationContext, preserve_identity : bool = False):
+    """ Merges @instance into @session, like session.merge does but
+    taking advantage of what was prefetched in the @context (see prefetch).
+
+    If the instance was prefetched, then session.merge will find
+    it in the identity map (no query). If it was looked for but not
+    found, then it's a new one, so we add it to the session (again,
+    no query). Else, we let session.merge do its job : an instance
+    without a key is merged as a copy (which is returned) and
+    the session autoflushes first.
+
+    :param preserve_identity: An instance which is already in the
+      session is returned as is and one without a key is added to the
+      session and returned : it's the very @instance, not a copy, and
+      nothing is flushed. When merging large collections, flushing
+      once per member makes the merge quadratic. That's what the
+      MERGE_REPLACE and MERGE_KEYS strategies of SQLATypeSupport do.
+    """
+
+    merged = _merge_new( session, instance, model, key, context, preserve_identity)
+    if merged is None:
+        merged = session.merge( instance)
+    return merged
+
+
+def _merge_new( session, instance, model, key : tuple, context : SerializationContext, preserve_identity : bool):
+    # Adds @instance if the prefetch tells it's a new one (or if it
+    # has no key, when preserving the identity). Returns it as is
+    # if it's already in the session (idem).
+
+    if preserve_identity:
+        if instance in session:
+            return instance
+
+        if None in key:
+            session.add( instance)
+            return instance
+
+    prefetched = context.prefetched.get( model)
+
+    if prefetched is not None and key in prefetched:
+        if prefetched[key] is None:
+            session.add( instance)
+            prefetched[key] = instance
+            return instance
+
+    return None
+
+
+def existing( session, model, key : tuple, context : SerializationContext):
+    """ The instance of @model with the primary @key if it was
+    prefetched in the @context or if it's in the @session's identity
+    map, else None. The database is not queried.
+    """
+
+    if None in key:
+        return None
+
+    prefetched = context.prefetched.get( model)
+    if prefetched is not None and key in prefetched:
+        return prefetched[key]
+
+    return session.identity_map.get( inspect( model).identity_key_from_primary_key( key))
+
+
+def delete_keys( session, model, keys, chunk_size : int = 500):
+    """ Deletes the instances of @model denoted by the key tuples @keys
+    with bulk DELETE statements (one per @chunk_size keys). That
+    bypasses the ORM : no cascades, no events. The deleted instances
+    which are in the session are expunged from it.
+    """
+
+    mapper = inspect( model)
+    keys = list( keys)
+
+    for k in keys:
+        instance = session.identity_map.get( mapper.identity_key_from_primary_key( k))
+        if instance is not None:
+            session.expunge( instance)
+
+    for chunk in _chunks( keys, chunk_size):
+        session.query( model).filter( _key_criterion( mapper, chunk)).delete( synchronize_session=False)
+
+
+def collection_members( session, parent, name : str, keys : list, remove_missing : bool = True) -> dict:
+    """ Prepares the merge of the collection @name of @parent with
+    members whose key tuples are @keys. Returns the members of the
+    collection which have one of those keys (a dict from key to
+    instance). If @remove_missing, the other members are deleted.
+
+    If the collection is not loaded (and @parent is not new), it stays
+    so : the keys of its members are queried, the members
+    to return are loaded (see load) and the others are deleted
+    in bulk (see delete_keys). Else, the work is done in memory and
+    the collection is replaced at once by the remaining members.
+    """
+
+    state = inspect( parent)
+    relationship = state.mapper.relationships[name]
+    mapper = relationship.mapper
+    wanted = set( [ k for k in keys if None not in k])
+
+    if state.has_identity and name in state.unloaded:
+        criterion = with_parent( parent, getattr( state.class_, name))
+        stored = set( [ tuple( row) for row in session.query( *mapper.primary_key).filter( criterion)])
+
+        if remove_missing:
+            delete_keys( session, mapper.class_, [ k for k in stored if k not in wanted])
+
+        present = [ k for k in wanted if k in stored]
+        return dict( zip( present, load( session, mapper.class_, present)))
+
+    members = dict()
+    kept = []
+    removed = []
+    for member in getattr( parent, name):
+        key = mapper.identity_key_from_instance( member)[1]
+        if key in wanted:
+            members[key] = member
+
+        if key in wanted or None in key or not remove_missing:
+            kept.append( member)
+        else:
+            removed.append( member)
+
+    if removed:
+        replace_members( session, parent, name, kept, removed)
+    return members
+
+
+def replace_members( session, parent, name : str, members, removed = ()):
+    """ Replaces the content of the collection @name of @parent by
+    @members and deletes the @removed members.
+
+    Assigning the collection would fire an event per removed member
+    and, if the relation has a backref, SQLA handles each of them in
+    a time proportional to the size of the collection. So, if the
+    collection wasn't changed since it was loaded, we set the members
+    which were already in it as its loaded content (no events) and
+    append the new ones.
+    """
+
+    state = inspect( parent)
+    attribute = state.attrs[name]
+
+    if removed and name not in state.unloaded and not attribute.history.has_changes():
+        previous = set( [ id( m) for m in attribute.loaded_value])
+        set_committed_value( parent, name, [ m for m in members if id( m) in previous])
+
+        collection = getattr( parent, name)
+        for member in members:
+            if id( member) not in previous:
+                if isinstance( collection, set):
+                    collection.add( member)
+                else:
+                    collection.append( member)
+    else:
+        setattr( parent, name, ( state.mapper.relationships[name].collection_class or list)( members))
+
+    for member in removed:
+        session.delete( member)
+
+
+def attach( parent, name : str, member):
+    """ Adds @member to the collection @name of @parent. If the collection
+    is not loaded, it's not loaded : the foreign key of @member is set
+    instead (that's for one-to-many relations only).
+    """
+
+    state = inspect( parent)
+
+    if state.has_identity and name in state.unloaded and state.mapper.relationships[name].secondary is None:
+        for local, remote in schema_index.info( state.class_).fk_columns[name]:
+            setattr( member, remote, getattr( parent, local))
+    else:
+        collection = getattr( parent, name)
+        if isinstance( collection, set):
+            collection.add( member)
+        else:
+            collection.append( member)
+
+
+async def merge_async( session, instance, model, key : tuple, context : SerializationContext, preserve_identity : bool = False):
+    """ merge, for an AsyncSession. """
+
+    merged = _merge_new( session, instance, model, key, context, preserve_identity)
+    if merged is None:
+        merged = await session.merge( instance)
+    return merged
+
+
+async def read_attribute( instance, name : str):
+    """ Reads the attribute @name of @instance, loading it if needed.
+    Under asyncio, SQLA refuses to lazy load an attribute on
+    a plain attribute access, so the load is run like AsyncAttrs'
+    awaitable_attrs does (and that doesn't require the mapped
+    classes to use AsyncAttrs).
+    """
+
+    if name in inspect( instance).unloaded:
+        return await greenlet_spawn( getattr, instance, name)
+    else:
+        return getattr( instance, name)
+
+
+async def aiterate( sources):
+    """ Iterates asynchronously over @sources, be it an asynchronous
+    iterable (like the result of AsyncSession.stream) or a regular one.
+    """
+
+    if hasattr( sources, '__aiter__'):
+        async for source in sources:
+            yield source
+    else:
+        for source in sources:
+            yield source
+
+
+def changed_attributes( instance) -> set:
+    """ The names of the attributes of @instance which were modified
+    since it was loaded (or last flushed). For a new instance, that's
+    all the attributes which were set.
+
+    This looks at the attributes' history, which the session resets
+    when it flushes. So an (auto)flush makes the instance look
+    unchanged. Nothing is loaded from the database.
+    """
+
+    return set( [ a.key for a in inspect( instance).attrs if a.history.has_changes()])
+
+
+def has_changes( instance) -> bool:
+    """ True if @instance is new or if one of its attributes was
+    modified (see changed_attributes). Changes to the instances
+    it refers to don't count.
+    """
+
+    if instance is None:
+        return False
+
+    state = inspect( instance)
+    if state.transient or state.pending:
+        return True
+    return any( a.history.has_changes() for a in state.attrs)
+
+
+def relation_has_changes( instance, name : str) -> bool:
+    """ True if the instance the single relation @name of @instance
+    refers to has changes (see has_changes). If the relation is not
+    loaded, it can't have changed, so it's not loaded.
+    """
+
+    # The unloaded attributes are not in the state's dict
+    return has_changes( inspect( instance).dict.get( name))
+
+
+def changed_members( instance, name : str) -> list:
+    """ The members of the collection @name of @instance which were
+    added to it or which were modified (see has_changes). The members
+    removed from the collection are not reported. If the collection
+    is not loaded, it can't have changed, so it's not loaded.
+    """
+
+    history = inspect( instance).attrs[name].history
+    return list( history.added or ()) + [ m for m in history.unchanged or () if has_changes( m)]
+
+
+def expunger( session):
+    """ Builds a function which expunges the instances it's given
+    from @session. Use it as the "release" parameter of the
+    stream_* serializers so that the session doesn't
+    accumulate the instances already serialized.
+
+    Only the given instances are expunged (plus what their
+    relations' cascades say). The instances they reference
+    are released by the session's weak referencing identity map
+    as soon as nobody uses them (unless they were modified).
+    """
+
+    def release( instances):
+        for instance in instances:
+            if instance in session:
+                session.expunge( instance)
+
+    return release
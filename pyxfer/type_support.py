@@ -1,13 +1,19 @@
 import inspect as pyinspect
 
 from sqlalchemy import Integer, String
-from sqlalchemy.inspection import inspect
 
-from pyxfer.pyxfer  import default_logger, TypeSupport, Serializer, CodeWriter, sqla_attribute_analysis
+from pyxfer.pyxfer  import default_logger, TypeSupport, Serializer, CodeWriter, sqla_attribute_analysis, schema_index, \
+    BATCH, LOADER_OPTIONS, PREFETCH
 
 
 
 
+# Strategies to merge a collection (see SQLATypeSupport)
+MERGE_APPEND = "append"
+MERGE_REPLACE = "replace"
+MERGE_KEYS = "keys"
+
+
 def gen_merge_relation_sqla(serializer : Serializer,
                             relation_source_expr : str,
                             relation_dest_expr : str,
@@ -15,7 +21,11 @@ def gen_merge_relation_sqla(serializer : Serializer,
                             rel_dest_type_support : TypeSupport,
                             serializer_call_code,
                             walk_type,
-                            collection_class=list):
+                            collection_class=list,
+                            remove_missing : bool = True,
+                            strategy : str = MERGE_APPEND,
+                            dest_instance_name : str = None,
+                            relation_name : str = None):
 
     """ Generates the code that will read a given relation in a source
     object (@source_ts) and merge its content into a corresponding relation in a
@@ -23,25 +33,30 @@ def gen_merge_relation_sqla(serializer : Serializer,
 
     The objects in the source relation are described by @rel_source_type_support.
     The objects in the destination relation are described by @rel_dest_type_support.
+
+    If @remove_missing, the objects of the destination relation which
+    are not in the source relation are removed from it.
+
+    @strategy tells how to merge (see SQLATypeSupport). MERGE_REPLACE
+    and MERGE_KEYS need the @dest_instance_name and the @relation_name.
     """
 
     assert isinstance(rel_source_type_support, TypeSupport)
     assert isinstance(rel_dest_type_support, SQLATypeSupport), "This merge operation will merge *to* some SQLA relations *only*"
+    assert strategy in (MERGE_APPEND, MERGE_REPLACE, MERGE_KEYS), "Unknown merge strategy {}".format( strategy)
+    assert strategy == MERGE_APPEND or (dest_instance_name and relation_name), "The {} merge strategy needs to know the relation".format( strategy)
 
     # To accomplish the merge operation, we will analyse the key-tuples
     # of each object in the source and destination relation.
     # The question is : how do we determine the key tuples. Shall
     # we look into the @rel_source_type_support or @rel_dest_type_support ?
 
-    ftypes, rnames, single_rnames, knames = sqla_attribute_analysis( walk_type)
 
     # if relation_name not in rnames:
     #     mainlog.error("While generating code to merge from '{}.{}' to '{}.{}'".format(source_instance_name, relation_name, dest_instance_name, relation_name ))
     #     raise Exception( "Missing '{}' in '{}' (available values are {}))".format( relation_name, rel_dest_type_support.type(),  ", ".join(rnames.keys())))
 
-    mapper = inspect( walk_type) # rel_dest_type_support.type()
-
-    k_names = [k.name for k in mapper.primary_key]
+    k_names = schema_index.info( walk_type).knames # rel_dest_type_support.type()
 
     key_parts_extractors = []
     source_key_parts_extractors = []
@@ -55,6 +70,12 @@ def gen_merge_relation_sqla(serializer : Serializer,
         key_parts_extractors.append(          rel_dest_type_support.gen_read_field("item", k_name))
         source_key_parts_extractors.append( rel_source_type_support.gen_read_field("item", k_name))
 
+    if strategy == MERGE_KEYS:
+        _gen_merge_relation_by_keys( serializer, relation_source_expr, source_key_parts_extractors,
+                                     rel_dest_type_support, serializer_call_code,
+                                     remove_missing, dest_instance_name, relation_name)
+        return
+
     # One cannot serialize before merging because if one does
     # so, then we may miss instance reuse in the destination
     # relation
@@ -73,6 +94,36 @@ def gen_merge_relation_sqla(serializer : Serializer,
     # We run through the source items. Each one is either
     # added or merged.
 
+    if strategy == MERGE_REPLACE:
+        # Build the new content of the relation, then replace the old
+        # one at once. SQLA works out the differences in one pass (where
+        # removing the items one by one from a list is quadratic).
+        serializer.append_code("members = []")
+        serializer.append_code("for item in {}:".format( relation_source_expr))
+        serializer.append_code("   key = {}   # from {}".format(",".join(source_key_parts_extractors), rel_source_type_support))
+        serializer.append_code("   if key in dest_inst_keys:")
+        serializer.append_code("       members.append( {})".format(serializer_call_code("item", "dest_inst_keys.pop(key)")))
+        serializer.append_code("   else:")
+        serializer.append_code("       s = {}".format(serializer_call_code("item", None)))
+        serializer.append_code("       session.add(s)")
+        serializer.append_code("       members.append(s)")
+
+        if remove_missing:
+            # Objects in dest but not in source are deleted (the session batches the DELETE's)
+            removed = "list( dest_inst_keys.values())"
+        else:
+            serializer.append_code("members.extend( dest_inst_keys.values())")
+            removed = "()"
+
+        if rel_dest_type_support.is_asynchronous():
+            serializer.append_code("await session.run_sync( _sqla_replace_members, {}, '{}', members, {})".format(
+                dest_instance_name, relation_name, removed))
+        else:
+            serializer.append_code("_sqla_replace_members( session, {}, '{}', members, {})".format(
+                dest_instance_name, relation_name, removed))
+        serializer.append_blank()
+        return
+
     serializer.append_code("for item in {}:".format( relation_source_expr))
     serializer.append_code("   key = {}   # from {}".format(",".join(source_key_parts_extractors), rel_source_type_support))
     serializer.append_code("   if key in dest_inst_keys:")
@@ -96,16 +147,111 @@ def gen_merge_relation_sqla(serializer : Serializer,
         raise Exception("Unrecognized collection type")
 
 
-    serializer.append_code("# Remove objects in dest but not in source (we assume they're deleted)")
-    serializer.append_code("for inst in dest_inst_keys.values():")
-    serializer.append_code("   {}.remove(inst)".format( relation_dest_expr))
+    if remove_missing:
+        serializer.append_code("# Remove objects in dest but not in source (we assume they're deleted)")
+        serializer.append_code("for inst in dest_inst_keys.values():")
+        serializer.append_code("   {}.remove(inst)".format( relation_dest_expr))
+    serializer.append_blank()
+
+
+def _gen_merge_relation_by_keys( serializer : Serializer,
+                                 relation_source_expr : str,
+                                 source_key_parts_extractors : list,
+                                 rel_dest_type_support : TypeSupport,
+                                 serializer_call_code,
+                                 remove_missing : bool,
+                                 dest_instance_name : str,
+                                 relation_name : str):
+
+    # The MERGE_KEYS strategy. The destination relation is not loaded,
+    # only the members the source refers to are (see
+    # sqla_runtime.collection_members).
+
+    if rel_dest_type_support.is_asynchronous():
+        members_call = "await session.run_sync( _sqla_collection_members, {}, '{}', [ ({},) for item in payload ], {})"
+    else:
+        members_call = "_sqla_collection_members( session, {}, '{}', [ ({},) for item in payload ], {})"
+
+    serializer.append_code("payload = list( {})".format( relation_source_expr))
+    serializer.append_code("members = " + members_call.format(
+        dest_instance_name, relation_name, ",".join( source_key_parts_extractors), remove_missing))
+    serializer.append_code("for item in payload:")
+    serializer.append_code("   key = ({},)".format(",".join(source_key_parts_extractors)))
+    serializer.append_code("   if key in members:")
+    serializer.append_code("       {}".format(serializer_call_code("item", "members[key]")))
+    serializer.append_code("   else:")
+    serializer.append_code("       s = {}".format(serializer_call_code("item", None)))
+    serializer.append_code("       session.add(s)")
+    serializer.append_code("       _sqla_attach( {}, '{}', s)".format( dest_instance_name, relation_name))
     serializer.append_blank()
 
 
+def gen_model_import( model) -> CodeWriter:
+    """ Generates the import of a mapped class in the generated code.
+    """
+
+    cw = CodeWriter()
+
+    m = pyinspect.getmodule( model)
+    if m and m.__spec__:
+        package = m.__spec__.name
+    else:
+        package = m.__file__.replace(".py","")
+        default_logger.warning("I can't find the package name, did you run a python file instead of a python moduyle (python -m ...)")
+
+    cw.append_code( "from {} import {}".format( package, model.__name__))
+    return cw
+
 
 class SQLATypeSupport(TypeSupport):
-    def __init__(self, sqla_model):
+    """ SQLA mapped instances.
+
+    :param asynchronous: Generate code for an AsyncSession. The
+      serializers are then coroutines (their names end with "_async") :
+      the merges are awaited and so are the reads of relations that
+      are not loaded yet (lazy loads are not allowed under asyncio).
+      Other attributes must be loaded (so expire_on_commit=False
+      is your friend).
+    :param compare_writes: When the instance to write is already in the
+      session (or was prefetched), write directly into it and assign
+      only the values that differ from the ones it has. So an unchanged
+      instance is not marked dirty and its attribute events are not
+      fired : re-importing unchanged data produces no UPDATE at all.
+      The same goes for the single relations.
+    :param collection_merge: How the collections of instances of
+      this type are merged :
+
+      * MERGE_APPEND : the collection is loaded, the new members are
+        appended and the missing ones removed one by one (so their
+        deletion is left to the relationship's cascades).
+      * MERGE_REPLACE : the collection is loaded and replaced at
+        once by its new content, the missing members are deleted.
+      * MERGE_KEYS : the collection is not loaded. Only the keys of its
+        members are queried, and only the members present in the source
+        are loaded. The missing ones are deleted in bulk (DELETE
+        statements, bypassing the ORM's cascades and events) and the
+        new ones are attached through their foreign keys. For very
+        large collections.
+
+      MERGE_APPEND merges the instances like session.merge does (a new
+      instance is merged as a copy, after an autoflush). MERGE_REPLACE
+      and MERGE_KEYS add the new instances themselves and don't
+      autoflush (see sqla_runtime.merge's preserve_identity). So, for
+      them, the time spent is linear in the size of the collection.
+    """
+
+    # When a relation is written, remove the instances which are
+    # not in the source relation.
+    REMOVE_MISSING_MEMBERS = True
+
+    def __init__(self, sqla_model, asynchronous : bool = False, compare_writes : bool = False,
+                 collection_merge : str = MERGE_APPEND):
+        assert collection_merge in (MERGE_APPEND, MERGE_REPLACE, MERGE_KEYS), "Unknown merge strategy {}".format( collection_merge)
+
         self._model = sqla_model
+        self._asynchronous = asynchronous
+        self._compare_writes = compare_writes
+        self._collection_merge = collection_merge
 
         self.fnames, self.rnames, self.single_rnames, self.knames = sqla_attribute_analysis( self._model)
 
@@ -126,31 +272,222 @@ class SQLATypeSupport(TypeSupport):
         pass
 
 
+    def start_instance_serializer(self, serializer, dest : str):
+        if not self._compare_writes:
+            return
+
+        source_ts = serializer.source_type_support
+        serializer.append_code( "# Write directly into the instance if the session already has it")
+        serializer.append_code( "fresh = {} is None".format( dest))
+        serializer.append_code( "if fresh:")
+        serializer.indent_right()
+        serializer.append_code( "{} = _sqla_existing( session, {}, ({},), cache)".format(
+            dest, self._model.__name__,
+            ",".join( [ source_ts.gen_read_field( "source", k) for k in self.knames])))
+        serializer.append_code( "fresh = {} is None".format( dest))
+        serializer.append_code( "if fresh:")
+        serializer.append_code( "    {} = {}()".format( dest, self._model.__name__))
+        serializer.indent_left()
+
     def check_instance_serializer(self, serializer, dest : str):
+        if self._compare_writes:
+            # The instance we wrote into is already in the session
+            serializer.append_code( "if fresh or {} not in session:".format( dest))
+            serializer.indent_right()
+            self._gen_merge( serializer, dest)
+            serializer.indent_left()
+        else:
+            self._gen_merge( serializer, dest)
+
+    def _gen_merge(self, serializer, dest : str):
         # check if key is not empty
         serializer.append_code( "# Merging into SQLA session. We do that after")
         serializer.append_code( "# having filled all the fields so that")
         serializer.append_code( "# SQLA will copy them efficiently")
-        serializer.append_code( "{} = session.merge({})".format( dest, dest))
+        serializer.append_code( "{} = {}( session, {}, {}, ({},), cache{})".format(
+            dest,
+            "await _sqla_merge_async" if self._asynchronous else "_sqla_merge",
+            dest, self._model.__name__,
+            ",".join( [ self.gen_read_field( dest, k) for k in self.knames]),
+            ", preserve_identity=True" if self._collection_merge in (MERGE_REPLACE, MERGE_KEYS) else ""))
+
+    def gen_source_companions(self, serializer) -> list:
+        if LOADER_OPTIONS in serializer.companions:
+            return [ self._gen_loader_options( serializer) ]
+        else:
+            return []
+
+    def _gen_loader_options(self, serializer) -> CodeWriter:
+        """ Generates a function that gives the query options to eager
+        load all the relations @serializer will follow. So
+        session.query(Order).options( *loader_options_Order_Order_to_dict())
+        loads exactly what the serializer will touch, in a few queries,
+        instead of one lazy load per relation and instance.
+
+        The relations are eager loaded by calling the loader options
+        functions of the relations' serializers. @_visited protects
+        us against cycles in the relations.
+
+        If the serializer skips some fields (like the views do), only
+        the ones it reads are loaded.
+        """
+
+        cw = CodeWriter()
+        cw.append_code("def {}( _visited = ()):".format(
+            serializer.companion_func_name( "loader_options")))
+        cw.indent_right()
+        cw.append_code("if '{}' in _visited:".format( serializer.func_name()))
+        cw.append_code("    return []")
+        cw.append_code("_visited = _visited + ('{}',)".format( serializer.func_name()))
+        cw.append_code("return [")
+        cw.indent_right()
+
+        if set( serializer.field_names) != set( self.fnames):
+            cw.append_code("load_only( {}),".format( ", ".join(
+                [ "{}.{}".format( self._model.__name__, f) for f in sorted( serializer.field_names)])))
+
+        for relation_name in sorted( serializer.relations):
+            relation_serializer, single = serializer.relations[relation_name]
+
+            if single:
+                loader = "joinedload"
+            else:
+                loader = "selectinload"
+
+            if isinstance( relation_serializer.source_type_support, SQLATypeSupport):
+                cw.append_code("{}( {}.{}).options( *{}( _visited)),".format(
+                    loader, self._model.__name__, relation_name,
+                    relation_serializer.companion_func_name( "loader_options")))
+            else:
+                cw.append_code("{}( {}.{}),".format( loader, self._model.__name__, relation_name))
+
+        cw.indent_left()
+        cw.append_code("]")
+        cw.indent_left()
+        return cw
+
+    def gen_destination_companions(self, serializer) -> list:
+        # The batch serializers prefetch
+        if isinstance( serializer.source_type_support, DictTypeSupport) and \
+           serializer.companions & { PREFETCH, BATCH }:
+            return [ self._gen_prefetch( serializer), self._gen_keys_collector( serializer) ]
+        else:
+            return []
+
+    def gen_batch_prologue(self, serializer, code : CodeWriter, sources_var : str):
+        if isinstance( serializer.source_type_support, DictTypeSupport):
+            code.append_code("# Load all the existing instances at once instead of one by one")
+            code.append_code("{} = list({})".format( sources_var, sources_var))
+            code.append_code("{}{}( {}, session, cache)".format(
+                "await " if self._asynchronous else "",
+                serializer.companion_func_name( "prefetch"), sources_var))
+
+    def _gen_prefetch(self, serializer) -> CodeWriter:
+        """ Generates a function that loads, ahead of deserialization,
+        all the instances whose keys appear in a list of dicts
+        (one query per mapped class instead of one per instance).
+        """
+
+        cw = CodeWriter()
+        cw.append_code("{} {}( sources, {}, cache : SerializationContext = None):".format(
+            "async def" if self._asynchronous else "def",
+            serializer.companion_func_name( "prefetch"),
+            self.serializer_additional_parameters()[0]))
+        cw.indent_right()
+        cw.append_code("if cache is None:")
+        cw.append_code("    cache = SerializationContext.for_call()")
+        cw.append_code("keys, collections = dict(), dict()")
+        cw.append_code("{}( sources, keys, collections)".format( serializer.companion_func_name( "_collect_keys")))
+        if self._asynchronous:
+            cw.append_code("await session.run_sync( _sqla_prefetch, keys, cache, collections=collections)")
+        else:
+            cw.append_code("_sqla_prefetch( session, keys, cache, collections=collections)")
+        cw.append_code("return cache")
+        cw.indent_left()
+        return cw
+
+    def _followed_by_keys_collector(self, serializer) -> list:
+        # The relations of @serializer merged from dicts into SQLA
+        # instances, as (relation name, relation serializer, single).
+
+        followed = []
+        for relation_name in sorted( serializer.relations):
+            relation_serializer, single = serializer.relations[relation_name]
+            if isinstance( relation_serializer.source_type_support, DictTypeSupport) and \
+               isinstance( relation_serializer.destination_type_support, SQLATypeSupport):
+                followed.append( (relation_name, relation_serializer, single))
+        return followed
+
+    def _gen_keys_collector(self, serializer) -> CodeWriter:
+        """ Generates a function that collects the keys of all the
+        instances represented in a list of dicts, following the same
+        relations as @serializer. It also tells which collections
+        the merge will go through (MERGE_KEYS doesn't load them).
+        """
+
+        source_ts = serializer.source_type_support
+        id_tag = getattr( source_ts, 'ID_TAG', None)
+        followed = self._followed_by_keys_collector( serializer)
+
+        cw = CodeWriter()
+        cw.append_code("def {}( sources, keys : dict, collections : dict):".format(
+            serializer.companion_func_name( "_collect_keys")))
+        cw.indent_right()
+        cw.append_code("collected = keys.setdefault( {}, set())".format( self._model.__name__))
+
+        loaded = [ relation_name for relation_name, relation_serializer, single in followed if not single]
+        if loaded and self._collection_merge != MERGE_KEYS:
+            cw.append_code("collections[{}] = ({},)".format(
+                self._model.__name__, ", ".join( [ "'{}'".format( name) for name in loaded])))
+        cw.append_code("for source in sources:")
+        cw.indent_right()
+
+        if id_tag:
+            cw.append_code("if not source or '{}' in source:".format( id_tag))
+        else:
+            cw.append_code("if not source:")
+        cw.append_code("    continue")
+
+        cw.append_code("collected.add( ({},))".format(
+            ",".join( [ "source.get('{}')".format(k) for k in self.knames])))
+
+        for relation_name, relation_serializer, single in followed:
+            collector = relation_serializer.companion_func_name( "_collect_keys")
+            if single:
+                cw.append_code("if source.get('{}'):".format( relation_name))
+                cw.append_code("    {}( (source['{}'],), keys, collections)".format( collector, relation_name))
+            else:
+                cw.append_code("{}( source.get('{}') or (), keys, collections)".format( collector, relation_name))
+
+        cw.indent_left()
+        cw.indent_left()
+        return cw
 
     def gen_global_code(self) -> CodeWriter:
         cw = CodeWriter()
         cw.append_code("from sqlalchemy.orm.session import Session")
+        cw.append_code("from sqlalchemy.orm import joinedload, selectinload, load_only")
+        cw.append_code("from pyxfer.sqla_runtime import merge as _sqla_merge, prefetch as _sqla_prefetch")
+        if self._compare_writes:
+            cw.append_code("from pyxfer.sqla_runtime import existing as _sqla_existing")
+        if self._collection_merge == MERGE_REPLACE:
+            cw.append_code("from pyxfer.sqla_runtime import replace_members as _sqla_replace_members")
+        elif self._collection_merge == MERGE_KEYS:
+            cw.append_code("from pyxfer.sqla_runtime import collection_members as _sqla_collection_members, attach as _sqla_attach")
         cw.append_code("def _sqla_session_add( session : Session, inst):")
         cw.append_code("    session.add( inst)")
         cw.append_code("    return inst")
 
-        cw2 = CodeWriter()
-
-        m = pyinspect.getmodule( self._model)
-        if m and m.__spec__:
-            package = m.__spec__.name
+        if self._asynchronous:
+            acw = CodeWriter()
+            acw.append_code("from sqlalchemy.ext.asyncio import AsyncSession")
+            acw.append_code("from pyxfer.sqla_runtime import merge_async as _sqla_merge_async, read_attribute as _sqla_read, aiterate as _aiterate")
+            return [cw, acw, gen_model_import( self._model)]
         else:
-            package = m.__file__.replace(".py","")
-            default_logger.warning("I can't find the package name, did you run a python file instead of a python moduyle (python -m ...)")
+            return [cw, gen_model_import( self._model)]
 
-        cw2.append_code( "from {} import {}".format( package, self._model.__name__))
-        return [cw, cw2]
+    def is_asynchronous(self) -> bool:
+        return self._asynchronous
 
     def type(self):
         return self._model
@@ -158,8 +495,14 @@ class SQLATypeSupport(TypeSupport):
     def type_name(self):
         return self._model.__name__
 
+    def type_annotation(self):
+        return self._model.__name__
+
     def make_instance_code(self, destination):
-        return "{}()".format( self.type_name())
+        if self._compare_writes:
+            # See start_instance_serializer
+            return None
+        return "{}()".format( self._model.__name__)
 
     def fields(self):
         return self._fields.keys()
@@ -174,7 +517,11 @@ class SQLATypeSupport(TypeSupport):
         return "{}.{}".format(repr, field_name)
 
     def gen_is_single_relation_present(self, instance, relation_name) -> str:
-        return "{}.{}".format( instance, relation_name)
+        if self._asynchronous:
+            # Loads the relation, so that it can be read afterwards.
+            return "await _sqla_read( {}, '{}')".format( instance, relation_name)
+        else:
+            return "{}.{}".format( instance, relation_name)
 
 
     # def relation_iterator_code(self, expression, relation_name):
@@ -185,11 +532,29 @@ class SQLATypeSupport(TypeSupport):
 
 
     def gen_write_field(self, instance, field, value):
+        if self._compare_writes:
+            return "if fresh or {}.{} != {}: {}.{} = {}".format( instance, field, value, instance, field, value)
         return "{}.{} = {}".format( instance, field, value)
 
     def gen_basetype_to_type_conversion(self, field, code):
         return "( {})".format(code)
 
+    def gen_single_relation_copy(self, serializer, source_instance_name, dest_instance_name,
+                                 relation_name, source_ts, serializer_call_code):
+        if not self._compare_writes:
+            return super().gen_single_relation_copy( serializer, source_instance_name, dest_instance_name,
+                                                     relation_name, source_ts, serializer_call_code)
+
+        serializer.append_code( "if ({}):".format(
+            source_ts.gen_is_single_relation_present( source_instance_name, relation_name)))
+        serializer.indent_right()
+        serializer.append_code( "target = {}".format(
+            serializer_call_code( source_ts.gen_read_field( source_instance_name, relation_name), None)))
+        serializer.append_code( "if fresh or {} is not target:".format(
+            self.gen_read_relation( dest_instance_name, relation_name)))
+        serializer.append_code( "    {}.{} = target".format( dest_instance_name, relation_name))
+        serializer.indent_left()
+
     def gen_read_field(self, instance, field):
         return "{}.{}".format(instance, field)
 
@@ -200,13 +565,19 @@ class SQLATypeSupport(TypeSupport):
         return "{}.{} = []".format(dest_instance, dest_name)
 
     def gen_read_relation( self, instance, relation_name):
-        return "{}.{}".format(instance, relation_name)
+        if self._asynchronous:
+            return "(await _sqla_read( {}, '{}'))".format( instance, relation_name)
+        else:
+            return "{}.{}".format(instance, relation_name)
 
     def gen_create_instance(self):
-        return "_sqla_session_add( session, {}())".format(self.type_name())
+        return "_sqla_session_add( session, {}())".format( self._model.__name__)
 
     def serializer_additional_parameters(self):
-        return ["session : Session"]
+        if self._asynchronous:
+            return ["session : AsyncSession"]
+        else:
+            return ["session : Session"]
 
     def relation_copy(self, serializer,
                       source_instance_name, dest_instance_name, relation_name,
@@ -235,13 +606,180 @@ class SQLATypeSupport(TypeSupport):
                                        rel_source_type_support, self,
                                        serializer_call_code,
                                        walk_type,
-                                       collection_class)
+                                       collection_class,
+                                       self.REMOVE_MISSING_MEMBERS,
+                                       self._collection_merge,
+                                       dest_instance_name, relation_name)
 
 
     def __str__(self):
         return "SQLATypeSupport[{}]".format( self.type_name())
 
 
+class SQLADeltaTypeSupport(SQLATypeSupport):
+    """ Reads only what was modified in SQLA mapped instances, according
+    to the history SQLA keeps of their attributes. So a client that
+    polls an order gets only what changed since it was loaded :
+
+        dicts = serialize_many_Order_OrderDelta_to_dict( orders)
+
+    * The key fields are always copied, so that the receiver can
+      tell which instance is concerned.
+    * The other fields are copied only if they were modified.
+    * A single relation is copied if it was changed or if the instance
+      it refers to has changes (and then that instance is copied as a
+      delta too). Unloaded relations are not loaded.
+    * A collection only holds its new members and its members which
+      have changes (as deltas). The removed members are not reported.
+
+    The session resets the history when it flushes, so serialize
+    before committing (and beware of autoflush). The deltas are applied
+    with SQLAPatchTypeSupport.
+    """
+
+    def type_name(self):
+        return "{}Delta".format( self._model.__name__)
+
+    def start_source_serializer(self, serializer, source_instance_name):
+        serializer.append_code("changed = _sqla_changed( {})".format( source_instance_name))
+
+    def gen_read_guard(self, instance, field):
+        return "'{}' in changed".format( field)
+
+    def gen_is_single_relation_present(self, instance, relation_name) -> str:
+        return "'{}' in changed or _sqla_relation_changes( {}, '{}')".format( relation_name, instance, relation_name)
+
+    def gen_read_relation( self, instance, relation_name):
+        return "_sqla_changed_members( {}, '{}')".format( instance, relation_name)
+
+    def gen_global_code(self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("from pyxfer.sqla_runtime import changed_attributes as _sqla_changed, relation_has_changes as _sqla_relation_changes, changed_members as _sqla_changed_members")
+        return super().gen_global_code() + [cw]
+
+    def __str__(self):
+        return "SQLADeltaTypeSupport[{}]".format( self._model.__name__)
+
+
+class SQLAPatchTypeSupport(SQLATypeSupport):
+    """ Writes partial dicts, like the deltas of SQLADeltaTypeSupport,
+    into SQLA mapped instances. Only what is in the dicts is touched :
+
+    * The key fields must be there, they tell which instance to update.
+    * The other fields are written only if they're in the dict.
+    * A collection is merged only if it's in the dict. Its members are
+      merged (or added) but the ones which are not in the dict are
+      left alone (instead of being removed).
+    """
+
+    REMOVE_MISSING_MEMBERS = False
+
+    def type_name(self):
+        return "{}Patch".format( self._model.__name__)
+
+    def gen_write_guard(self, source_ts, source_instance, field):
+        return source_ts.gen_has_field( source_instance, field)
+
+    def relation_copy(self, serializer,
+                      source_instance_name, dest_instance_name, relation_name,
+                      source_ts, dest_ts,
+                      rel_source_type_support,
+                      serializer_call_code,
+                      walk_type):
+
+        serializer.append_code("if {}:".format( source_ts.gen_has_field( source_instance_name, relation_name)))
+        serializer.indent_right()
+        super().relation_copy( serializer,
+                               source_instance_name, dest_instance_name, relation_name,
+                               source_ts, dest_ts,
+                               rel_source_type_support,
+                               serializer_call_code,
+                               walk_type)
+        serializer.indent_left()
+
+    def __str__(self):
+        return "SQLAPatchTypeSupport[{}]".format( self._model.__name__)
+
+
+class SQLARowTypeSupport(TypeSupport):
+    """ Reads SQLA Core rows (as returned by session.execute or
+    connection.execute) instead of mapped instances. The ORM doesn't
+    have to build instances, track them in the session, etc. So for
+    read-only exports, it's much faster.
+
+    The columns are read by position. The positions are given to the
+    fields as the serializer reads them and the select_* companion
+    function builds the select() statement that returns the columns
+    in that order :
+
+        rows = session.execute( select_Order_row_to_dict())
+        dicts = serialize_many_Order_row_to_dict( rows)
+
+    Rows are flat, so relations can't be read with it (SKIP them).
+    select() with columns as arguments needs SQLAlchemy 1.4.
+    """
+
+    def __init__(self, sqla_model):
+        self._model = sqla_model
+        self._positions = dict()
+
+    def type(self):
+        return tuple
+
+    def type_name(self):
+        return "row"
+
+    def type_annotation(self):
+        return "Sequence"
+
+    def make_instance_code(self, destination):
+        raise Exception("Rows are read only")
+
+    def column_position(self, field : str) -> int:
+        if field not in self._positions:
+            self._positions[field] = len( self._positions)
+        return self._positions[field]
+
+    def gen_read_field(self, instance, field):
+        return "{}[{}]".format( instance, self.column_position( field))
+
+    def gen_type_to_basetype_conversion(self, field, code):
+        return code
+
+    def cache_key( self, serializer : Serializer, key_var : str, source_instance_name : str, cache_base_name : str):
+        # There's one row per instance, so there's nothing to reuse.
+        serializer.append_code( "{} = None".format( key_var))
+
+    def gen_is_single_relation_present(self, instance, relation_name) -> str:
+        raise Exception("Rows are flat, they can't hold the relation {}.{}. Please SKIP it.".format(
+            self._model.__name__, relation_name))
+
+    def gen_read_relation( self, instance, relation_name):
+        raise Exception("Rows are flat, they can't hold the relation {}.{}. Please SKIP it.".format(
+            self._model.__name__, relation_name))
+
+    def gen_global_code(self) -> CodeWriter:
+        cw = CodeWriter()
+        cw.append_code("from typing import Sequence")
+        cw.append_code("from sqlalchemy import select")
+        return [cw, gen_model_import( self._model)]
+
+    def gen_source_companions(self, serializer) -> list:
+        # The select for the fields read by the serializer, in
+        # the order of their positions.
+
+        columns = sorted( self._positions, key=lambda f:self._positions[f])
+
+        cw = CodeWriter()
+        cw.append_code("def {}():".format( serializer.companion_func_name( "select")))
+        cw.append_code("    return select( {})".format(
+            ", ".join( [ "{}.{}".format( self._model.__name__, f) for f in columns])))
+        return [cw]
+
+    def __str__(self):
+        return "SQLARowTypeSupport[{}]".format( self._model.__name__)
+
+
 
 
 
@@ -312,6 +850,9 @@ class DictTypeSupport(TypeSupport):
     def gen_is_single_relation_present(self, instance, relation_name) -> str:
         return "('{}' in {} and {}['{}'] is not None)".format(relation_name, instance, instance, relation_name)
 
+    def gen_has_field(self, instance, field) -> str:
+        return "'{}' in {}".format(field, instance)
+
     def relation_copy(self, serializer, source_instance_name, dest_instance_name, relation_name,
                       source_ts, dest_ts,
                       rel_source_type_support,
@@ -345,17 +886,30 @@ class DictTypeSupport(TypeSupport):
 
 
 class ObjectTypeSupport(TypeSupport):
+    """ Plain python objects, which classes are generated along
+    the serializers (see gen_global_code). Their attributes are the
+    fields and relations the serializers read or write.
+
+    :param slots: Generate classes with __slots__ and a constructor
+      taking all the attributes. Such instances don't have a __dict__,
+      so they're much smaller and their attributes are accessed faster.
+      That's for when you have millions of them.
+    :param name_format: Format of the generated class name, given the
+      name of the base type. Use it when the serializers import the
+      base type too (for example, with SQLA entities, "{}DTO").
+    """
 
-    def __init__(self, obj_or_name):
+    def __init__(self, obj_or_name, slots : bool = False, name_format : str = "{}"):
         self._fields = set()
         self._relations = dict()
+        self._slots = slots
 
         if isinstance( obj_or_name, str):
-            self._name = obj_or_name
+            self._name = name_format.format( obj_or_name)
             self._base_type = None
         else:
             #print("Breakpoint : {} aka {}".format( obj_or_name, obj_or_name.__name__))
-            self._name = obj_or_name.__name__
+            self._name = name_format.format( obj_or_name.__name__)
             self._base_type = obj_or_name
 
     def type(self):
@@ -392,12 +946,15 @@ class ObjectTypeSupport(TypeSupport):
     #     #out_lines.append("    d = dict()")
 
     def gen_global_code(self) -> CodeWriter:
+        if self._slots:
+            return self._gen_slots_class()
+
         cw = CodeWriter()
 
         if True or self._base_type is None:
             cw.append_code("class {}:".format(self._name))
             cw.append_code("    def __init__(self):".format(self._name))
-            for f in self._fields:
+            for f in sorted( self._fields):
                 cw.append_code("        self.{} = None".format(f))
 
             if self._relations:
@@ -408,6 +965,34 @@ class ObjectTypeSupport(TypeSupport):
 
         return cw
 
+    def _gen_slots_class(self) -> CodeWriter:
+        # The attributes are the ones recorded during the walk, so
+        # this must be called after the serializers are generated
+        # (generated_code does that).
+
+        fields = sorted( self._fields - set( self._relations))
+        relations = sorted( self._relations)
+        # __weakref__ so that the instances can be identity keys in
+        # a SerializationContext without being kept alive by it.
+        slots = fields + relations + ['__weakref__']
+
+        cw = CodeWriter()
+        cw.append_code("class {}:".format(self._name))
+        cw.indent_right()
+        cw.append_code("__slots__ = ({},)".format( ", ".join( [ "'{}'".format(n) for n in slots])))
+        cw.append_code("")
+        cw.append_code("def __init__(self{}):".format(
+            "".join( [ ", {} = None".format(n) for n in fields + relations])))
+        cw.indent_right()
+        for f in fields:
+            cw.append_code("self.{} = {}".format(f, f))
+        for r in relations:
+            cw.append_code("self.{} = {} if {} is None else {}".format(r, self._relations[r], r, r))
+        if not (fields or relations):
+            cw.append_code("pass")
+        cw.indent_left()
+        cw.indent_left()
+        return cw
 
     def gen_write_field(self, instance, field, value):
         self._fields.add( field)
@@ -514,6 +1099,11 @@ class SQLADictTypeSupport(DictTypeSupport):
     def __init__(self, base_type):
         ftypes, rnames, single_rnames, self._key_names = sqla_attribute_analysis( base_type)
 
+    def short_forms_need_context(self) -> bool:
+        # A short form is resolved as long as its full form is
+        # in the context.
+        return True
+
     def cache_key( self, serializer : Serializer, key_var : str, source_instance_name : str, cache_base_name : str):
         # Compute cache key out of a dict
 
@@ -77,10 +77,11 @@ setuptools.setup(
     url="www.koi.org",
     author="Stefan Champailler",
     author_email="schampailler@skynet.be",
-    python_requires='~=3.6',
+    python_requires='>=3.7',
     packages=['pyxfer'],
-    install_requires=['sqlalchemy>=1.0.0, <1.1.0'],
-    classifiers=['Programming Language :: Python :: 3.6',
+    install_requires=['sqlalchemy>=1.4'],
+    extras_require={'numpy': ['numpy']},
+    classifiers=['Programming Language :: Python :: 3.7',
                  'Development Status :: 3 - Alpha',
                  'Topic :: Software Development :: Code Generators']
 )
@@ -1,12 +1,29 @@
 import io
+from datetime import date
+import os
+import sys
+import tempfile
 import unittest
 from unittest import skip
 from pprint import pprint, PrettyPrinter
 
-from pyxfer.pyxfer import SQLAWalker, SKIP, generated_code, TypeSupportFactory, CodeGenQuick
-from pyxfer.type_support import SQLADictTypeSupport, SQLATypeSupport
+from pyxfer.pyxfer import SQLAWalker, SKIP, VIEWS, COMPANIONS, generated_code, TypeSupportFactory, CodeGenQuick, CodeWriter
+from pyxfer.type_support import SQLADictTypeSupport, SQLATypeSupport, SQLARowTypeSupport, SQLADeltaTypeSupport, SQLAPatchTypeSupport, \
+    MERGE_REPLACE, MERGE_KEYS
+from pyxfer.code_cache import GeneratedCodeCache, schema_fingerprint, generate_code
+from pyxfer.context import SerializationContext
 
-from sqlalchemy import MetaData, Integer, ForeignKey, Date, Column, Float, String, create_engine
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import MetaData, Integer, ForeignKey, Date, Column, Float, String, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, backref, relationship
 
@@ -81,6 +98,49 @@ def rename_ids( d, new_id):
 
     return d
 
+class QueryCounter:
+    """ Counts the SELECT and UPDATE statements sent to the database. """
+
+    def __enter__(self):
+        self.selects = 0
+        self.updates = 0
+        event.listen( engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove( engine, "before_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            self.selects += 1
+        elif statement.lstrip().upper().startswith("UPDATE"):
+            self.updates += 1
+
+
+def orders_schema():
+    """ The fields controls of the orders, their parts and the
+    operations. The parts don't lead back to their order.
+    """
+
+    return { Order : {}, Operation : {}, OrderPart : { 'order' : SKIP } }
+
+def build_serializers( model_and_field_controls, directions, **walker_options):
+    """ Generates and compiles the serializers for @model_and_field_controls
+    in all the @directions (pairs of TypeSupport factories), with
+    all their companions by default.
+    """
+
+    walker_options.setdefault( "companions", COMPANIONS)
+    executed_code = dict()
+    exec( compile( generate_code( model_and_field_controls, directions, **walker_options), "<string>", "exec"), executed_code)
+    return executed_code
+
+def build_spec():
+    """ What python -m pyxfer.build test build_spec generates. """
+
+    return { 'models' : orders_schema(),
+             'directions' : [ (TypeSupportFactory( SQLATypeSupport ), TypeSupportFactory( SQLADictTypeSupport )) ] }
+
 def canonize_dict( d : dict):
     rename_ids( d, dict())
     s = io.StringIO()
@@ -116,6 +176,20 @@ class Test(unittest.TestCase):
 
         session.commit()
 
+    def setUp(self):
+        # Most tests serialize between SQLA entities and dicts
+        self.sqla_factory = TypeSupportFactory( SQLATypeSupport )
+        self.dict_factory = TypeSupportFactory( SQLADictTypeSupport )
+        self.to_dict = (self.sqla_factory, self.dict_factory)
+        self.from_dict = (self.dict_factory, self.sqla_factory)
+
+    def build( self, *directions, models_fc = None, **walker_options):
+        """ build_serializers for @models_fc (the orders schema by default)
+        in the @directions (SQLA entities to dicts by default).
+        """
+
+        return build_serializers( models_fc or orders_schema(), list( directions) or [ self.to_dict ], **walker_options)
+
     #@skip
     def test_happy(self):
         w = SQLAWalker()
@@ -285,6 +359,716 @@ class Test(unittest.TestCase):
 
         assert r == s
 
+    def test_code_cache(self):
+        model_and_field_controls = orders_schema()
+        directions = [ self.to_dict, self.from_dict ]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = GeneratedCodeCache( cache_dir)
+
+            # Generated code must not change from one run to another
+            # else we can't cache it.
+            assert cache.generate( model_and_field_controls, directions) == \
+                cache.generate( model_and_field_controls, directions)
+
+            fingerprint = schema_fingerprint( model_and_field_controls, directions)
+            assert fingerprint != schema_fingerprint( { Order : {}, Operation : {}, OrderPart : { 'order' : SKIP, 'operation' : SKIP } }, directions)
+
+            module = cache.get_module( model_and_field_controls, directions)
+            path = cache.module_path( fingerprint)
+            assert os.path.exists( path)
+            assert module.__file__ == path
+
+            # Second time, the code comes from the disk.
+            del sys.modules[ module.__name__]
+            module = GeneratedCodeCache( cache_dir).get_module( model_and_field_controls, directions)
+            assert module.__file__ == path
+
+            o = session.query(Order).first()
+            serialized = module.serialize_Order_Order_to_dict( o, None)
+            assert serialized['order_id'] == o.order_id
+            assert len( serialized['parts']) == 2
+
+    def test_code_writer(self):
+        inner = CodeWriter()
+        inner.append_code( ["a = 1", "b = 2"])
+
+        cw = CodeWriter()
+        cw.append_code( "def f():")
+        cw.indent_right()
+        cw.append_code( inner)
+        cw.append_code( "return a + b")
+        cw.indent_left()
+        cw.insert_code( ["# header", "# two"], 0)
+        cw.insert_code( inner, 3, 2)
+
+        assert cw.generated_code().split("\n") == [
+            "# header", "# two", "def f():",
+            "        a = 1", "        b = 2",
+            "    a = 1", "    b = 2", "    return a + b" ]
+
+    def test_schema_index(self):
+        from pyxfer.pyxfer import schema_index, sqla_attribute_analysis
+
+        info = schema_index.info( OrderPart)
+        assert schema_index.info( OrderPart) is info
+        assert info.knames == ['order_part_id']
+        assert info.relation_target( 'operation') is Operation
+        assert info.fk_columns['order'] == [ ('order_id', 'order_id')]
+
+        ftypes, rnames, single_rnames, knames = sqla_attribute_analysis( Order)
+        assert ftypes['start_date'] == Date and rnames == { 'parts' : OrderPart } and not single_rnames
+        ftypes.clear() # Copies, the index is not changed
+        assert 'start_date' in schema_index.info( Order).ftypes
+
+        factory = TypeSupportFactory( SQLATypeSupport )
+        assert factory.get_type_support( Order) is factory.get_type_support( Order)
+
+    def test_plan(self):
+        from pyxfer.pyxfer import strongly_connected_components
+
+        cgq = CodeGenQuick( self.sqla_factory, self.dict_factory, SQLAWalker())
+
+        # Dependencies first
+        assert cgq.plan( orders_schema()) == \
+            [ [Operation], [OrderPart], [Order] ]
+
+        # Order and OrderPart refer to each other
+        plan = cgq.plan( { Order : {}, Operation : {}, OrderPart : {} })
+        assert plan[0] == [Operation] and set( plan[1]) == set( [Order, OrderPart]) and len( plan) == 2
+        serializers = cgq.make_serializers( { Order : {}, Operation : {}, OrderPart : {} })
+        assert serializers[OrderPart].relations['order'][0].func_name() == serializers[Order].func_name()
+
+        with self.assertRaises( Exception) as ctx:
+            cgq.plan( { Order : {}, OrderPart : { 'order' : SKIP } })
+        assert "OrderPart.operation of type Operation" in str( ctx.exception)
+
+        # No recursion, a long chain doesn't hit the recursion limit
+        chain = dict( [ (i, [i+1]) for i in range( 5000)] + [ (5000, [0])])
+        assert strongly_connected_components( chain) == [ list( range( 5001)) ]
+
+    def test_lazy(self):
+        from pyxfer.lazy import LazySerializers
+
+        sqla_factory, dict_factory = self.to_dict
+        models_fc = orders_schema()
+        models_fc[Order] = { VIEWS : { 'summary' : ['cost'] } }
+        serializers = LazySerializers( models_fc, companions=COMPANIONS)
+
+        # Only what's reachable from the requested class is generated
+        to_dict = serializers.get( sqla_factory, OrderPart, dict_factory)
+        assert serializers.is_generated( sqla_factory, Operation, dict_factory)
+        assert not serializers.is_generated( sqla_factory, Order, dict_factory)
+
+        part = session.query(OrderPart).first()
+        assert to_dict( part, None)['operation']['operation_id'] == part.operation_id
+
+        # The serializers already generated are reused, their
+        # code is not kept
+        assert serializers.get( sqla_factory, OrderPart, dict_factory) is to_dict
+        assert not serializers._walker.serializers
+        assert not [ s for direction in serializers._directions.values() for s in direction[1].values() if s.generated_code()]
+        o = session.query(Order).first()
+        serialized = serializers.get( sqla_factory, Order, dict_factory, "serialize_many")( [o])[0]
+        assert len( serialized['parts']) == len( o.parts)
+        assert serializers.get( sqla_factory, Order, dict_factory, "views")['summary']( o, None) == \
+            { 'order_id' : o.order_id, 'cost' : o.cost }
+
+        # Each direction is generated on its own
+        assert not serializers.is_generated( dict_factory, Order, sqla_factory)
+        session.expunge_all()
+        merged = serializers.get( dict_factory, Order, sqla_factory)( serialized, None, session)
+        assert merged.parts[0].operation.operation_id == o.parts[0].operation.operation_id
+        session.rollback()
+
+    def test_build(self):
+        from pyxfer.build import main
+        from pyxfer.code_cache import load_module
+
+        with tempfile.TemporaryDirectory() as build_dir:
+            path = os.path.join( build_dir, "generated", "pyxfer_built_serializers.py")
+
+            assert main( [ __name__, "build_spec", "--output", path, "--check"]) == 1
+            assert main( [ __name__, "build_spec", "--output", path]) == 0
+            assert os.path.exists( os.path.join( build_dir, "generated", "__init__.py"))
+            assert main( [ __name__, "build_spec", "--output", path, "--check"]) == 0
+
+            module = load_module( path)
+            try:
+                o = session.query(Order).first()
+                assert module.serialize_Order_Order_to_dict( o, None)['order_id'] == o.order_id
+            finally:
+                del sys.modules[ module.__name__]
+
+            # Outdated
+            with open( path) as f:
+                code = f.read()
+            with open( path, "w") as f:
+                f.write( code.replace( "fingerprint : ", "fingerprint : x", 1))
+            assert main( [ __name__, "build_spec", "--output", path, "--check"]) == 1
+
+    def test_inline(self):
+        from pyxfer.inline import inline_call, can_inline
+
+        if not can_inline():
+            return
+
+        called = self.build( self.to_dict, self.from_dict)
+        inlined = self.build( self.to_dict, self.from_dict, inline_threshold=100)
+
+        # Operation is inlined in OrderPart, OrderPart is not inlined
+        # in Order (it's a collection)
+        serializer = CodeGenQuick( self.sqla_factory, self.dict_factory, SQLAWalker( inline_threshold=100)).make_serializers( orders_schema())
+        assert "serialize_Operation_Operation_to_dict(" not in serializer[OrderPart].function_code()
+        assert "serialize_OrderPart_OrderPart_to_dict(" in serializer[Order].function_code()
+
+        orders = session.query(Order).all()
+        serialized = inlined['serialize_many_Order_Order_to_dict']( orders)
+        assert serialized == called['serialize_many_Order_Order_to_dict']( orders)
+
+        session.expunge_all()
+        merged = inlined['serialize_Order_dict_to_Order']( serialized[0], None, session)
+        assert merged.parts[0].operation.operation_id == serialized[0]['parts'][0]['operation']['operation_id']
+        session.rollback()
+
+        # In a cycle walked in reverse order (OrderPart before Order),
+        # Order is only forward declared when OrderPart is walked :
+        # it's called, not inlined.
+        cyclic = { OrderPart : {}, Operation : {}, Order : {} }
+        assert CodeGenQuick( self.sqla_factory, self.dict_factory, SQLAWalker()).plan( cyclic)[1][0] is OrderPart
+        called = self.build( models_fc=cyclic)
+        inlined = self.build( models_fc=cyclic, inline_threshold=100)
+        part = session.query(OrderPart).first()
+        assert inlined['serialize_OrderPart_OrderPart_to_dict']( part, None)['order']['order_id'] == part.order_id
+        assert inlined['serialize_OrderPart_OrderPart_to_dict']( part, None) == \
+            called['serialize_OrderPart_OrderPart_to_dict']( part, None)
+
+        # Returns in loops can't be inlined
+        function = "def f( source, destination, cache):\n    for x in source:\n        return x\n    return None"
+        assert inline_call( "y = f( s, None, cache)", function, "f", "_i1_") is None
+        assert inline_call( "y = f( s, None, cache)", function.replace( "return x", "pass"), "f", "_i1_") == \
+            [ "for _i1_x in s:", "    pass", "_i1_result = None", "y = _i1_result" ]
+
+    def test_serialization_context(self):
+
+        class Thing:
+            pass
+
+        context = SerializationContext( max_size=2)
+        context['a'], context['b'] = 1, 2
+        context['a'] # a is now the most recently used
+        context['c'] = 3
+        assert 'b' not in context and 'a' in context and 'c' in context
+
+        # Identity entries don't keep instances alive
+        context = SerializationContext()
+        thing = Thing()
+        context[ context.identity_key( "Thing", thing)] = "serialized"
+        assert len(context) == 1
+        del thing
+        assert len(context) == 0
+
+        with SerializationContext() as context:
+            context['a'] = 1
+        assert len(context) == 0
+
+        # Unbounded contexts are plain dicts for the generated code,
+        # only the bounded ones keep track of the use of their entries
+        from pyxfer.context import BoundedSerializationContext
+        assert type( SerializationContext()).__getitem__ is dict.__getitem__
+        assert isinstance( SerializationContext( max_size=2), BoundedSerializationContext)
+        thing = Thing()
+        assert SerializationContext.for_call().identity_key( "Thing", thing) == ("Thing", id(thing))
+
+        code = self.build()
+        serialize_part = code['serialize_OrderPart_OrderPart_to_dict']
+
+        # Without a context, each call starts from scratch, so
+        # the shared operation is serialized completely each time.
+        part = session.query(OrderPart).first()
+        assert serialize_part( part, None)['operation'] == serialize_part( part, None)['operation']
+
+        # With a context, the second time, it's a short form.
+        context = SerializationContext()
+        p1 = serialize_part( part, None, context)
+        p2 = serialize_part( part.order.parts[1], None, context)
+        assert p1['operation'] == {'name': 'lazer cutting', 'operation_id': 12}
+        assert p2['operation'] == {'operation_id': 12}
+
+    def test_batch_serializers(self):
+        code = self.build( self.to_dict, self.from_dict)
+
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id).all()
+        serialized = code['serialize_many_OrderPart_OrderPart_to_dict']( parts)
+
+        # The operation is shared by the parts, so it's serialized
+        # once in the whole batch.
+        assert [ p['order_part_id'] for p in serialized] == [ p.order_part_id for p in parts]
+        assert serialized[0]['operation'] == {'name': 'lazer cutting', 'operation_id': 12}
+        assert serialized[1]['operation'] == {'operation_id': 12}
+
+        unserialized = code['serialize_many_OrderPart_dict_to_OrderPart']( serialized, session)
+        assert unserialized == parts
+        assert unserialized[0].operation is unserialized[1].operation
+        session.commit()
+
+    def test_prefetch(self):
+        code = self.build( self.to_dict, self.from_dict)
+
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id).all()
+        serialized = code['serialize_many_OrderPart_OrderPart_to_dict']( parts)
+        serialized.append( { 'order_part_id' : None, 'name' : "Part Three",
+                             'order_id' : parts[0].order_id, 'operation_id' : 12,
+                             'operation' : { 'operation_id' : 12 } })
+        session.expunge_all()
+
+        # One query for the parts, one for the operations, whatever
+        # the number of parts.
+        with QueryCounter() as counter:
+            unserialized = code['serialize_many_OrderPart_dict_to_OrderPart']( serialized, session)
+        assert counter.selects == 2, counter.selects
+
+        assert [ p.name for p in unserialized] == ["Part One", "Part Two", "Part Three"]
+        assert unserialized[0].operation is unserialized[2].operation
+        session.rollback()
+
+        # The collections the merge goes through are loaded along
+        # their instances, so the number of queries doesn't depend
+        # on the number of orders.
+        for i in range( 5):
+            order = Order( cost = i)
+            order.parts.append( OrderPart( name = "Part {}".format(i), operation_id = 12))
+            session.add( order)
+        session.flush()
+
+        selects = []
+        for count in ( 1, 6):
+            serialized = code['serialize_many_Order_Order_to_dict']( session.query(Order).order_by(Order.order_id).limit( count).all())
+            session.expunge_all()
+            with QueryCounter() as counter:
+                orders = code['serialize_many_Order_dict_to_Order']( serialized, session)
+            selects.append( counter.selects)
+            assert [ len( o.parts) for o in orders] == [ len( d['parts']) for d in serialized]
+        assert selects[0] == selects[1], selects
+        session.rollback()
+
+    def test_loader_options(self):
+        code = self.build()
+
+        expected = code['serialize_many_Order_Order_to_dict']( session.query(Order).all())
+        session.expunge_all()
+
+        # One query for the orders, one for all their parts
+        # (with their operations).
+        with QueryCounter() as counter:
+            orders = session.query(Order).options( *code['loader_options_Order_Order_to_dict']()).all()
+            serialized = code['serialize_many_Order_Order_to_dict']( orders)
+        assert counter.selects == 2, counter.selects
+        assert canonize_dict( { 'r' : serialized}) == canonize_dict( { 'r' : expected})
+
+    @unittest.skipIf( numpy is None, "NumPy is not installed")
+    def test_numpy_columns(self):
+        from pyxfer.numpy_support import SQLANumpyTypeSupport, ColumnBatch
+
+        code = self.build( (self.sqla_factory, TypeSupportFactory( SQLANumpyTypeSupport )),
+                           models_fc={ OrderPart : { 'order' : SKIP, 'operation' : SKIP } })
+
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id).all()
+        batch = code['serialize_many_OrderPart_OrderPart_to_columns']( parts)
+
+        assert len(batch) == 2
+        assert batch['order_part_id'].dtype == numpy.int64
+        assert list( batch['order_part_id']) == [ p.order_part_id for p in parts]
+        assert list( batch['name']) == ["Part One", "Part Two"]
+
+        # One row at a time
+        batch = ColumnBatch( code['columns_OrderPart_OrderPart_to_columns'], 2)
+        code['serialize_OrderPart_OrderPart_to_columns']( parts[1], batch)
+        assert len(batch) == 1 and batch['name'][0] == "Part Two"
+
+    def test_json(self):
+        import gzip, json
+        from pyxfer.json_support import SQLAJSONTypeSupport, json_stream
+
+        code = self.build( self.to_dict, (self.sqla_factory, TypeSupportFactory( SQLAJSONTypeSupport )))
+
+        orders = session.query(Order).all()
+        expected = code['serialize_many_Order_Order_to_dict']( orders)
+
+        text = code['serialize_Order_Order_to_json']( orders[0], None).getvalue()
+        assert json.loads( text) == expected[0]
+
+        # Short forms work across the batch too.
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id).all()
+        text = code['serialize_many_OrderPart_OrderPart_to_json']( parts + [None]).getvalue()
+        assert json.loads( text) == code['serialize_many_OrderPart_OrderPart_to_dict']( parts) + [None]
+
+        out = io.BytesIO()
+        with json_stream( out, compress=True) as stream:
+            code['serialize_many_Order_Order_to_json']( orders, stream)
+        assert json.loads( gzip.decompress( out.getvalue()).decode('utf-8')) == expected
+
+    def test_stream(self):
+        from pyxfer.sqla_runtime import expunger
+
+        code = self.build()
+
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id)
+        expected = code['serialize_many_OrderPart_OrderPart_to_dict']( parts.all())
+
+        operation = session.query(Operation).get(12) # Not garbage collected while streaming
+        cache = SerializationContext( max_size = 1)
+        stream = code['stream_OrderPart_OrderPart_to_dict']( parts.yield_per(1), cache, window=1,
+                                                             release=expunger( session))
+        got = list( stream)
+        assert [ p['order_part_id'] for p in got] == [ p['order_part_id'] for p in expected]
+
+        # With a window of 1, the context only remembers the last
+        # serialization of the previous part : its operation, which
+        # the next part shares.
+        assert len( cache) == 1
+        assert expected[1]['operation'] == { 'operation_id' : 12 }
+        assert got[0]['operation'] == expected[0]['operation']
+        assert got[1]['operation'] == expected[1]['operation']
+
+        # The serialized parts were removed from the session
+        assert not [ p for p in session if isinstance( p, OrderPart)]
+
+        # When order.parts[i].order leads back to the order, the
+        # context must remember the whole of the order while it's
+        # serialized, whatever the window.
+        code = self.build( models_fc={ Order : {}, Operation : {}, OrderPart : {} })
+
+        orders = session.query(Order).order_by(Order.order_id).all()
+        for window in (1, 2):
+            got = list( code['stream_Order_Order_to_dict']( orders, window=window))
+            assert [ o['order_id'] for o in got] == [ o.order_id for o in orders]
+            assert len( got[0]['parts']) == 2
+            assert got[0]['parts'][0]['order'] == { 'order_id' : orders[0].order_id }
+
+        with SerializationContext( max_size = 2) as context:
+            with context.pinned():
+                code['serialize_Order_Order_to_dict']( orders[0], None, context)
+                assert len( context) > 2
+            assert len( context) == 2
+
+        # The companions are opt-in. Dicts, whose short forms need
+        # the whole context, are never streamed.
+        code = self.build( self.to_dict, self.from_dict, companions=())
+        assert 'serialize_Order_dict_to_Order' in code
+        assert not [ name for name in code if name.startswith( ("serialize_many_", "stream_", "loader_options_", "prefetch_", "_collect_keys_"))]
+        code = self.build( self.to_dict, self.from_dict)
+        assert 'stream_Order_Order_to_dict' in code and 'stream_Order_dict_to_Order' not in code
+
+    def test_slots_objects(self):
+        from pyxfer.type_support import ObjectTypeSupport
+
+        obj_factory = TypeSupportFactory( ObjectTypeSupport, slots=True, name_format="{}DTO" )
+        code = self.build( (self.sqla_factory, obj_factory), models_fc={ Order : {}, Operation : {}, OrderPart : {} })
+
+        order = session.query(Order).order_by(Order.order_id).first()
+        dto = code['serialize_Order_Order_to_OrderDTO']( order, None)
+
+        assert not hasattr( dto, '__dict__')
+        assert dto.order_id == order.order_id
+        assert [ p.name for p in dto.parts] == [ p.name for p in order.parts]
+        assert dto.parts[0].order is dto
+        assert dto.parts[0].operation.name == order.parts[0].operation.name
+
+        # The constructor takes all the attributes
+        part = code['OrderPartDTO']( name="Part Three", order_part_id=3)
+        assert part.name == "Part Three" and part.order is None
+        assert code['OrderDTO']().parts == []
+
+    def test_rows(self):
+        code = self.build( self.to_dict, (TypeSupportFactory( SQLARowTypeSupport ), self.dict_factory),
+                           models_fc={ OrderPart : { 'order' : SKIP, 'operation' : SKIP } })
+
+        parts = session.query(OrderPart).order_by(OrderPart.order_part_id).all()
+        expected = code['serialize_many_OrderPart_OrderPart_to_dict']( parts)
+
+        session.expunge_all()
+        with QueryCounter() as counter:
+            rows = session.execute( code['select_OrderPart_row_to_dict']().order_by( OrderPart.order_part_id))
+            assert code['serialize_many_OrderPart_row_to_dict']( rows) == expected
+        assert counter.selects == 1
+
+        # No ORM instance was built
+        assert len( session.identity_map) == 0
+
+    def test_binary_records(self):
+        from pyxfer.binary_support import SQLABinaryTypeSupport, SQLARecordTypeSupport
+
+        code = self.build( self.to_dict,
+                           (self.sqla_factory, TypeSupportFactory( SQLABinaryTypeSupport )),
+                           (TypeSupportFactory( SQLARecordTypeSupport ), self.dict_factory),
+                           models_fc={ Order : { 'parts' : SKIP },
+                                       OrderPart : { 'order' : SKIP, 'operation' : SKIP } })
+
+        # Nulls, dates and non ASCII strings
+        order = Order( start_date = date( 2019, 7, 14), cost = 2.5)
+        order.parts.append( OrderPart( name = "Pièce", operation_id = 12))
+        session.add( order)
+        session.flush()
+
+        for model in ( Order, OrderPart):
+            instances = session.query(model).all()
+            expected = code['serialize_many_{}_{}_to_dict'.format( model.__name__, model.__name__)]( instances)
+
+            data = bytes( code['serialize_many_{}_{}_to_binary'.format( model.__name__, model.__name__)]( instances))
+            records = code['records_{}_record_to_dict'.format( model.__name__)]( data)
+            assert code['serialize_many_{}_record_to_dict'.format( model.__name__)]( records) == expected
+
+        session.rollback()
+
+    def test_parallel(self):
+        import multiprocessing
+        from pyxfer.parallel import ParallelSerializer, EngineSessionFactory
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The workers need a database of their own
+            url = "sqlite:///" + os.path.join( tmp_dir, "test.db")
+            file_session = EngineSessionFactory( url)()
+            MapperBase.metadata.create_all( file_session.get_bind())
+            for i in range( 5):
+                order = Order( cost = i)
+                order.parts.append( OrderPart( name = "Part {}".format(i), operation = Operation( name = "Op")))
+                file_session.add( order)
+            file_session.commit()
+
+            module = GeneratedCodeCache( tmp_dir, companions=COMPANIONS).get_module( orders_schema(), [ self.to_dict ])
+            orders = file_session.query( Order).order_by( Order.order_id.desc()).all()
+            expected = module.serialize_many_Order_Order_to_dict( orders)
+
+            with ParallelSerializer( module, "serialize_Order_Order_to_dict", Order, EngineSessionFactory( url),
+                                     max_workers=2, chunk_size=2,
+                                     mp_context=multiprocessing.get_context( "fork")) as parallel:
+                assert canonize_dict( parallel.map( orders)) == canonize_dict( expected)
+                assert parallel.map( [ orders[1].order_id, 1000]) == [ expected[1], None]
+
+            file_session.close()
+
+    @unittest.skipIf( aiosqlite is None, "aiosqlite is not installed")
+    def test_async(self):
+        import asyncio
+        from sqlalchemy import select
+        from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+        async_factory = TypeSupportFactory( SQLATypeSupport, asynchronous=True )
+        code = self.build( (async_factory, self.dict_factory), (self.dict_factory, async_factory))
+
+        async def run( url):
+            async_engine = create_async_engine( url)
+            async with async_engine.begin() as connection:
+                await connection.run_sync( MapperBase.metadata.create_all)
+
+            async with AsyncSession( async_engine, expire_on_commit=False) as s:
+                order = Order( cost = 1)
+                order.parts.append( OrderPart( name = "Part", operation = Operation( name = "Op")))
+                s.add( order)
+                await s.commit()
+
+            # The relations are lazy loaded, asynchronously
+            async with AsyncSession( async_engine, expire_on_commit=False) as s:
+                orders = ( await s.execute( select( Order))).scalars().all()
+                dicts = await code['serialize_many_Order_Order_to_dict_async']( orders)
+
+            assert dicts[0]['parts'][0]['operation']['name'] == "Op"
+            dicts[0]['parts'][0]['name'] = "Renamed"
+            dicts[0]['parts'][0]['operation']['name'] = "New op"
+
+            async with AsyncSession( async_engine, expire_on_commit=False) as s:
+                await code['serialize_many_Order_dict_to_Order_async']( dicts, s)
+                await s.commit()
+
+            async with AsyncSession( async_engine, expire_on_commit=False) as s:
+                stream = code['stream_Order_Order_to_dict_async']( await s.stream_scalars( select( Order)))
+                dicts = [ d async for d in stream ]
+
+            await async_engine.dispose()
+            return dicts
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dicts = asyncio.run( run( "sqlite+aiosqlite:///" + os.path.join( tmp_dir, "test.db")))
+
+        assert dicts[0]['parts'][0]['name'] == "Renamed"
+        assert dicts[0]['parts'][0]['operation']['name'] == "New op"
+
+    def test_delta(self):
+        code = self.build( (TypeSupportFactory( SQLADeltaTypeSupport ), self.dict_factory),
+                           (self.dict_factory, TypeSupportFactory( SQLAPatchTypeSupport )))
+
+        order = session.query(Order).first()
+        part_one, part_two = sorted( order.parts, key=lambda p:p.name)
+        cost = order.cost
+
+        # Nothing changed, only the keys
+        assert code['serialize_Order_OrderDelta_to_dict']( order, None) == { 'order_id' : order.order_id, 'parts' : [] }
+
+        # The deltas take the options of SQLATypeSupport
+        assert TypeSupportFactory( SQLADeltaTypeSupport, asynchronous=True).get_type_support( Order).is_asynchronous()
+
+        part_one.name = "Renamed"
+        delta = code['serialize_Order_OrderDelta_to_dict']( order, None)
+        assert delta == { 'order_id' : order.order_id,
+                          'parts' : [ { 'order_part_id' : part_one.order_part_id, 'name' : "Renamed" } ] }
+        session.rollback()
+
+        # The patch doesn't touch what's not in the delta
+        code['serialize_Order_dict_to_OrderPatch']( delta, None, session)
+        assert part_one.name == "Renamed"
+        assert part_two in order.parts and part_two.name == "Part Two"
+        assert order.cost == cost
+        session.rollback()
+
+        # The deltas don't load the relations to look for changes
+        fresh_session = Session()
+        parts = fresh_session.query(OrderPart).all()
+        with QueryCounter() as counter:
+            deltas = code['serialize_many_OrderPart_OrderPartDelta_to_dict']( parts)
+        assert counter.selects == 0
+        assert deltas == [ { 'order_part_id' : p.order_part_id } for p in parts]
+        fresh_session.close()
+
+    def test_compare_writes(self):
+        code = self.build( self.to_dict, (self.dict_factory, TypeSupportFactory( SQLATypeSupport, compare_writes=True )))
+
+        dicts = code['serialize_many_Order_Order_to_dict']( session.query(Order).all())
+
+        # Re-importing unchanged data doesn't touch anything
+        with QueryCounter() as counter:
+            orders = code['serialize_many_Order_dict_to_Order']( dicts, session)
+            assert not session.dirty and not session.new
+            session.flush()
+        assert counter.updates == 0
+
+        dicts[0]['parts'][0]['name'] = "Renamed"
+        with QueryCounter() as counter:
+            code['serialize_many_Order_dict_to_Order']( dicts, session)
+            assert list( session.dirty) == [ orders[0].parts[0] ]
+            session.flush()
+        assert counter.updates == 1
+        assert orders[0].parts[0].name == "Renamed"
+
+        # New instances are written in full
+        dicts[0]['parts'].append( { 'order_part_id' : None, 'order_id' : orders[0].order_id, 'name' : "New",
+                                    'operation_id' : orders[0].parts[0].operation_id } )
+        code['serialize_many_Order_dict_to_Order']( dicts, session)
+        assert [ p.name for p in session.new ] == [ "New" ]
+        session.rollback()
+
+    def test_collection_merge(self):
+        from sqlalchemy import inspect
+
+        # MERGE_APPEND, the default : the members are merged in place,
+        # like session.merge does. A new instance is merged as a copy
+        # and the session autoflushes before merging.
+        code = self.build( self.to_dict, self.from_dict)
+        order = session.query(Order).first()
+        parts = list( order.parts)
+        d = code['serialize_Order_Order_to_dict']( order, None)
+        d['parts'].append( { 'order_part_id' : None, 'order_id' : order.order_id, 'name' : "New",
+                             'operation_id' : parts[0].operation_id } )
+
+        assert code['serialize_Order_dict_to_Order']( d, None, session) is order
+        assert order.parts[0:2] == parts
+        new_part = order.parts[2]
+        assert new_part in session.new
+
+        part = OrderPart()
+        merged = code['serialize_OrderPart_dict_to_OrderPart']( d['parts'][2], part, session)
+        assert merged is not part and merged in session and part not in session
+        assert new_part.order_part_id is not None
+        session.rollback()
+
+        for strategy in ( MERGE_REPLACE, MERGE_KEYS):
+            code = self.build( self.to_dict, (self.dict_factory, TypeSupportFactory( SQLATypeSupport, collection_merge=strategy)))
+
+            order = session.query(Order).first()
+            d = code['serialize_Order_Order_to_dict']( order, None)
+
+            # Part Two is removed, Part One renamed and a new part added
+            part_one = [ p for p in d['parts'] if p['name'] == "Part One" ][0]
+            part_one['name'] = "Renamed"
+            d['parts'] = [ part_one,
+                           { 'order_part_id' : None, 'order_id' : order.order_id, 'name' : "New",
+                             'operation_id' : part_one['operation_id'] } ]
+
+            session.expire_all()
+            code['serialize_Order_dict_to_Order']( d, None, session)
+            assert ( 'parts' in inspect( order).unloaded) == ( strategy == MERGE_KEYS)
+            session.flush()
+
+            session.expire_all()
+            assert sorted( [ p.name for p in order.parts]) == [ "New", "Renamed" ]
+            assert session.query(OrderPart).filter( OrderPart.name == "Part Two").count() == 0
+            session.rollback()
+
+            # The new instances are the ones the serializer made and
+            # nothing is flushed.
+            part = OrderPart()
+            assert code['serialize_OrderPart_dict_to_OrderPart']( d['parts'][1], part, session) is part
+            assert part in session.new and part.order_part_id is None
+            session.rollback()
+
+    def test_views(self):
+        from sqlalchemy import inspect
+
+        models_fc = orders_schema()
+        models_fc[Order] = { VIEWS : { 'summary' : [ 'cost' ],
+                                       'no_parts' : { 'parts' : SKIP } } }
+        code = self.build( models_fc=models_fc)
+
+        views = code['views_Order_Order_to_dict']
+        assert views[None] is code['serialize_Order_Order_to_dict']
+
+        order = session.query(Order).first()
+        assert views['summary']( order, None) == { 'order_id' : order.order_id, 'cost' : order.cost }
+        assert set( views['no_parts']( order, None)) == { 'order_id', 'start_date', 'cost' }
+        assert len( views[None]( order, None)['parts']) == 2
+
+        # Only the columns of the view are loaded
+        session.expunge_all()
+        orders = session.query(Order).options( *code['loader_options_Order_Order_to_dict_summary']()).all()
+        assert 'start_date' in inspect( orders[0]).unloaded
+        assert code['serialize_many_Order_Order_to_dict_summary']( orders)[0] == { 'order_id' : order.order_id, 'cost' : order.cost }
+
+    def test_instrumentation(self):
+        from pyxfer.instrumentation import registry, COUNTERS, TIMING
+
+        model_and_field_controls = orders_schema()
+        directions = [ self.to_dict ]
+
+        # No instrumentation, no trace of it in the code
+        with tempfile.TemporaryDirectory() as cache_dir:
+            code = GeneratedCodeCache( cache_dir).generate( model_and_field_controls, directions)
+            assert "_stats" not in code and "perf_counter" not in code
+
+            assert schema_fingerprint( model_and_field_controls, directions) != \
+                schema_fingerprint( model_and_field_controls, directions, walker_options={ 'instrumentation' : TIMING })
+
+        code = self.build( instrumentation=TIMING)
+        registry.reset()
+
+        orders = session.query(Order).all()
+        code['serialize_many_Order_Order_to_dict']( orders)
+
+        order_stats = registry['serialize_Order_Order_to_dict']
+        assert order_stats.calls == order_stats.produced == len( orders)
+        assert order_stats.time_ns > 0
+
+        # Both parts share the same operation
+        operation_stats = registry['serialize_Operation_Operation_to_dict']
+        assert (operation_stats.calls, operation_stats.cache_hits, operation_stats.cache_misses) == (2, 1, 1)
+
+        code = self.build( instrumentation=COUNTERS)
+        registry.reset()
+        code['serialize_many_Order_Order_to_dict']( orders)
+        assert registry['serialize_OrderPart_OrderPart_to_dict'].produced == 2
+        assert registry['serialize_OrderPart_OrderPart_to_dict'].time_ns == 0
+        assert "serialize_OrderPart_OrderPart_to_dict" in registry.report()
+
+
 if __name__ == "__main__":
 
     unittest.main()